@@ -0,0 +1,311 @@
+"""複数の Ollama エンドポイントへの負荷分散
+
+大きな CPU マシンでポートや NUMA ノードごとに Ollama を複数動かすときに使う。
+エンドポイントごとに実行中の数と直近のレイテンシ（指数移動平均）、読み込み済みのモデルを持ち、
+生成のたびに「そのモデルを読み込み済み」で「一番空いている」エンドポイントを選ぶ。
+同じセッションは KV キャッシュを再利用できるよう同じエンドポイントに固定する。
+接続に続けて失敗したエンドポイントは一定時間外し、ヘルスチェックが通れば戻す。
+
+    CLONEAI_OLLAMA_HOSTS=http://127.0.0.1:11434,http://127.0.0.1:11435
+    CLONEAI_OLLAMA_HEALTH_INTERVAL_S=5
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+from metrics import REGISTRY
+
+_in_flight = REGISTRY.gauge("cloneai_backend_in_flight", "Generations currently running per Ollama endpoint")
+_healthy = REGISTRY.gauge("cloneai_backend_healthy", "1 if the Ollama endpoint is in rotation")
+_requests = REGISTRY.counter("cloneai_backend_requests_total", "Generations per Ollama endpoint by outcome")
+_latency = REGISTRY.histogram("cloneai_backend_latency_seconds", "Generation latency per Ollama endpoint")
+
+
+def _normalize_host(host: str) -> str:
+    host = host.strip().rstrip("/")
+    if host.endswith("/api"):
+        host = host[: -len("/api")]
+    if not host.startswith(("http://", "https://")):
+        host = f"http://{host}"
+    return host
+
+
+def _http_json(url: str, timeout: float) -> Dict[str, Any]:
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8") or "{}")
+
+
+def _is_connection_error(exc: BaseException) -> bool:
+    """接続の失敗か。ollama のストリームは httpx の例外を ConnectionError に包まずに投げる"""
+    if isinstance(exc, ConnectionError):
+        return True
+    # httpx は ollama が読み込む。まだ読み込まれていなければ httpx の例外が来ることもない
+    httpx = sys.modules.get("httpx")
+    return httpx is not None and isinstance(exc, httpx.TransportError)
+
+
+class NoHealthyBackendError(ConnectionError):
+    """回せるエンドポイントが1つも無い"""
+
+
+class OllamaEndpoint:
+    """1つの Ollama プロセスの状態（BackendPool のロックの下で更新する）"""
+    def __init__(self, host: str):
+        self.host = _normalize_host(host)
+        self.healthy = True
+        self.in_flight = 0
+        self.ewma_s: Optional[float] = None
+        self.loaded_models: Set[str] = set()
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self._client: Any = None
+
+    @property
+    def api_base(self) -> str:
+        return f"{self.host}/api"
+
+    def client(self) -> Any:
+        """このエンドポイント用の ollama.Client（初回に作る）"""
+        if self._client is None:
+            from clone_agentAI import load_ollama
+            ollama = load_ollama()
+            if ollama is None:
+                raise RuntimeError("ollama パッケージが見つかりません")
+            self._client = ollama.Client(host=self.host)
+        return self._client
+
+    def has_model(self, model: str) -> bool:
+        # /api/ps は "gemma3:1b" のようにタグ付きで返すので、タグ省略時は :latest とみなす
+        return model in self.loaded_models or (":" not in model and f"{model}:latest" in self.loaded_models)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "host": self.host,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "latency_ms": None if self.ewma_s is None else round(self.ewma_s * 1000.0, 1),
+            "loaded_models": sorted(self.loaded_models),
+        }
+
+
+class BackendPool:
+    """プロセスで共有するエンドポイントのプール"""
+    def __init__(
+        self,
+        hosts: List[str],
+        ewma_alpha: float = 0.2,
+        max_failures: int = 2,
+        eject_s: float = 30.0,
+        probe: Optional[Callable[[OllamaEndpoint], Set[str]]] = None,
+    ):
+        if not hosts:
+            raise ValueError("BackendPool needs at least one host")
+        self.endpoints = [OllamaEndpoint(h) for h in hosts]
+        self.ewma_alpha = ewma_alpha
+        # 続けてこの回数だけ接続に失敗したら eject_s 秒外す
+        self.max_failures = max_failures
+        self.eject_s = eject_s
+        # エンドポイントに問い合わせて読み込み済みのモデルを返す（失敗なら例外）。テストで差し替える
+        self.probe = probe or self._probe_http
+        self._pins: Dict[str, OllamaEndpoint] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> Optional["BackendPool"]:
+        """CLONEAI_OLLAMA_HOSTS が設定されていなければ None（従来どおり OLLAMA_HOST の1台）"""
+        hosts = [h for h in os.getenv("CLONEAI_OLLAMA_HOSTS", "").split(",") if h.strip()]
+        return cls(hosts) if hosts else None
+
+    # ---- ヘルスチェック ----
+
+    @staticmethod
+    def _probe_http(endpoint: OllamaEndpoint) -> Set[str]:
+        _http_json(f"{endpoint.api_base}/version", timeout=2)
+        models = _http_json(f"{endpoint.api_base}/ps", timeout=2).get("models") or []
+        return {m.get("name") or m.get("model") for m in models if m.get("name") or m.get("model")}
+
+    def check(self, endpoint: OllamaEndpoint) -> bool:
+        try:
+            loaded = self.probe(endpoint)
+        except Exception:
+            with self._lock:
+                self._eject(endpoint)
+            return False
+        with self._lock:
+            endpoint.loaded_models = set(loaded)
+            endpoint.consecutive_failures = 0
+            endpoint.ejected_until = 0.0
+            endpoint.healthy = True
+        _healthy.set(1, host=endpoint.host)
+        return True
+
+    def check_all(self) -> int:
+        """全エンドポイントを確認して、回せる数を返す"""
+        return sum(1 for endpoint in self.endpoints if self.check(endpoint))
+
+    def start(self, interval_s: Optional[float] = None) -> None:
+        """バックグラウンドで定期的にヘルスチェックする（二重には起動しない）"""
+        if interval_s is None:
+            interval_s = float(os.getenv("CLONEAI_OLLAMA_HEALTH_INTERVAL_S", "5"))
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(interval_s,), name="ollama-health", daemon=True)
+        self._thread.start()
+
+    def _run(self, interval_s: float) -> None:
+        while not self._stop.wait(interval_s):
+            self.check_all()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def any_healthy(self) -> bool:
+        with self._lock:
+            return any(self._available(e, time.monotonic()) for e in self.endpoints)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [e.snapshot() for e in self.endpoints]
+
+    # ---- 振り分け ----
+
+    def _available(self, endpoint: OllamaEndpoint, now: float) -> bool:
+        return endpoint.healthy or now >= endpoint.ejected_until > 0
+
+    def _eject(self, endpoint: OllamaEndpoint) -> None:
+        endpoint.healthy = False
+        endpoint.ejected_until = time.monotonic() + self.eject_s
+        for key in [k for k, e in self._pins.items() if e is endpoint]:
+            del self._pins[key]
+        _healthy.set(0, host=endpoint.host)
+
+    @staticmethod
+    def _load(endpoint: OllamaEndpoint) -> float:
+        """空き具合の目安: (実行中 + 1) × 直近のレイテンシ（未計測なら実行中の数だけで比べる）"""
+        return (endpoint.in_flight + 1) * (endpoint.ewma_s if endpoint.ewma_s is not None else 1.0)
+
+    def select(self, model: str, session_key: Optional[str] = None) -> OllamaEndpoint:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints if self._available(e, now)]
+            if not candidates:
+                raise NoHealthyBackendError("利用できる Ollama エンドポイントがありません")
+            pinned = self._pins.get(session_key) if session_key else None
+            if pinned is not None and pinned in candidates:
+                return pinned
+            # モデルを読み込み済みのものを優先する（どこにも無ければ読み込ませるしかない）
+            warm = [e for e in candidates if e.has_model(model)] or candidates
+            chosen = min(warm, key=lambda e: (self._load(e), e.in_flight))
+            if session_key:
+                self._pins[session_key] = chosen
+            return chosen
+
+    @contextmanager
+    def lease(self, model: str, session_key: Optional[str] = None) -> Iterator[OllamaEndpoint]:
+        """生成の間エンドポイントを借りる。接続エラーなら失敗として数え、続けば外す"""
+        endpoint = self.select(model, session_key)
+        with self._lock:
+            endpoint.in_flight += 1
+        _in_flight.inc(host=endpoint.host)
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield endpoint
+        except GeneratorExit:
+            # ストリームを途中で閉じた（呼び出し元のキャンセル）。レイテンシには数えない
+            outcome = "cancelled"
+            raise
+        except Exception as exc:
+            outcome = "connection_error" if _is_connection_error(exc) else "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                endpoint.in_flight -= 1
+                if outcome == "connection_error":
+                    endpoint.consecutive_failures += 1
+                    if endpoint.consecutive_failures >= self.max_failures:
+                        self._eject(endpoint)
+                elif outcome == "ok":
+                    # "error"（モデルが無いなどのエラーの応答）では読み込み済みとも回復したとも言えないので何も変えない
+                    endpoint.consecutive_failures = 0
+                    endpoint.loaded_models.add(model)
+                    endpoint.healthy = True
+                    prev = endpoint.ewma_s
+                    endpoint.ewma_s = elapsed if prev is None else prev + self.ewma_alpha * (elapsed - prev)
+            _in_flight.dec(host=endpoint.host)
+            _requests.inc(host=endpoint.host, outcome=outcome)
+            if outcome == "ok":
+                _latency.observe(elapsed, host=endpoint.host)
+
+    def chat(self, session_key: Optional[str] = None, retries: int = 1, **kwargs: Any) -> Any:
+        """ollama.chat と同じ引数で呼ぶ。接続できなければ別のエンドポイントで retries 回までやり直す"""
+        return self._call("chat", session_key, retries, kwargs)
+
+    def generate(self, session_key: Optional[str] = None, retries: int = 1, **kwargs: Any) -> Any:
+        """ollama.generate と同じ引数で呼ぶ（context を続けるときは session_key で同じエンドポイントに固定する）"""
+        return self._call("generate", session_key, retries, kwargs)
+
+    def _call(self, method: str, session_key: Optional[str], retries: int, kwargs: Dict[str, Any]) -> Any:
+        if kwargs.get("stream"):
+            return self._stream(method, session_key, retries, kwargs)
+        for attempt in range(retries + 1):
+            try:
+                with self.lease(kwargs["model"], session_key) as endpoint:
+                    return getattr(endpoint.client(), method)(**kwargs)
+            except NoHealthyBackendError:
+                raise
+            except Exception as exc:
+                if not _is_connection_error(exc):
+                    raise
+                with self._lock:
+                    self._pins.pop(session_key, None)
+                if attempt == retries:
+                    raise
+        raise AssertionError("unreachable")
+
+    def _stream(self, method: str, session_key: Optional[str], retries: int, kwargs: Dict[str, Any]) -> Iterator[Any]:
+        """ストリームを読み終える（または閉じる）までエンドポイントを借りたままにする"""
+        for attempt in range(retries + 1):
+            started = False
+            try:
+                with self.lease(kwargs["model"], session_key) as endpoint:
+                    for chunk in getattr(endpoint.client(), method)(**kwargs):
+                        started = True
+                        yield chunk
+                return
+            except NoHealthyBackendError:
+                raise
+            except Exception as exc:
+                if not _is_connection_error(exc):
+                    raise
+                with self._lock:
+                    self._pins.pop(session_key, None)
+                # 途中まで返したあとはやり直せない
+                if started or attempt == retries:
+                    raise
+
+
+_pool: Optional[BackendPool] = None
+_pool_lock = threading.Lock()
+_pool_loaded = False
+
+
+def get_backend_pool() -> Optional[BackendPool]:
+    """CLONEAI_OLLAMA_HOSTS からプロセスで1つのプールを作る（未設定なら None）"""
+    global _pool, _pool_loaded
+    with _pool_lock:
+        if not _pool_loaded:
+            _pool = BackendPool.from_env()
+            _pool_loaded = True
+    return _pool
@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, TextIO, Tuple
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from clone_agentAI import (  # noqa: E402
+    PERSONA_PROMPT_MODES,
+    AIPersonaAgent,
+    cassette_replay_enabled,
+    check_ollama_available,
+    load_ollama,
+)
+from personas import CompiledPersona, get_registry  # noqa: E402
+
+
+@dataclass
+class BatchItem:
+    """One input line: either a multi-turn conversation or a single prompt with context."""
+
+    id: str
+    turns: List[str]
+    context: str
+    persona_id: Optional[str]
+    raw: Dict[str, Any]
+
+
+def parse_item(data: Dict[str, Any], line_no: int) -> BatchItem:
+    """Accept {"turns": [...]} conversations and benchmark-style {"prompt", "context"} examples."""
+    if isinstance(data.get("turns"), list) and data["turns"]:
+        turns = [str(t) for t in data["turns"]]
+    elif data.get("prompt"):
+        turns = [str(data["prompt"])]
+    else:
+        raise ValueError(f"line {line_no}: expected 'turns' or 'prompt'")
+    return BatchItem(
+        id=str(data.get("id") or f"item_{line_no:05d}"),
+        turns=turns,
+        context=str(data.get("context") or ""),
+        persona_id=data.get("persona_id"),
+        raw=data,
+    )
+
+
+def read_items(path: Path) -> List[BatchItem]:
+    items = []
+    with path.open("r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if line:
+                items.append(parse_item(json.loads(line), line_no))
+    return items
+
+
+def item_hash(item: BatchItem, persona_id: str, model: str, prompt_mode: str, backend: str = "ollama") -> str:
+    """Content hash of the input and everything that changes the output (not the id or line order).
+
+    `backend` is "simulation", "ollama" or "server", so simulated replies never count as done for a real run.
+    """
+    canonical = json.dumps(
+        {
+            "turns": item.turns,
+            "context": item.context,
+            "persona_id": persona_id,
+            "model": model,
+            "prompt_mode": prompt_mode,
+            "backend": backend,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def completed_hashes(path: Path) -> Set[str]:
+    """Hashes of successful results already in the output (a torn last line is ignored)."""
+    done: Set[str] = set()
+    if not path.exists():
+        return done
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("hash") and not record.get("error"):
+                done.add(record["hash"])
+    return done
+
+
+def seed_context(agent: AIPersonaAgent, context: str, persona_names: Iterable[str]) -> int:
+    """Load a "speaker: text" transcript into the agent's history as (user, persona) pairs.
+
+    Lines by one of `persona_names` become agent replies; everything else is user input.
+    Trailing user lines are dropped: benchmark contexts end with the prompt itself.
+    """
+    names = {n.strip() for n in persona_names if n.strip()}
+    pending: List[str] = []
+    seeded = 0
+    for line in context.splitlines():
+        speaker, sep, text = line.partition(":")
+        if not sep or not text.strip():
+            continue
+        if speaker.strip() in names:
+            agent.memory.add_interaction("\n".join(pending), text.strip())
+            pending = []
+            seeded += 1
+        else:
+            pending.append(text.strip())
+    return seeded
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        out: TextIO,
+        model: str,
+        simulation_mode: bool,
+        prompt_mode: str,
+        persona_names: List[str],
+        concurrency: int,
+        transport: Any = None,
+    ):
+        self.out = out
+        self.model = model
+        self.simulation_mode = simulation_mode
+        self.prompt_mode = prompt_mode
+        self.persona_names = persona_names
+        # ollama.Client pointed at clone_server's /api/chat (--server); None talks to Ollama directly
+        self.transport = transport
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.lock = asyncio.Lock()
+        self.completed = 0
+        self.failed = 0
+
+    def _agent(self, persona: CompiledPersona) -> AIPersonaAgent:
+        agent = AIPersonaAgent(
+            persona.template,
+            model_name=self.model,
+            simulation_mode=self.simulation_mode,
+            persona_prompt_mode=self.prompt_mode,
+            trait_index=persona.trait_index,
+            generation_options=persona.options or None,
+        )
+        if self.transport is not None:
+            agent.client.transport = self.transport
+        return agent
+
+    async def run_item(self, item: BatchItem, persona: CompiledPersona, digest: str) -> None:
+        async with self.semaphore:
+            agent = self._agent(persona)
+            names = [persona.template.name, *self.persona_names]
+            seeded = seed_context(agent, item.context, names) if item.context else 0
+            replies = []
+            error = None
+            started = time.perf_counter()
+            for turn, message in enumerate(item.turns):
+                turn_started = time.perf_counter()
+                reply = await agent.aprocess_input(message)
+                if agent.last_error:
+                    # Recorded per item so the batch keeps going; failed items are retried on resume
+                    error = agent.last_error
+                    break
+                replies.append(
+                    {
+                        "turn": turn,
+                        "message": message,
+                        "reply": reply,
+                        "latency_ms": round((time.perf_counter() - turn_started) * 1000.0, 1),
+                    }
+                )
+            record = {
+                "id": item.id,
+                "hash": digest,
+                "persona_id": persona.persona_id,
+                "model": self.model,
+                "simulation": self.simulation_mode,
+                "context_turns": seeded,
+                "replies": replies,
+                "total_ms": round((time.perf_counter() - started) * 1000.0, 1),
+            }
+            if "reference" in item.raw:
+                record["reference"] = item.raw["reference"]
+            if error:
+                record["error"] = error
+            async with self.lock:
+                self.out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self.out.flush()
+                if error:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+
+
+async def run_batch(
+    items: List[BatchItem],
+    out_path: Path,
+    model: str,
+    simulation_mode: bool,
+    prompt_mode: str,
+    persona_names: List[str],
+    concurrency: int,
+    default_persona: Optional[str] = None,
+    transport: Any = None,
+) -> Tuple[int, int, int]:
+    """Run all items not yet in `out_path`; returns (completed, failed, skipped)."""
+    registry = get_registry()
+    done = completed_hashes(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    skipped = 0
+    backend = "simulation" if simulation_mode else "server" if transport is not None else "ollama"
+    with out_path.open("a", encoding="utf-8") as out:
+        runner = BatchRunner(out, model, simulation_mode, prompt_mode, persona_names, concurrency, transport)
+        tasks = []
+        for item in items:
+            persona = registry.get(item.persona_id or default_persona)
+            digest = item_hash(item, persona.persona_id, model, prompt_mode, backend)
+            if digest in done:
+                skipped += 1
+                continue
+            done.add(digest)
+            tasks.append(runner.run_item(item, persona, digest))
+        await asyncio.gather(*tasks)
+    return runner.completed, runner.failed, skipped
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Pre-generate persona replies for a JSONL prompt set")
+    parser.add_argument("--input", required=True, help="JSONL with {'turns': [...]} or {'prompt', 'context'} per line")
+    parser.add_argument("--output", required=True, help="Results JSONL (appended; completed items are skipped)")
+    parser.add_argument("--model", default=os.getenv("CLONEAI_OLLAMA_MODEL", "gemma3:1b"))
+    parser.add_argument("--persona", help="Persona id for items without 'persona_id' (default: registry default)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Items generated at the same time")
+    parser.add_argument(
+        "--prompt-mode",
+        choices=PERSONA_PROMPT_MODES,
+        default=os.getenv("CLONEAI_PERSONA_PROMPT_MODE", "selective"),
+    )
+    parser.add_argument("--persona-names", default="聖,Hijiri,福井聖", help="Speaker names treated as the persona in 'context'")
+    parser.add_argument("--simulate", action="store_true", help="Use the simulation backend even if Ollama is up")
+    parser.add_argument(
+        "--server",
+        help="Generate through a running clone_server (e.g. http://127.0.0.1:8001) so live /chat turns go first",
+    )
+    parser.add_argument("--priority", choices=["batch", "background"], default="batch", help="Scheduling class with --server")
+    parser.add_argument("--verbose", action="store_true", help="Show the agent's thought log")
+
+    args = parser.parse_args(argv)
+    # argparse does not check the default (taken from CLONEAI_PERSONA_PROMPT_MODE) against choices
+    if args.prompt_mode not in PERSONA_PROMPT_MODES:
+        parser.error(f"invalid --prompt-mode / CLONEAI_PERSONA_PROMPT_MODE: {args.prompt_mode!r}")
+
+    items = read_items(Path(args.input))
+    transport = None
+    if args.server and not args.simulate:
+        server = args.server.rstrip("/")
+        if not check_ollama_available(f"{server}/api"):
+            print(f"ERROR: clone_server is not reachable at {server}", file=sys.stderr)
+            return 1
+        ollama = load_ollama()
+        if ollama is None:
+            print("ERROR: python package 'ollama' is required for --server", file=sys.stderr)
+            return 1
+        transport = ollama.Client(host=server, headers={"X-CloneAI-Priority": args.priority})
+        simulation_mode = False
+    elif args.simulate:
+        simulation_mode = True
+    elif cassette_replay_enabled() or check_ollama_available():
+        simulation_mode = False
+    else:
+        print("ERROR: Ollama is not reachable; start it or pass --simulate", file=sys.stderr)
+        return 1
+    backend = "simulation" if simulation_mode else f"server:{args.priority}" if transport is not None else "ollama"
+    print(
+        f"{len(items)} items, backend={backend}, "
+        f"model={args.model}, concurrency={args.concurrency}",
+        file=sys.stderr,
+    )
+
+    started = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        completed, failed, skipped = asyncio.run(
+            run_batch(
+                items,
+                Path(args.output),
+                args.model,
+                simulation_mode,
+                args.prompt_mode,
+                [n for n in args.persona_names.split(",") if n.strip()],
+                args.concurrency,
+                default_persona=args.persona,
+                transport=transport,
+            )
+        )
+    elapsed = time.perf_counter() - started
+
+    print(
+        f"completed={completed} failed={failed} skipped={skipped} in {elapsed:.1f}s -> {args.output}",
+        file=sys.stderr,
+    )
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
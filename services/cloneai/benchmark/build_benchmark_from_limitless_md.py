@@ -8,7 +8,7 @@ from pathlib import Path
 from typing import Iterable, List, Optional
 
 
-SPEAKER_LINE_RE = re.compile(r"^\*\*(?P<speaker>[^*]+)\*\*:\s*(?P<content>.+)\s*$")
+SPEAKER_LINE_RE = re.compile(r"^(?:[-*]\s+)?\*\*(?P<speaker>[^*]+)\*\*:\s*(?P<content>.+)\s*$")
 
 
 @dataclass
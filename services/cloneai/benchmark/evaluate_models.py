@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import argparse
 import json
+import sys
 from dataclasses import dataclass
 from difflib import SequenceMatcher
 from pathlib import Path
@@ -27,16 +28,44 @@ def main() -> int:
     parser.add_argument("--models", required=True, help="Comma-separated Ollama model names")
     parser.add_argument("--out", required=True, help="Output JSON path")
     parser.add_argument("--max", type=int, default=50, help="Max examples to evaluate")
+    parser.add_argument("--cassette", help="Record/replay Ollama traffic to this cassette (.jsonl.gz)")
+    parser.add_argument("--cassette-mode", choices=["record", "replay"], default="replay")
+    parser.add_argument(
+        "--replay-speed", choices=["recorded", "fast"], default="fast", help="Replay at recorded timing or instantly"
+    )
+    parser.add_argument(
+        "--server",
+        help="Submit through a running clone_server (e.g. http://127.0.0.1:8001) so live /chat turns go first",
+    )
+    parser.add_argument("--priority", choices=["batch", "background"], default="batch", help="Scheduling class with --server")
 
     args = parser.parse_args()
 
-    # Lazy import so this script can be run even when ollama isn't installed.
-    try:
-        import ollama  # type: ignore
-    except Exception:
-        print("ERROR: python package 'ollama' is not available. Activate venv and pip install ollama")
+    if args.server and args.cassette:
+        print("ERROR: --server and --cassette cannot be combined")
         return 1
 
+    if args.cassette:
+        sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+        from cassette import Cassette, CassetteTransport
+
+        transport = CassetteTransport(Cassette(Path(args.cassette)), mode=args.cassette_mode, speed=args.replay_speed)
+        chat = transport.chat
+    else:
+        chat = None
+
+    # Lazy import so this script can be run even when ollama isn't installed (or when replaying a cassette).
+    if chat is None or args.cassette_mode == "record":
+        try:
+            import ollama  # type: ignore
+        except Exception:
+            print("ERROR: python package 'ollama' is not available. Activate venv and pip install ollama")
+            return 1
+        if chat is None and args.server:
+            chat = ollama.Client(host=args.server, headers={"X-CloneAI-Priority": args.priority}).chat
+        elif chat is None:
+            chat = ollama.chat
+
     bench_path = Path(args.benchmark)
     examples: List[Dict] = []
     with bench_path.open("r", encoding="utf-8") as f:
@@ -73,7 +102,7 @@ def main() -> int:
             if ctx:
                 system_content += "\n\n以下は直近の会話文脈です。参考にしてください。\n" + ctx
 
-            resp = ollama.chat(
+            resp = chat(
                 model=model,
                 messages=[
                     {"role": "system", "content": system_content},
@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import argparse
+import json
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+# Reply text is emitted one character per "token" so that latency is easy to reason about.
+REPLY_TEXT = "たしかに、それはおもろいな。俺も最近そういうこと考えてて、結局やってみるのが一番やと思うねん。"
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (Japanese averages ~2 chars per token on gemma-class tokenizers)."""
+    return max(1, len(text) // 2)
+
+
+@dataclass
+class FakeOllamaConfig:
+    token_ms: float = 20.0
+    prompt_eval_ms: float = 0.5
+    load_ms: float = 0.0
+    parallel: int = 1
+    reply_tokens: int = 60
+    models: Tuple[str, ...] = ("gemma3:1b",)
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """HTTP server that mimics the parts of the Ollama API used by cloneAI.
+
+    Generation waits for one of `parallel` slots (like OLLAMA_NUM_PARALLEL), then
+    sleeps prompt_tokens * prompt_eval_ms followed by token_ms per emitted token.
+    A /api/generate `context` is treated as a warm prefix: only the new prompt is evaluated,
+    and the returned context extends the one sent.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], config: FakeOllamaConfig):
+        super().__init__(address, FakeOllamaHandler)
+        self.config = config
+        self.slots = threading.Semaphore(max(1, config.parallel))
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.served = 0
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, name="fake-ollama", daemon=True)
+        thread.start()
+        return thread
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    server: FakeOllamaServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        pass
+
+    def do_GET(self) -> None:  # noqa: N802
+        cfg = self.server.config
+        if self.path == "/api/version":
+            self._send_json({"version": "0.0.0-fake"})
+        elif self.path in ("/api/tags", "/api/ps"):
+            self._send_json({"models": [{"name": m, "model": m} for m in cfg.models]})
+        elif self.path == "/":
+            self._send_text("Ollama is running")
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self) -> None:  # noqa: N802
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json({"error": "invalid JSON"}, status=400)
+            return
+
+        if self.path in ("/api/chat", "/api/generate"):
+            self._generate(body, chat=self.path == "/api/chat")
+        elif self.path in ("/api/embed", "/api/embeddings"):
+            self._embed(body, legacy=self.path == "/api/embeddings")
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def _generate(self, body: Dict[str, Any], chat: bool) -> None:
+        cfg = self.server.config
+        model = body.get("model") or cfg.models[0]
+        if model not in cfg.models:
+            self._send_json({"error": f"model '{model}' not found"}, status=404)
+            return
+
+        if chat:
+            prompt_text = "".join(str(m.get("content", "")) for m in body.get("messages") or [])
+        else:
+            prompt_text = str(body.get("prompt", ""))
+        prior_context = [] if chat else list(body.get("context") or [])
+        options = body.get("options") or {}
+        prompt_tokens = estimate_tokens(prompt_text)
+        n_tokens = int(options.get("num_predict") or cfg.reply_tokens)
+        if n_tokens < 0:
+            n_tokens = cfg.reply_tokens
+        stream = body.get("stream", True)
+
+        started = time.perf_counter_ns()
+        with self.server.slots:
+            with self.server.lock:
+                self.server.in_flight += 1
+            try:
+                load_ns = int(cfg.load_ms * 1e6)
+                time.sleep(cfg.load_ms / 1000.0)
+                prompt_eval_ns = int(prompt_tokens * cfg.prompt_eval_ms * 1e6)
+                time.sleep(prompt_eval_ns / 1e9)
+                if stream:
+                    self._stream_tokens(
+                        model, chat, n_tokens, started, load_ns, prompt_tokens, prompt_eval_ns, prior_context
+                    )
+                else:
+                    eval_start = time.perf_counter_ns()
+                    time.sleep(n_tokens * cfg.token_ms / 1000.0)
+                    text = "".join(_reply_tokens(n_tokens))
+                    final = _final_chunk(
+                        model, chat, text, started, load_ns, prompt_tokens, prompt_eval_ns,
+                        n_tokens, time.perf_counter_ns() - eval_start, prior_context,
+                    )
+                    self._send_json(final)
+            finally:
+                with self.server.lock:
+                    self.server.in_flight -= 1
+                    self.server.served += 1
+
+    def _stream_tokens(
+        self,
+        model: str,
+        chat: bool,
+        n_tokens: int,
+        started: int,
+        load_ns: int,
+        prompt_tokens: int,
+        prompt_eval_ns: int,
+        prior_context: List[int],
+    ) -> None:
+        cfg = self.server.config
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        eval_start = time.perf_counter_ns()
+        try:
+            for token in _reply_tokens(n_tokens):
+                time.sleep(cfg.token_ms / 1000.0)
+                chunk = {"model": model, "created_at": _now(), "done": False}
+                if chat:
+                    chunk["message"] = {"role": "assistant", "content": token}
+                else:
+                    chunk["response"] = token
+                self._write_chunk(chunk)
+            final = _final_chunk(
+                model, chat, "", started, load_ns, prompt_tokens, prompt_eval_ns,
+                n_tokens, time.perf_counter_ns() - eval_start, prior_context,
+            )
+            self._write_chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away mid-stream; Ollama stops generating in that case too.
+            self.close_connection = True
+
+    def _embed(self, body: Dict[str, Any], legacy: bool) -> None:
+        if legacy:
+            self._send_json({"embedding": _fake_embedding(str(body.get("prompt", "")))})
+            return
+        inputs = body.get("input") or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self._send_json({"model": body.get("model"), "embeddings": [_fake_embedding(x) for x in inputs]})
+
+    def _write_chunk(self, payload: Dict[str, Any]) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, payload: Dict[str, Any], status: int = 200) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_text(self, text: str) -> None:
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _reply_tokens(n_tokens: int) -> Iterator[str]:
+    for i in range(n_tokens):
+        yield REPLY_TEXT[i % len(REPLY_TEXT)]
+
+
+def _final_chunk(
+    model: str,
+    chat: bool,
+    text: str,
+    started: int,
+    load_ns: int,
+    prompt_tokens: int,
+    prompt_eval_ns: int,
+    eval_count: int,
+    eval_ns: int,
+    prior_context: Optional[List[int]] = None,
+) -> Dict[str, Any]:
+    final: Dict[str, Any] = {
+        "model": model,
+        "created_at": _now(),
+        "done": True,
+        "done_reason": "stop",
+        "total_duration": time.perf_counter_ns() - started,
+        "load_duration": load_ns,
+        "prompt_eval_count": prompt_tokens,
+        "prompt_eval_duration": prompt_eval_ns,
+        "eval_count": eval_count,
+        "eval_duration": eval_ns,
+    }
+    if chat:
+        final["message"] = {"role": "assistant", "content": text}
+    else:
+        final["response"] = text
+        final["context"] = list(prior_context or []) + list(range(prompt_tokens + eval_count))
+    return final
+
+
+def _fake_embedding(text: str, dim: int = 64) -> List[float]:
+    seed = zlib.crc32(text.encode("utf-8"))
+    return [((seed * (i + 1)) % 1000) / 1000.0 for i in range(dim)]
+
+
+def _now() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def serve(host: str, port: int, config: FakeOllamaConfig) -> FakeOllamaServer:
+    return FakeOllamaServer((host, port), config)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Fake Ollama HTTP server with configurable latency")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--token-ms", type=float, default=20.0, help="Per generated token latency (ms)")
+    parser.add_argument("--prompt-eval-ms", type=float, default=0.5, help="Per prompt token eval cost (ms)")
+    parser.add_argument("--load-ms", type=float, default=0.0, help="Model load time added to each request (ms)")
+    parser.add_argument("--parallel", type=int, default=1, help="Parallel generation slots (OLLAMA_NUM_PARALLEL)")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="Tokens per reply when num_predict is unset")
+    parser.add_argument("--models", default="gemma3:1b", help="Comma-separated model names to advertise")
+
+    args = parser.parse_args(argv)
+
+    config = FakeOllamaConfig(
+        token_ms=args.token_ms,
+        prompt_eval_ms=args.prompt_eval_ms,
+        load_ms=args.load_ms,
+        parallel=args.parallel,
+        reply_tokens=args.reply_tokens,
+        models=tuple(m.strip() for m in str(args.models).split(",") if m.strip()),
+    )
+    server = serve(args.host, args.port, config)
+    print(f"Fake Ollama listening on {server.base_url} (set OLLAMA_HOST={server.base_url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
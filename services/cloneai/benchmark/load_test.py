@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import requests
+
+
+# Default multi-turn script: the scripted opener from clone_agentAI.test_mode plus follow-ups.
+DEFAULT_SCRIPTS: List[List[str]] = [
+    [
+        "こんにちは、自己紹介してください",
+        "プログラミングで最近興味あることは？",
+        "この週末の予定は？",
+        "Rustと他の言語を比較するとどうですか？",
+    ],
+    [
+        "はじめまして！",
+        "好きな食べ物は何？",
+        "最近ハマってるゲームある？",
+    ],
+]
+
+
+@dataclass
+class TurnResult:
+    participant: int
+    turn: int
+    started: float
+    latency_s: float
+    ok: bool
+    status: Optional[int] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class Report:
+    mode: str
+    participants: int
+    duration_s: float
+    turns: int
+    errors: int
+    error_rate: float
+    throughput_rps: float
+    latency_ms: Dict[str, float] = field(default_factory=dict)
+    error_kinds: Dict[str, int] = field(default_factory=dict)
+
+
+def percentile(sorted_values: Sequence[float], pct: float) -> float:
+    """Nearest-rank percentile over an already sorted sequence."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(results: List[TurnResult], mode: str, participants: int, duration_s: float) -> Report:
+    latencies = sorted(r.latency_s * 1000.0 for r in results if r.ok)
+    errors = [r for r in results if not r.ok]
+    kinds: Dict[str, int] = {}
+    for r in errors:
+        key = r.error or f"HTTP {r.status}"
+        kinds[key] = kinds.get(key, 0) + 1
+    return Report(
+        mode=mode,
+        participants=participants,
+        duration_s=duration_s,
+        turns=len(results),
+        errors=len(errors),
+        error_rate=len(errors) / max(1, len(results)),
+        throughput_rps=len(latencies) / duration_s if duration_s > 0 else 0.0,
+        latency_ms={
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else 0.0,
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+        },
+        error_kinds=kinds,
+    )
+
+
+class Participant:
+    """One virtual participant: a session that walks through a multi-turn script."""
+
+    def __init__(self, index: int, base_url: str, script: List[str], think_s: float, timeout_s: float, model: Optional[str]):
+        self.index = index
+        self.base_url = base_url.rstrip("/")
+        self.script = script
+        self.think_s = think_s
+        self.timeout_s = timeout_s
+        self.model = model
+        self.session_id = f"load-{index}-{uuid.uuid4().hex[:8]}"
+        self.http = requests.Session()
+
+    def run(self, sink: List[TurnResult], lock: threading.Lock) -> None:
+        for turn, message in enumerate(self.script):
+            payload = {"message": message, "session_id": self.session_id, "reset": turn == 0}
+            if self.model:
+                payload["model_name"] = self.model
+            started = time.perf_counter()
+            try:
+                res = self.http.post(f"{self.base_url}/chat", json=payload, timeout=self.timeout_s)
+                body = res.json() if res.status_code == 200 else {}
+                # A backend failure still answers 200 with an apology; count it as an error
+                error = "backend_error" if body.get("error") else None
+                ok = res.status_code == 200 and bool(body.get("reply")) and error is None
+                result = TurnResult(
+                    self.index, turn, started, time.perf_counter() - started, ok, res.status_code, error=error
+                )
+            except requests.RequestException as exc:
+                result = TurnResult(
+                    self.index, turn, started, time.perf_counter() - started, False, error=type(exc).__name__
+                )
+            with lock:
+                sink.append(result)
+            if self.think_s > 0:
+                time.sleep(random.expovariate(1.0 / self.think_s))
+
+
+def run_closed_loop(
+    base_url: str,
+    participants: int,
+    scripts: List[List[str]],
+    think_s: float,
+    timeout_s: float,
+    model: Optional[str],
+    iterations: int,
+) -> List[TurnResult]:
+    """N participants each run their script `iterations` times back to back."""
+    results: List[TurnResult] = []
+    lock = threading.Lock()
+
+    def worker(i: int) -> None:
+        for _ in range(iterations):
+            Participant(i, base_url, scripts[i % len(scripts)], think_s, timeout_s, model).run(results, lock)
+
+    with ThreadPoolExecutor(max_workers=participants) as pool:
+        list(pool.map(worker, range(participants)))
+    return results
+
+
+def run_open_loop(
+    base_url: str,
+    rate: float,
+    duration_s: float,
+    scripts: List[List[str]],
+    think_s: float,
+    timeout_s: float,
+    model: Optional[str],
+) -> List[TurnResult]:
+    """New participants arrive as a Poisson process regardless of how slow the server is."""
+    results: List[TurnResult] = []
+    lock = threading.Lock()
+    threads: List[threading.Thread] = []
+    start = time.perf_counter()
+    stop_at = start + duration_s
+    index = 0
+    next_arrival = start
+    while next_arrival < stop_at:
+        time.sleep(max(0.0, next_arrival - time.perf_counter()))
+        participant = Participant(index, base_url, scripts[index % len(scripts)], think_s, timeout_s, model)
+        t = threading.Thread(target=participant.run, args=(results, lock), daemon=True)
+        t.start()
+        threads.append(t)
+        index += 1
+        next_arrival += random.expovariate(rate)
+    for t in threads:
+        t.join()
+    return results
+
+
+def load_scripts(path: Optional[str]) -> List[List[str]]:
+    """Scripts file: JSON list of message lists, or JSONL with {"turns": [...]} per line."""
+    if not path:
+        return DEFAULT_SCRIPTS
+    text = Path(path).read_text(encoding="utf-8").strip()
+    if text.startswith("["):
+        return [list(s) for s in json.loads(text)]
+    return [list(json.loads(line)["turns"]) for line in text.splitlines() if line.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Drive clone_server /chat with virtual participants")
+    parser.add_argument("--url", default="http://127.0.0.1:8001", help="clone_server base URL")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--participants", type=int, default=8, help="Concurrent participants (closed loop)")
+    parser.add_argument("--iterations", type=int, default=1, help="Script repetitions per participant (closed loop)")
+    parser.add_argument("--rate", type=float, default=1.0, help="Participant arrivals per second (open loop)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Arrival window in seconds (open loop)")
+    parser.add_argument("--think", type=float, default=0.0, help="Mean think time between turns (s)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout (s)")
+    parser.add_argument("--scripts", help="JSON/JSONL file with multi-turn scripts")
+    parser.add_argument("--model", help="model_name to send with each request")
+    parser.add_argument("--out", help="Write the JSON report to this path")
+
+    args = parser.parse_args(argv)
+    scripts = load_scripts(args.scripts)
+
+    started = time.perf_counter()
+    if args.mode == "closed":
+        results = run_closed_loop(
+            args.url, args.participants, scripts, args.think, args.timeout, args.model, args.iterations
+        )
+        participants = args.participants
+    else:
+        results = run_open_loop(args.url, args.rate, args.duration, scripts, args.think, args.timeout, args.model)
+        participants = len({r.participant for r in results})
+    elapsed = time.perf_counter() - started
+
+    report = summarize(results, args.mode, participants, elapsed)
+    lat = report.latency_ms
+    print(
+        f"{report.mode}: participants={report.participants} turns={report.turns} "
+        f"throughput={report.throughput_rps:.2f} req/s errors={report.errors} ({report.error_rate:.1%})"
+    )
+    print(
+        f"latency ms: p50={lat['p50']:.0f} p90={lat['p90']:.0f} p95={lat['p95']:.0f} "
+        f"p99={lat['p99']:.0f} max={lat['max']:.0f}"
+    )
+    for kind, count in report.error_kinds.items():
+        print(f"  error {kind}: {count}")
+
+    if args.out:
+        out_path = Path(args.out)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        with out_path.open("w", encoding="utf-8") as f:
+            json.dump(asdict(report), f, ensure_ascii=False, indent=2)
+        print(f"Wrote: {out_path}")
+
+    return 0 if report.errors == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import gc
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+for _path in (ROOT_DIR / "src", ROOT_DIR):
+    if str(_path) not in sys.path:
+        sys.path.insert(0, str(_path))
+
+from benchmark.build_benchmark_from_limitless_md import iter_utterances_from_md  # noqa: E402
+from clone_agentAI import AIPersonaAgent, MemoryManager, create_yamada_taro_persona  # noqa: E402
+from limitless_api.lifelog_client import _lifelog_from_json  # noqa: E402
+from retrieval import PersonaTraitIndex  # noqa: E402
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "micro_baseline.json"
+DEFAULT_THRESHOLD = 1.5
+CALIBRATION = "calibration"
+HISTORY_SIZES = (10, 100, 1000)
+
+USER_TURN = "最近プログラミングで面白かったことある？週末は何してた？"
+AGENT_TURN = "まあ、そうだね...最近はRustで小さいツールを書いてて、型のおかげで安心して書き換えられるのが楽しいわ。"
+
+
+@dataclass
+class CaseResult:
+    name: str
+    ns_per_call: float
+    calls: int
+
+
+@dataclass
+class Regression:
+    name: str
+    baseline_ns: float
+    current_ns: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current_ns / self.baseline_ns if self.baseline_ns else float("inf")
+
+
+def _filled_memory(size: int) -> MemoryManager:
+    memory = MemoryManager(max_history=size)
+    for _ in range(size):
+        memory.add_interaction(USER_TURN, AGENT_TURN)
+    return memory
+
+
+def _agent(history: int, persona_prompt_mode: str = "full") -> AIPersonaAgent:
+    persona = create_yamada_taro_persona()
+    agent = AIPersonaAgent(persona, simulation_mode=True, persona_prompt_mode=persona_prompt_mode)
+    agent.memory = _filled_memory(history)
+    return agent
+
+
+def _lifelog_page(entries: int) -> List[Dict[str, Any]]:
+    """A `lifelogs` page as the API returns it; `_lifelog_from_json` parses the timestamps of each entry."""
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    page = []
+    for i in range(entries):
+        begin = start + timedelta(hours=i)
+        page.append({
+            "id": f"log-{i}",
+            "title": "長い会議",
+            "startTime": begin.isoformat().replace("+00:00", "Z"),
+            "endTime": (begin + timedelta(minutes=50)).isoformat().replace("+00:00", "Z"),
+            "isStarred": i % 2 == 0,
+            "updatedAt": (begin + timedelta(minutes=55)).isoformat().replace("+00:00", "Z"),
+            "markdown": f"- **福井聖**: {AGENT_TURN}",
+            "contents": [{"type": "blockquote", "content": AGENT_TURN, "speakerName": "福井聖", "startOffsetMs": 0}],
+        })
+    return page
+
+
+def _lifelog_markdown(target_bytes: int) -> str:
+    block = (
+        "### 雑談\n\n"
+        f"- **相手**: {USER_TURN}\n"
+        f"- **福井聖**: {AGENT_TURN}\n"
+        "メモ: 話者行ではない行\n\n"
+    )
+    return block * max(1, target_bytes // len(block.encode("utf-8")))
+
+
+def _calibration() -> int:
+    """Fixed pure-Python workload used to normalise results for the speed of the machine."""
+    total = 0
+    for i in range(2000):
+        total += len(str(i)) * (i & 7)
+    return total
+
+
+def build_cases() -> List[Tuple[str, Callable[[], Any]]]:
+    """Hot-path cases as (name, zero-argument callable); setup happens here, outside the timed loop."""
+    cases: List[Tuple[str, Callable[[], Any]]] = [(CALIBRATION, _calibration)]
+
+    persona = create_yamada_taro_persona()
+    cases.append(("persona.to_prompt[full]", persona.to_prompt))
+    traits = PersonaTraitIndex(persona.trait_entries())
+    selected = traits.select(USER_TURN, k=8)
+    cases.append(("persona.to_prompt[selective]", lambda: persona.to_prompt(selected_entries=selected)))
+
+    for size in HISTORY_SIZES:
+        agent = _agent(size)
+
+        def build(agent: AIPersonaAgent = agent) -> str:
+            agent.thought_flow.thoughts.clear()
+            return agent._build_prompt(USER_TURN)
+
+        cases.append((f"agent._build_prompt[history={size}]", build))
+
+    for size in HISTORY_SIZES:
+        memory = _filled_memory(size)
+        cases.append((f"memory.add_interaction[history={size}]", lambda m=memory: m.add_interaction(USER_TURN, AGENT_TURN)))
+        cases.append((f"memory.get_history_as_text[history={size}]", memory.get_history_as_text))
+
+    analyzer = _agent(0)
+
+    def analyze() -> str:
+        analyzer.thought_flow.thoughts.clear()
+        return analyzer._analyze_response(AGENT_TURN, USER_TURN)
+
+    cases.append(("agent._analyze_response", analyze))
+
+    # Entries per page, parsed the way LifelogClient.list_lifelogs does
+    for entries in (10, 100):
+        page = _lifelog_page(entries)
+        cases.append((f"_lifelog_from_json[page={entries}]", lambda p=page: [_lifelog_from_json(e) for e in p]))
+
+    markdown = _lifelog_markdown(4 * 1024 * 1024)
+    cases.append(("iter_utterances_from_md[4MB]", lambda: sum(1 for _ in iter_utterances_from_md(markdown))))
+    return cases
+
+
+def measure(fn: Callable[[], Any], min_time: float = 0.1, repeat: int = 7) -> CaseResult:
+    """Best-of-`repeat` time per call, with the call count calibrated so each repeat lasts `min_time`."""
+    calls = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or calls >= 1 << 20:
+            break
+        calls *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    best = elapsed / calls
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat - 1):
+            started = time.perf_counter()
+            for _ in range(calls):
+                fn()
+            best = min(best, (time.perf_counter() - started) / calls)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return CaseResult(name="", ns_per_call=best * 1e9, calls=calls)
+
+
+def run(
+    name_filter: Optional[str] = None, min_time: float = 0.1, repeat: int = 7
+) -> List[CaseResult]:
+    results = []
+    # ThoughtFlow prints every thought; send it to devnull so the terminal doesn't dominate the timings
+    with open(os.devnull, "w", encoding="utf-8") as sink, contextlib.redirect_stdout(sink):
+        for name, fn in build_cases():
+            if name_filter and name_filter not in name:
+                continue
+            result = measure(fn, min_time=min_time, repeat=repeat)
+            result.name = name
+            results.append(result)
+    return results
+
+
+def compare(
+    results: List[CaseResult], baseline: Dict[str, Any], threshold: Optional[float] = None
+) -> List[Regression]:
+    """Cases slower than baseline * threshold. Cases missing from the baseline are ignored.
+
+    When both runs include the calibration case, current timings are scaled by the
+    calibration ratio so a uniformly slower machine doesn't read as a regression.
+    """
+    limit = threshold or float(baseline.get("threshold", DEFAULT_THRESHOLD))
+    cases = baseline.get("cases", {})
+    current = {r.name: r.ns_per_call for r in results}
+    scale = 1.0
+    if CALIBRATION in cases and current.get(CALIBRATION):
+        scale = float(cases[CALIBRATION]["ns_per_call"]) / current[CALIBRATION]
+    regressions = []
+    for result in results:
+        base = cases.get(result.name)
+        if base is None or result.name == CALIBRATION:
+            continue
+        regression = Regression(result.name, float(base["ns_per_call"]), result.ns_per_call * scale)
+        if regression.ratio > limit:
+            regressions.append(regression)
+    return regressions
+
+
+def _format_ns(ns: float) -> str:
+    for unit, scale in (("s", 1e9), ("ms", 1e6), ("us", 1e3)):
+        if ns >= scale:
+            return f"{ns / scale:.2f} {unit}"
+    return f"{ns:.0f} ns"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the cloneAI agent hot path")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="Baseline JSON to compare against")
+    parser.add_argument("--update", action="store_true", help="Write the current results as the new baseline")
+    parser.add_argument("--threshold", type=float, help="Allowed slowdown ratio (default: baseline's, else 1.5)")
+    parser.add_argument("--filter", help="Only run cases whose name contains this string")
+    parser.add_argument("--min-time", type=float, default=0.1, help="Minimum seconds per timed repeat")
+    parser.add_argument("--repeat", type=int, default=7, help="Timed repeats per case (best is kept)")
+
+    args = parser.parse_args(argv)
+    results = run(args.filter, min_time=args.min_time, repeat=args.repeat)
+    if args.filter and not any(r.name == CALIBRATION for r in results):
+        results.insert(0, run(CALIBRATION, min_time=args.min_time, repeat=args.repeat)[0])
+
+    baseline_path = Path(args.baseline)
+    baseline: Dict[str, Any] = {}
+    if baseline_path.exists():
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    base_cases = baseline.get("cases", {})
+
+    for r in results:
+        base = base_cases.get(r.name)
+        delta = f"  x{r.ns_per_call / base['ns_per_call']:.2f}" if base else ""
+        print(f"{r.name:<48} {_format_ns(r.ns_per_call):>12}{delta}")
+
+    if args.update:
+        merged = dict(base_cases)
+        merged.update({r.name: {"ns_per_call": round(r.ns_per_call, 1)} for r in results})
+        payload = {
+            "threshold": args.threshold or baseline.get("threshold", DEFAULT_THRESHOLD),
+            "python": sys.version.split()[0],
+            "cases": dict(sorted(merged.items())),
+        }
+        baseline_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"Wrote baseline: {baseline_path}")
+        return 0
+
+    if not baseline:
+        print(f"No baseline at {baseline_path}; run with --update to create one")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for reg in regressions:
+        print(
+            f"REGRESSION {reg.name}: {_format_ns(reg.baseline_ns)} -> {_format_ns(reg.current_ns)} (x{reg.ratio:.2f})"
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
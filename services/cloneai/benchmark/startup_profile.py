@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SERVICE_DIR = Path(__file__).resolve().parents[1]
+DEFAULT_OUT = Path(__file__).resolve().parent / "startup_report.json"
+
+
+@dataclass
+class ImportEntry:
+    module: str
+    self_ms: float
+    cumulative_ms: float
+    depth: int
+
+
+@dataclass
+class StartupReport:
+    python: str
+    import_total_ms: float
+    top_imports: List[Dict[str, float]] = field(default_factory=list)
+    time_to_live_ms: List[float] = field(default_factory=list)
+    time_to_ready_ms: List[float] = field(default_factory=list)
+    warmup_ms: Dict[str, float] = field(default_factory=dict)
+
+
+def parse_importtime(stderr: str) -> List[ImportEntry]:
+    """Parse `python -X importtime` output ("import time: self | cumulative | name")."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        entries.append(ImportEntry(name.strip(), int(self_us) / 1000.0, int(cumulative_us) / 1000.0, depth))
+    return entries
+
+
+def measure_imports(module: str = "clone_server") -> Tuple[float, List[ImportEntry]]:
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SERVICE_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries = parse_importtime(proc.stderr)
+    total = next((e.cumulative_ms for e in entries if e.module == module and e.depth == 0), 0.0)
+    return total, entries
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get(url: str) -> Tuple[Optional[int], bytes]:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as res:
+            return res.status, res.read()
+    except urllib.error.HTTPError as exc:
+        return exc.code, b""
+    except OSError:
+        return None, b""
+
+
+def measure_boot(timeout_s: float = 15.0) -> Tuple[float, float, Dict[str, float]]:
+    """Spawn uvicorn and time how long until /health and /ready answer 200."""
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "clone_server:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=SERVICE_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=os.environ.copy(),
+    )
+    live_ms = ready_ms = float("nan")
+    warmup: Dict[str, float] = {}
+    try:
+        while time.perf_counter() - started < timeout_s:
+            if live_ms != live_ms and _get(f"{base}/health")[0] == 200:
+                live_ms = (time.perf_counter() - started) * 1000.0
+            status, body = _get(f"{base}/ready")
+            if status == 200:
+                ready_ms = (time.perf_counter() - started) * 1000.0
+                warmup = json.loads(body).get("warmup_ms", {})
+                break
+            time.sleep(0.005)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return live_ms, ready_ms, warmup
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Measure clone_server import time and time-to-ready")
+    parser.add_argument("--runs", type=int, default=3, help="Cold boots to time")
+    parser.add_argument("--top", type=int, default=15, help="Slowest imports to include in the report")
+    parser.add_argument("--out", default=str(DEFAULT_OUT), help="Write the JSON report to this path")
+
+    args = parser.parse_args(argv)
+
+    total, entries = measure_imports()
+    top = sorted(entries, key=lambda e: e.self_ms, reverse=True)[: args.top]
+    report = StartupReport(
+        python=sys.version.split()[0],
+        import_total_ms=round(total, 1),
+        top_imports=[{"module": e.module, "self_ms": round(e.self_ms, 1), "cumulative_ms": round(e.cumulative_ms, 1)} for e in top],
+    )
+    for _ in range(args.runs):
+        live_ms, ready_ms, warmup = measure_boot()
+        report.time_to_live_ms.append(round(live_ms, 1))
+        report.time_to_ready_ms.append(round(ready_ms, 1))
+        report.warmup_ms = warmup
+
+    print(f"import clone_server: {report.import_total_ms:.0f} ms")
+    for item in report.top_imports[:5]:
+        print(f"  {item['module']:<40} self={item['self_ms']:.1f} ms cumulative={item['cumulative_ms']:.1f} ms")
+    print(f"time to /health: {report.time_to_live_ms} ms")
+    print(f"time to /ready:  {report.time_to_ready_ms} ms")
+
+    out_path = Path(args.out)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(asdict(report), ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+    print(f"Wrote: {out_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,253 @@
+"""Ollama 通信の記録と再生（カセット）
+
+OllamaClient や evaluate_models.py が呼ぶ `ollama.chat` の位置に差し込むトランスポート。
+記録モードでは実際の Ollama にストリーミングで問い合わせ、チャンクごとの到着時刻と
+Ollama のタイミング項目をまとめて gzip 圧縮した JSONL に追記する。
+再生モードでは同じリクエストに対して記録した応答を決定的に返す（記録時の速度または待ち時間なし）。
+
+リクエストのキーはプロンプト全体なので、2ターン目以降は前の応答の後処理まで記録時と同じでないと
+再生できない。カセットを使うエージェントは後処理の乱数を seed（CLONEAI_CASSETTE_SEED）で固定する。
+
+    CLONEAI_CASSETTE=runs/eval.cassette.jsonl.gz
+    CLONEAI_CASSETTE_MODE=record | replay
+    CLONEAI_CASSETTE_SPEED=recorded | fast
+    CLONEAI_CASSETTE_SEED=0
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+TIMING_FIELDS = (
+    "total_duration",
+    "load_duration",
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+)
+
+
+class CassetteMiss(KeyError):
+    """再生モードで記録に無いリクエストが来た"""
+    def __init__(self, key: str, model: Optional[str] = None, request: Optional[int] = None, prompt: str = ""):
+        super().__init__(key)
+        self.key = key
+        self.model = model
+        self.request = request
+        self.prompt = prompt
+
+    def __str__(self) -> str:
+        where = f"model {self.model}" if self.model else "this model"
+        if self.request is not None:
+            where += f", request #{self.request}"
+        tail = " ".join(self.prompt.split())[-40:]
+        ending = f", prompt ending '…{tail}'" if tail else ""
+        return (
+            f"no recorded reply in the cassette for {where}{ending} (key {self.key[:12]}); "
+            "re-record it, or check that the prompt and CLONEAI_CASSETTE_SEED match the recording"
+        )
+
+
+def request_key(model: str, messages: Sequence[Dict[str, Any]], options: Optional[Dict[str, Any]] = None) -> str:
+    """リクエスト内容から決定的なキーを作る"""
+    canonical = json.dumps(
+        {"model": model, "messages": list(messages), "options": options or {}},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class RecordedMessage:
+    content: str
+    role: str = "assistant"
+
+
+@dataclass
+class RecordedResponse:
+    """ollama.ChatResponse と同じ属性でアクセスできる再生用の応答"""
+    model: str
+    message: RecordedMessage
+    done: bool = True
+    total_duration: Optional[int] = None
+    load_duration: Optional[int] = None
+    prompt_eval_count: Optional[int] = None
+    prompt_eval_duration: Optional[int] = None
+    eval_count: Optional[int] = None
+    eval_duration: Optional[int] = None
+
+
+@dataclass
+class Interaction:
+    key: str
+    model: str
+    # [到着時刻(ms, リクエスト開始からの経過), テキスト断片]
+    chunks: List[List[Any]] = field(default_factory=list)
+    timings: Dict[str, Optional[int]] = field(default_factory=dict)
+
+    @property
+    def content(self) -> str:
+        return "".join(chunk[1] for chunk in self.chunks)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {"key": self.key, "model": self.model, "chunks": self.chunks, "timings": self.timings},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+
+
+class Cassette:
+    """記録済みのやり取りを保持するファイル（同じキーが複数あれば記録順に巡回して返す）"""
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._entries: Dict[str, List[Interaction]] = {}
+        self._cursor: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        data = json.loads(line)
+                        self._entries.setdefault(data["key"], []).append(Interaction(**data))
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._entries.values())
+
+    def append(self, interaction: Interaction) -> None:
+        with self._lock:
+            self._entries.setdefault(interaction.key, []).append(interaction)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # gzip はメンバーを連結しても読めるので追記で壊れない
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write(interaction.to_json() + "\n")
+
+    def next(self, key: str) -> Interaction:
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise CassetteMiss(key)
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            return entries[index % len(entries)]
+
+
+class CassetteTransport:
+    """`ollama.chat` と同じ呼び出し方で記録・再生するトランスポート"""
+    def __init__(
+        self,
+        cassette: Cassette,
+        mode: str = "replay",
+        speed: str = "fast",
+        inner: Optional[Callable[..., Any]] = None,
+        seed: int = 0,
+    ):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown cassette mode: {mode}")
+        if speed not in ("recorded", "fast"):
+            raise ValueError(f"unknown replay speed: {speed}")
+        self.cassette = cassette
+        self.mode = mode
+        self.speed = speed
+        self._inner = inner
+        # エージェントの後処理の乱数の seed（記録と再生で同じプロンプトになるように）
+        self.seed = seed
+        self._requests = 0
+        self._count_lock = threading.Lock()
+
+    def chat(
+        self,
+        model: str,
+        messages: Sequence[Dict[str, Any]],
+        options: Optional[Dict[str, Any]] = None,
+        stream: bool = False,
+        **kwargs: Any,
+    ) -> Any:
+        key = request_key(model, messages, options)
+        with self._count_lock:
+            self._requests += 1
+            request = self._requests
+        if self.mode == "record":
+            interaction = self._record(key, model, messages, options, **kwargs)
+        else:
+            try:
+                interaction = self.cassette.next(key)
+            except CassetteMiss:
+                prompt = str((list(messages) or [{}])[-1].get("content") or "")
+                raise CassetteMiss(key, model=model, request=request, prompt=prompt) from None
+        if stream:
+            return self._replay_stream(interaction)
+        self._wait_until(time.perf_counter(), interaction.chunks[-1][0] if interaction.chunks else 0)
+        return _response(interaction, interaction.content)
+
+    def _record(
+        self,
+        key: str,
+        model: str,
+        messages: Sequence[Dict[str, Any]],
+        options: Optional[Dict[str, Any]],
+        **kwargs: Any,
+    ) -> Interaction:
+        inner = self._inner
+        if inner is None:
+            import ollama  # type: ignore
+
+            inner = ollama.chat
+        interaction = Interaction(key=key, model=model)
+        started = time.perf_counter()
+        for chunk in inner(model=model, messages=list(messages), options=options, stream=True, **kwargs):
+            content = chunk.message.content if getattr(chunk, "message", None) else ""
+            if content:
+                interaction.chunks.append([round((time.perf_counter() - started) * 1000, 1), content])
+            if getattr(chunk, "done", False):
+                interaction.timings = {name: getattr(chunk, name, None) for name in TIMING_FIELDS}
+        self.cassette.append(interaction)
+        return interaction
+
+    def _replay_stream(self, interaction: Interaction) -> Iterator[RecordedResponse]:
+        started = time.perf_counter()
+        for offset_ms, content in interaction.chunks:
+            self._wait_until(started, offset_ms)
+            yield RecordedResponse(model=interaction.model, message=RecordedMessage(content), done=False)
+        yield _response(interaction, "")
+
+    def _wait_until(self, started: float, offset_ms: float) -> None:
+        if self.speed == "recorded":
+            delay = started + offset_ms / 1000.0 - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def _response(interaction: Interaction, content: str) -> RecordedResponse:
+    return RecordedResponse(model=interaction.model, message=RecordedMessage(content), **interaction.timings)
+
+
+_shared: Dict[Tuple[str, str, str, int], CassetteTransport] = {}
+_shared_lock = threading.Lock()
+
+
+def transport_from_env() -> Optional[CassetteTransport]:
+    """CLONEAI_CASSETTE が設定されていればトランスポートを返す（同じ設定ならプロセス内で共有する）"""
+    path = os.getenv("CLONEAI_CASSETTE")
+    if not path:
+        return None
+    mode = os.getenv("CLONEAI_CASSETTE_MODE", "replay")
+    speed = os.getenv("CLONEAI_CASSETTE_SPEED", "fast")
+    seed = int(os.getenv("CLONEAI_CASSETTE_SEED", "0"))
+    with _shared_lock:
+        transport = _shared.get((path, mode, speed, seed))
+        if transport is None:
+            transport = CassetteTransport(Cassette(Path(path)), mode=mode, speed=speed, seed=seed)
+            _shared[(path, mode, speed, seed)] = transport
+    return transport
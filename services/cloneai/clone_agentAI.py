@@ -1,13 +1,38 @@
-import requests
+import asyncio
+import functools
+import os
 import time
 import json
 import random
-from typing import Dict, List, Any, Optional, Tuple, Union
-# pip install ollama
-try:
-    import ollama  # type: ignore
-except Exception:  # pragma: no cover
-    ollama = None
+import threading
+import urllib.request
+from typing import AsyncIterator, Callable, Dict, List, Any, Optional, Tuple, Union
+
+from concurrency import INTERACTIVE, LimiterTimeout
+from context_window import DEFAULT_REPLY_TOKENS, estimate_tokens, record_trimmed
+from deadline import RESERVE_S, THROUGHPUT, Deadline, cap_options
+# requests と ollama (pip install ollama) は読み込みに時間がかかるので、サーバーの起動を速くするため
+# 実際に Ollama を呼ぶときまで読み込まない（load_ollama）
+
+_ollama_module: Any = None
+
+# options に num_ctx が無いときに Ollama が使う値
+OLLAMA_DEFAULT_NUM_CTX = 2048
+
+# AIPersonaAgent の persona_prompt_mode に渡せる値
+PERSONA_PROMPT_MODES = ("full", "selective")
+
+
+def load_ollama() -> Any:
+    """ollama パッケージを初回に読み込む（見つからなければ None）"""
+    global _ollama_module
+    if _ollama_module is None:
+        try:
+            import ollama  # type: ignore
+            _ollama_module = ollama
+        except Exception:  # pragma: no cover
+            _ollama_module = False
+    return _ollama_module or None
 
 class ThoughtFlow:
     """思考フローを記録するクラス"""
@@ -47,6 +72,31 @@ class LLMClient:
     def generate(self, prompt: str) -> str:
         """プロンプトに基づいてテキストを生成する"""
         raise NotImplementedError("Subclasses must implement this method")
+    
+    async def agenerate(self, prompt: str) -> str:
+        """非同期にテキストを生成する（既定では generate をワーカースレッドで実行）"""
+        return await asyncio.to_thread(self.generate, prompt)
+    
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        """生成されたテキストを断片ごとに返す（既定では全体を1回で返す）"""
+        yield await self.agenerate(prompt)
+
+
+def _default_transport() -> Any:
+    """CLONEAI_CASSETTE が設定されていればカセットのトランスポートを返す"""
+    if not os.getenv("CLONEAI_CASSETTE"):
+        return None
+    from cassette import transport_from_env
+    return transport_from_env()
+
+
+def cassette_replay_enabled() -> bool:
+    """カセット再生モードなら Ollama が無くても実バックエンドとして動かせる"""
+    return bool(os.getenv("CLONEAI_CASSETTE")) and os.getenv("CLONEAI_CASSETTE_MODE", "replay") == "replay"
+
+
+class GenerationCancelled(Exception):
+    """呼び出し元がいなくなったので生成を途中でやめた"""
 
 
 class OllamaClient(LLMClient):
@@ -55,6 +105,27 @@ class OllamaClient(LLMClient):
         self.model_name = model_name
         self.base_url = base_url
         self.simulation_mode = False  # シミュレーションモードのフラグ
+        self._simulator = None
+        # ollama.chat と同じ呼び出し方のトランスポート（CLONEAI_CASSETTE で記録・再生に差し替える）
+        self.transport = _default_transport()
+        # Ollama の options（temperature など）。Noneならモデルの既定値
+        self.options: Optional[Dict[str, Any]] = None
+        # 複数の Ollama に振り分けるとき（backend_pool.BackendPool）。session_key で同じエンドポイントに固定する
+        self.pool: Any = None
+        self.session_key: Optional[str] = None
+        # concurrency.AdaptiveLimiter（プロセスで共有する同時生成数の上限）。Noneなら制限しない
+        self.limiter: Any = None
+        # limiter の優先度クラス（interactive / background / batch）
+        self.priority = INTERACTIVE
+        # 直前の agenerate が締め切りのため劣化した応答を返したときの理由（"partial" / "fallback"）
+        self.last_degraded: Optional[str] = None
+        # context_window.ContextSizer（プロンプトの長さから num_ctx を選ぶ）。Noneなら options のまま
+        self.context_sizer: Any = None
+        # /api/generate で生成し、返ってきた context（ここまでの会話のトークン列）に続けて次のターンを送るか
+        self.use_context = False
+        # 直前のターンまでを表す Ollama の context と、それを作ったモデル（トークン列はモデルごとに違う）
+        self.context: Optional[List[int]] = None
+        self.context_model: Optional[str] = None
         
     def generate(self, prompt: str) -> str:
         """モデルを使用してテキストを生成する
@@ -70,6 +141,130 @@ class OllamaClient(LLMClient):
         else:
             return self._real_generate(prompt)
     
+    async def agenerate(
+        self,
+        prompt: str,
+        deadline: Optional[Deadline] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """モデルを使用して非同期にテキストを生成する
+        
+        シミュレーションモードではスレッドを占有せずに待機する。
+        on_token を指定すると受け取った断片ごとに呼ぶ（実際の生成ではワーカースレッドから呼ばれる）。
+        タスクがキャンセルされたら、次のチャンクを受け取った時点で Ollama へのストリームを閉じて生成を止める。
+        deadline を指定すると残り時間に収まるよう num_predict を絞り、間に合わなければ途中までの応答
+        （まだ何も無ければシミュレーションの応答）を返して last_degraded に理由を入れる。
+        limiter が設定されていれば実行枠が空くまで待つ（待つのも締め切りまで）。
+        """
+        self.last_degraded = None
+        if self.limiter is None:
+            return await self._agenerate(prompt, deadline, on_token)
+        timeout = None if deadline is None else deadline.remaining_s() - RESERVE_S
+        try:
+            async with self.limiter.acquire(timeout=timeout, priority=self.priority) as permit:
+                reply = await self._agenerate(prompt, deadline, on_token)
+                # バックエンドが最後まで生成した応答だけをレイテンシのサンプルにする
+                if self.simulation_mode or self.last_degraded or reply.startswith("エラー:"):
+                    permit.sample = False
+                else:
+                    permit.units = len(reply)
+                return reply
+        except LimiterTimeout:
+            return self._degraded_reply(prompt, [])
+    
+    async def _agenerate(
+        self, prompt: str, deadline: Optional[Deadline], on_token: Optional[Callable[[str], None]] = None
+    ) -> str:
+        parts: List[str] = []
+        cancel: Optional[threading.Event] = None
+        if self.simulation_mode:
+            print(f"モデル {self.model_name} に問い合わせ中（シミュレーションモード）...")
+            work = self._simulate_into(prompt, parts, on_token)
+        else:
+            options = self._sized_options(prompt)
+            if deadline is not None:
+                options, cap = cap_options(options, self.model_name, deadline)
+                if cap == 0:
+                    return self._degraded_reply(prompt, parts)
+            cancel = threading.Event()
+            work = asyncio.to_thread(self._real_generate, prompt, cancel, parts, options, on_token)
+        try:
+            if deadline is None:
+                return await work
+            return await asyncio.wait_for(work, timeout=max(0.0, deadline.remaining_s() - RESERVE_S))
+        except asyncio.TimeoutError:
+            if cancel is not None:
+                cancel.set()
+            return self._degraded_reply(prompt, parts)
+        except asyncio.CancelledError:
+            if cancel is not None:
+                cancel.set()
+            raise
+    
+    async def _simulate_into(
+        self, prompt: str, parts: List[str], on_token: Optional[Callable[[str], None]] = None
+    ) -> str:
+        async for token in self.simulator.astream(prompt):
+            parts.append(token)
+            if on_token is not None:
+                on_token(token)
+        return "".join(parts)
+    
+    def _sized_options(self, prompt: str) -> Optional[Dict[str, Any]]:
+        """context_sizer があれば、このプロンプトに合わせた num_ctx を入れた options を返す"""
+        if self.context_sizer is None:
+            return self.options
+        context_tokens = len(self.context) if self.has_context() else 0
+        return self.context_sizer.apply(self.model_name, prompt, self.options, context_tokens)
+    
+    def _generate_supported(self) -> bool:
+        return self.use_context and (self.transport is None or hasattr(self.transport, "generate"))
+    
+    def has_context(self) -> bool:
+        """次のターンを前のターンの context に続けて送れるか"""
+        return (
+            self._generate_supported()
+            and not self.simulation_mode
+            and bool(self.context)
+            and self.context_model == self.model_name
+        )
+    
+    def context_fits(self, prompt_tokens: int) -> bool:
+        """context に prompt_tokens を足しても num_ctx の上限に収まるか"""
+        if self.context_sizer is not None:
+            budget = self.context_sizer.prompt_budget(self.options)
+        else:
+            budget = ((self.options or {}).get("num_ctx") or OLLAMA_DEFAULT_NUM_CTX) - DEFAULT_REPLY_TOKENS
+        return len(self.context or []) + prompt_tokens <= budget
+    
+    def _degraded_reply(self, prompt: str, parts: List[str]) -> str:
+        """締め切りに間に合わなかったときの応答（途中まで受け取った分、無ければシミュレーション）"""
+        text = "".join(parts).strip()
+        if text:
+            self.last_degraded = "partial"
+            # 文の途中で切れていれば、半分以上残るなら最後の文末までにする
+            end = max(text.rfind(mark) for mark in ("。", "！", "？", "!", "?"))
+            return text[:end + 1] if end + 1 >= len(text) // 2 else text + "…"
+        self.last_degraded = "fallback"
+        from simulation import compose_reply
+        return compose_reply(prompt)
+    
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        if self.simulation_mode:
+            async for token in self.simulator.astream(prompt):
+                yield token
+        else:
+            yield await self.agenerate(prompt)
+    
+    @property
+    def simulator(self) -> LLMClient:
+        """シミュレーション用バックエンド（simulation.SimulatedLLMClient）"""
+        if self._simulator is None:
+            from simulation import SimulatedLLMClient
+            self._simulator = SimulatedLLMClient(self.model_name)
+        self._simulator.model_name = self.model_name
+        return self._simulator
+    
     def _simulate_generation(self, prompt: str) -> str:
         """実際のモデル呼び出しをシミュレーション
         
@@ -80,54 +275,74 @@ class OllamaClient(LLMClient):
             シミュレートされた応答
         """
         print(f"モデル {self.model_name} に問い合わせ中（シミュレーションモード）...")
-        
-        # プロンプトに基づいた応答をシミュレート
-        responses = {
-            "自己紹介": "こんにちは！山田太郎です。30代のバックエンドエンジニアとして働いています。まあ、そうだね...Pythonが大好きで、最近はRustにも興味を持っているんだ。技術の世界は日々進化していて面白いよね。趣味は登山とゲームで、休日にはよく山に出かけるんだ。技術書を読むのも好きで、常に新しい知識を吸収しようとしているよ。何か手伝えることがあれば、気軽に聞いてね！",
-            "プログラミング": "まあ、そうだね...最近はWebAssemblyとRustの組み合わせに興味があるんだ。特にエッジコンピューティングでの活用が面白いと思っているよ。あとは、Pythonの非同期処理とFastAPIを使ったマイクロサービス開発にハマってて、パフォーマンスと拡張性のバランスが絶妙なんだよね。機械学習フレームワークの軽量化にも注目しているかな。TensorFlow LiteやPyTorchのモバイル対応は進化が速くて追いかけるのが大変だけど、端末上での推論は今後もっと重要になると思うんだ。君は何か興味ある技術はある？",
-            "週末": "この週末の予定か、まあ、そうだね...土曜日は朝から奥多摩の山に登りに行く予定だよ。天気が良ければ景色が最高なんだ。日曜日は新しく買ったRustの本を読みながら、小さなプロジェクトを始めようと思っている。あとはスタートアップの仲間とオンライミーティングで次のスプリントの計画を立てる約束もしているかな。プログラマーらしく、リラックスしながらもコードを書く時間は確保するつもりさ。君の週末の予定はどうなの？",
-            "Rust": "まあ、そうだね...Rustと他の言語を比較すると、メモリ安全性と並行処理の扱いやすさが際立つよね。特にC++と比べると、所有権システムが明示的でありながらGCがないのがRustの素晴らしいところだと思う。Pythonと比較すると実行速度は桁違いに速いけど、開発スピードではPythonのほうが上だね。Goと比べるとエラー処理の考え方が違って、Rustはより厳格なアプローチを取っている。まあ、言語ごとに適材適所があるから、プロジェクトの要件によって使い分けるのが賢明だと思うよ。僕の場合、パフォーマンスクリティカルな部分はRust、高速に開発したい部分はPythonという組み合わせが好きかな。"
-        }
-        
-        # プロンプトのキーワードに基づいて応答を選択
-        if "自己紹介" in prompt:
-            response = responses["自己紹介"]
-        elif any(word in prompt.lower() for word in ["プログラミング", "技術", "興味", "言語"]):
-            response = responses["プログラミング"]
-        elif any(word in prompt.lower() for word in ["週末", "予定", "休み"]):
-            response = responses["週末"]
-        elif "Rust" in prompt:
-            response = responses["Rust"]
-        else:
-            response = "まあ、そうだね...それは興味深い話題だね。技術者としての視点から考えると、いくつかの側面があるように思うよ。もう少し具体的に話してみない？"
-        
-        # 応答生成に時間がかかるのをシミュレート
-        time.sleep(0.5)
-        
-        return response
+        return self.simulator.generate(prompt)
     
-    def _real_generate(self, prompt: str) -> str:
+    def _real_generate(
+        self,
+        prompt: str,
+        cancel: Optional[threading.Event] = None,
+        parts: Optional[List[str]] = None,
+        options: Optional[Dict[str, Any]] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> str:
         """実際のOllama APIを呼び出す
         
         Args:
             prompt: 生成のためのプロンプト
+            cancel: 指定するとストリーミングで受け取り、セットされた時点でストリームを閉じる
+            parts: ストリーミングで受け取った断片を順に追加するリスト（締め切りで打ち切ったときに使う）
+            options: self.options の代わりに使う options（num_predict を絞ったものなど）
+            on_token: ストリーミングで断片を受け取るたびに呼ぶ関数
             
         Returns:
             モデルからの応答
         
         Raises:
-            Exception: API呼び出しに失敗した場合
+            GenerationCancelled: cancel がセットされた場合
         """
+        import requests
+        
         try:
-            if ollama is None:
+            ollama = load_ollama() if self.transport is None else None
+            if self.transport is None and ollama is None:
                 return "エラー: ollama パッケージが見つかりません。仮想環境を有効化して 'pip install ollama' を実行してください"
             print(f"モデル {self.model_name} に問い合わせ中...")
-            response = ollama.chat(
+            if options is None:
+                options = self._sized_options(prompt)
+            if self._generate_supported():
+                # prompt は context の続き（エージェントが has_context() を見て組み立てる）
+                method = "generate"
+                request = {"prompt": prompt, "context": self.context if self.has_context() else None}
+                # 成功したら最後のチャンクの context に置き換える。途中で終わったら次は組み立て直す
+                self.context = None
+            else:
+                method = "chat"
+                request = {"messages": [{"role": "user", "content": prompt}]}
+            if self.transport is not None:
+                call = getattr(self.transport, method)
+            elif self.pool is not None:
+                call = functools.partial(getattr(self.pool, method), self.session_key)
+            else:
+                call = getattr(ollama, method)
+            response = call(
                 model=self.model_name,
-                messages=[{"role": "user", "content": prompt}],
+                options=options,
+                stream=cancel is not None,
+                **request,
             )
+            if cancel is not None:
+                summary, response = self._collect_stream(
+                    response, cancel, parts if parts is not None else [], on_token
+                )
+                THROUGHPUT.observe(self.model_name, response)
+                self._log_timings(prompt, response)
+                self._remember_context(response)
+                return summary or "応答がありません。"
             # response.raise_for_status()
-            summary = response.message.content if response.message else "応答がありません。"
+            THROUGHPUT.observe(self.model_name, response)
+            self._log_timings(prompt, response)
+            self._remember_context(response)
+            summary = self._chunk_text(response) or "応答がありません。"
             return summary
             # response = requests.post(
             #     f"{self.base_url}/generate",
@@ -140,6 +355,8 @@ class OllamaClient(LLMClient):
             # )
             # response.raise_for_status()
             # return response.json().get("response", "応答がありませんでした")
+        except GenerationCancelled:
+            raise
         except requests.exceptions.Timeout:
             return "エラー: APIリクエストがタイムアウトしました"
         except requests.exceptions.ConnectionError:
@@ -149,6 +366,65 @@ class OllamaClient(LLMClient):
         except Exception as e:
             return f"エラー: {str(e)}"
     
+    @staticmethod
+    def _collect_stream(
+        chunks: Any,
+        cancel: threading.Event,
+        parts: List[str],
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> Tuple[str, Any]:
+        """ストリームのチャンクを parts に追加してつなげる。最後のチャンク（タイミング項目を持つ）も返す
+        
+        キャンセルされたらジェネレーターを閉じる。HTTP 接続が切れると Ollama は生成を止める。
+        """
+        last = None
+        try:
+            for chunk in chunks:
+                if cancel.is_set():
+                    raise GenerationCancelled()
+                text = OllamaClient._chunk_text(chunk)
+                if text:
+                    parts.append(text)
+                    if on_token is not None:
+                        on_token(text)
+                last = chunk
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+        if cancel.is_set():
+            raise GenerationCancelled()
+        return "".join(parts), last
+    
+    @staticmethod
+    def _chunk_text(chunk: Any) -> Optional[str]:
+        """chat のチャンクは message.content、generate のチャンクは response に本文が入る"""
+        message = getattr(chunk, "message", None)
+        if message is not None:
+            return message.content
+        return getattr(chunk, "response", None)
+    
+    def _remember_context(self, response: Any) -> None:
+        context = getattr(response, "context", None) if self._generate_supported() else None
+        if context:
+            self.context = list(context)
+            self.context_model = self.model_name
+    
+    def _log_timings(self, prompt: str, response: Any) -> None:
+        """CLONEAI_TIMING_LOG が設定されていれば Ollama のタイミングを JSONL に追記する
+        
+        simulation.py でシミュレーションのレイテンシ分布を当てはめるのに使う。
+        """
+        log_path = os.getenv("CLONEAI_TIMING_LOG")
+        if not log_path:
+            return
+        record = {"model": self.model_name, "prompt_chars": len(prompt)}
+        for field in ("load_duration", "prompt_eval_count", "prompt_eval_duration",
+                      "eval_count", "eval_duration", "total_duration"):
+            record[field] = getattr(response, field, None)
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    
     def set_simulation_mode(self, enabled: bool = True) -> None:
         """シミュレーションモードを切り替える
         
@@ -178,13 +454,44 @@ class PersonaTemplate:
         self.knowledge_areas = knowledge_areas or []
         self.values = values or []
         
-    def to_prompt(self) -> str:
-        """ペルソナをプロンプトに変換"""
+    def trait_entries(self) -> List[str]:
+        """特徴・経歴・性格・知識分野・価値観を1行ずつのエントリに分解する
+        
+        Returns:
+            検索対象となるエントリのリスト
+        """
+        entries = []
+        for block in (self.background, self.personality):
+            if block:
+                entries.extend(line.strip() for line in block.splitlines() if line.strip())
+        entries.extend(f"{trait}: {value}" for trait, value in self.traits.items())
+        entries.extend(f"知識分野: {area}" for area in self.knowledge_areas)
+        entries.extend(f"価値観・信条: {value}" for value in self.values)
+        return entries
+        
+    def to_prompt(self, selected_entries: Optional[List[str]] = None) -> str:
+        """ペルソナをプロンプトに変換
+        
+        Args:
+            selected_entries: 指定した場合は基本情報と話し方に加えてこのエントリだけを含める
+                （Noneの場合は全ての特徴を含める）
+        """
         prompt = [
             f"# ペルソナ設定: {self.name}",
             f"## 基本情報\n{self.description}\n"
         ]
         
+        if selected_entries is not None:
+            if self.speech_style:
+                prompt.append(f"## 話し方の特徴\n{self.speech_style}\n")
+            if selected_entries:
+                prompt.append("## この話題に関連する特徴")
+                for entry in selected_entries:
+                    prompt.append(f"- {entry}")
+                prompt.append("")
+            prompt.extend(self._instructions())
+            return "\n".join(prompt)
+        
         if self.background:
             prompt.append(f"## 経歴\n{self.background}\n")
             
@@ -212,21 +519,40 @@ class PersonaTemplate:
                 prompt.append(f"- {value}")
             prompt.append("")
             
-        prompt.append("## 指示")
-        prompt.append("あなたは上記の人物になりきって応答してください。")
-        prompt.append("一人称は「俺」を使い、上記の性格や話し方、知識に基づいて応答してください。")
-        prompt.append("応答は簡潔すぎず、かといって冗長になりすぎないよう心がけてください。")
-        prompt.append("ユーザーとの対話ではできるだけ自然な会話の流れを維持してください。")
+        prompt.extend(self._instructions())
         
         return "\n".join(prompt)
+    
+    def _instructions(self) -> List[str]:
+        return [
+            "## 指示",
+            "あなたは上記の人物になりきって応答してください。",
+            "一人称は「俺」を使い、上記の性格や話し方、知識に基づいて応答してください。",
+            "応答は簡潔すぎず、かといって冗長になりすぎないよう心がけてください。",
+            "ユーザーとの対話ではできるだけ自然な会話の流れを維持してください。",
+        ]
 
 
 class MemoryManager:
     """会話の履歴や重要な情報を管理するクラス"""
-    def __init__(self, max_history: int = 10):
+    def __init__(self,
+                 max_history: int = 10,
+                 episodic: Optional[Any] = None,
+                 facts: Optional[Any] = None,
+                 fact_extractor: Optional[Any] = None):
         self.conversation_history: List[Dict[str, str]] = []
         self.key_facts: Dict[str, Any] = {}
         self.max_history = max_history
+        # memory_store.EpisodicMemory（全ターンの長期記憶）。Noneなら直近の履歴のみ
+        self.episodic = episodic
+        # memory_store.FactStore と RuleFactExtractor（ユーザーについての事実）
+        self.facts = facts
+        self.fact_extractor = fact_extractor
+        self._fact_jobs: List[Any] = []
+        # clear() と restore_state() のたびに増やす。それより前に投入した事実抽出の結果は捨てる
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+        self.turn_count = 0
         
     def add_interaction(self, user_input: str, agent_response: str) -> None:
         """対話を履歴に追加する
@@ -235,24 +561,148 @@ class MemoryManager:
             user_input: ユーザーの入力
             agent_response: エージェントの応答
         """
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.turn_count += 1
         self.conversation_history.append({
             "user": user_input,
             "agent": agent_response,
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+            "timestamp": timestamp
         })
         
+        # 長期記憶への索引化と事実の抽出はバックグラウンドで行う
+        if self.episodic is not None:
+            self.episodic.add_turn(self.turn_count, user_input, agent_response, timestamp)
+        if self.fact_extractor is not None:
+            from memory_store import background_executor
+            self._fact_jobs = [job for job in self._fact_jobs if not job.done()]
+            self._fact_jobs.append(
+                background_executor().submit(self._extract_facts, user_input, self.turn_count, self._generation)
+            )
+        
         # 履歴の長さを制限
         if len(self.conversation_history) > self.max_history:
             self.conversation_history = self.conversation_history[-self.max_history:]
             
-    def add_fact(self, key: str, value: Any) -> None:
+    def _extract_facts(self, user_input: str, turn: int, generation: int) -> None:
+        extracted = self.fact_extractor.extract(user_input)
+        with self._generation_lock:
+            # 投入したあとに会話がリセット・復元されていれば、前の会話の事実なので書き込まない
+            if generation != self._generation:
+                return
+            for key, value in extracted:
+                self.add_fact(key, value, turn=turn)
+            
+    def add_fact(self, key: str, value: Any, turn: Optional[int] = None) -> None:
         """重要な事実を記録する
         
         Args:
             key: 事実の識別子
             value: 事実の内容
+            turn: 事実が述べられたターン（Noneの場合は現在のターン）
         """
         self.key_facts[key] = value
+        if self.facts is not None:
+            self.facts.add(key, str(value), turn=self.turn_count if turn is None else turn)
+            
+    def get_relevant_facts(self, query: str, limit: int = 5) -> List[Any]:
+        """現在の入力に関係する事実だけを取得する
+        
+        Args:
+            query: 現在のユーザー入力
+            limit: 取得する最大件数
+            
+        Returns:
+            memory_store.Fact のリスト（事実テーブルが無効なら空）
+        """
+        if self.facts is None:
+            return []
+        return self.facts.match(query, limit=limit)
+        
+    def get_relevant_episodes(self, query: str, k: int = 3) -> List[Any]:
+        """直近の履歴ウィンドウより古いターンから、入力に関連するものを取得する
+        
+        Args:
+            query: 現在のユーザー入力
+            k: 取得する件数
+            
+        Returns:
+            memory_store.Episode のリスト（長期記憶が無効なら空）
+        """
+        if self.episodic is None:
+            return []
+        oldest_recent_turn = self.turn_count - len(self.conversation_history) + 1
+        return self.episodic.search(query, k=k, before_turn=oldest_recent_turn)
+        
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """バックグラウンドの索引化・事実抽出の完了を待つ"""
+        if self._fact_jobs:
+            from concurrent.futures import wait
+            wait(list(self._fact_jobs), timeout=timeout)
+        if self.episodic is not None:
+            self.episodic.flush(timeout=timeout)
+        
+    def to_state(self, timeout: Optional[float] = 1.0, episodes_after: int = 0) -> Dict[str, Any]:
+        """セッションストアに保存するための状態を返す
+        
+        バックグラウンドの事実抽出が残っていれば timeout 秒まで完了を待つ。
+        
+        Args:
+            timeout: 事実抽出を待つ秒数
+            episodes_after: 長期記憶のターンはこの番号より後のものだけを入れる（保存済みの分を省く）
+        
+        Returns:
+            JSONに変換できる短いキーの辞書
+        """
+        if self._fact_jobs:
+            from concurrent.futures import wait
+            wait(list(self._fact_jobs), timeout=timeout)
+        state: Dict[str, Any] = {
+            "t": self.turn_count,
+            "h": [[e["user"], e["agent"], e["timestamp"]] for e in self.conversation_history],
+            "k": self.key_facts,
+        }
+        if self.facts is not None:
+            state["f"] = [[f.category, f.value, f.turn] for f in self.facts.all()]
+        if self.episodic is not None:
+            state["e"] = [list(t) for t in self.episodic.turns(after=episodes_after)]
+        return state
+        
+    def restore_state(self, state: Dict[str, Any]) -> None:
+        """to_state で保存した状態に置き換える
+        
+        Args:
+            state: to_state の戻り値
+        """
+        self._invalidate_fact_jobs()
+        self.turn_count = state.get("t", 0)
+        self.conversation_history = [
+            {"user": user, "agent": agent, "timestamp": timestamp}
+            for user, agent, timestamp in state.get("h", [])
+        ]
+        self.key_facts = dict(state.get("k", {}))
+        if self.facts is not None:
+            self.facts.clear()
+            for category, value, turn in state.get("f", []):
+                self.facts.add(category, value, turn=turn)
+        if self.episodic is not None:
+            self.episodic.restore([tuple(t) for t in state.get("e", [])])
+        
+    def clear(self) -> None:
+        """履歴と長期記憶を初期化する"""
+        self._invalidate_fact_jobs()
+        self.conversation_history = []
+        self.key_facts = {}
+        self.turn_count = 0
+        if self.episodic is not None:
+            self.episodic.clear()
+        if self.facts is not None:
+            self.facts.clear()
+        
+    def _invalidate_fact_jobs(self) -> None:
+        """実行待ち・実行中の事実抽出の結果を捨てる（書き込み中のものは終わるのを待つ）"""
+        with self._generation_lock:
+            self._generation += 1
+        self._fact_jobs = []
         
     def get_history_as_text(self, num_entries: Optional[int] = None) -> str:
         """会話履歴をテキスト形式で取得する
@@ -284,12 +734,62 @@ class AIPersonaAgent:
     def __init__(self, 
                  persona: PersonaTemplate, 
                  model_name: str = "gemma3:1b",
-                 simulation_mode: bool = False):
+                 simulation_mode: bool = False,
+                 retriever: Optional[Any] = None,
+                 retrieval_k: int = 3,
+                 persona_prompt_mode: str = "full",
+                 trait_k: int = 8,
+                 trait_index: Optional[Any] = None,
+                 exemplar_index: Optional[Any] = None,
+                 exemplar_k: int = 3,
+                 episodic_memory: bool = False,
+                 episode_k: int = 3,
+                 fact_memory: bool = False,
+                 generation_options: Optional[Dict[str, Any]] = None,
+                 router: Optional[Any] = None):
         self.persona = persona
         self.client = OllamaClient(model_name)
+        self.client.options = generation_options
         self.client.set_simulation_mode(simulation_mode)
+        # 応答の後処理（口癖の挿入）の乱数。後処理した応答は履歴として次のプロンプトに入るので、
+        # カセットを使うときは記録と再生で同じプロンプトになるよう seed を固定する
+        self.rng = random.Random(getattr(self.client.transport, "seed", None))
         self.thought_flow = ThoughtFlow()
-        self.memory = MemoryManager()
+        episodic = None
+        if episodic_memory:
+            from memory_store import EpisodicMemory
+            episodic = EpisodicMemory()
+        facts = fact_extractor = None
+        if fact_memory:
+            from memory_store import FactStore, RuleFactExtractor
+            facts, fact_extractor = FactStore(), RuleFactExtractor()
+        self.memory = MemoryManager(episodic=episodic, facts=facts, fact_extractor=fact_extractor)
+        self.episode_k = episode_k
+        # retrieval.HybridRetriever（ライフログ知識の検索）。Noneなら検索しない
+        self.retriever = retriever
+        self.retrieval_k = retrieval_k
+        # "full": 全特徴をプロンプトに含める / "selective": 入力に関連する上位trait_k件だけ含める
+        # （既定は従来どおり "full"。clone_server は CLONEAI_PERSONA_PROMPT_MODE の既定で "selective" を渡す）
+        if persona_prompt_mode not in PERSONA_PROMPT_MODES:
+            raise ValueError(
+                f"persona_prompt_mode must be one of {', '.join(PERSONA_PROMPT_MODES)}: {persona_prompt_mode!r}"
+            )
+        self.persona_prompt_mode = persona_prompt_mode
+        self.trait_k = trait_k
+        self.trait_index = trait_index
+        if persona_prompt_mode == "selective" and trait_index is None:
+            from retrieval import PersonaTraitIndex
+            self.trait_index = PersonaTraitIndex(persona.trait_entries())
+        # exemplars.ExemplarIndex（本人の実際の返答例）。Noneなら few-shot 例を含めない
+        self.exemplar_index = exemplar_index
+        self.exemplar_k = exemplar_k
+        # 直前のターンで起きたエラー（バックエンドの失敗・例外）。正常ならNone
+        self.last_error: Optional[str] = None
+        # router.ModelRouter（入力に応じて高速モデルと大きいモデルを振り分ける）。Noneなら model_name 固定
+        self.router = router
+        self.last_route: Optional[Any] = None
+        # 直前のターンが締め切りのため劣化した応答だったときの理由（OllamaClient.last_degraded）
+        self.last_degraded: Optional[str] = None
         
     def _build_prompt(self, user_input: str) -> str:
         """プロンプトを構築する
@@ -310,30 +810,114 @@ class AIPersonaAgent:
             self.thought_flow.add_thought("挨拶が検出されました", "thinking")
             
         self.thought_flow.add_thought("思考ステップ2: 関連する背景知識を検索中...", "thinking")
-        # 実際のアプリケーションでは、ここでRAGや知識ベースからの検索を行うことも可能
+        knowledge_hits = []
+        if self.retriever is not None:
+            knowledge_hits = self.retriever.search(user_input, k=self.retrieval_k)
+            self.thought_flow.add_thought(f"関連する記憶を{len(knowledge_hits)}件取得しました", "thinking")
         
         self.thought_flow.add_thought("思考ステップ3: プロンプトを構築中...", "process")
         
         # ペルソナ情報を含むプロンプトを作成
-        prompt_parts = [self.persona.to_prompt()]
+        if self.persona_prompt_mode == "selective" and self.trait_index is not None:
+            selected = self.trait_index.select(user_input, k=self.trait_k)
+            self.thought_flow.add_thought(f"関連するペルソナ特徴を{len(selected)}件選択しました", "process")
+            prompt_parts = [self.persona.to_prompt(selected_entries=selected)]
+        else:
+            prompt_parts = [self.persona.to_prompt()]
         
-        # 会話履歴を追加
-        if self.memory.conversation_history:
-            self.thought_flow.add_thought(f"会話履歴を追加します（{len(self.memory.conversation_history)}件）", "process")
-            prompt_parts.append("## これまでの会話")
-            prompt_parts.append(self.memory.get_history_as_text())
+        # 本人の実際の返答例を few-shot として追加
+        if self.exemplar_index is not None:
+            exemplars = self.exemplar_index.search(user_input, k=self.exemplar_k)
+            if exemplars:
+                self.thought_flow.add_thought(f"本人の返答例を{len(exemplars)}件追加します", "process")
+                prompt_parts.append("## 本人の実際の会話例（口調の参考）")
+                prompt_parts.append("\n\n".join(
+                    f"相手: {ex.prompt}\n{self.persona.name}: {ex.reply}" for ex in exemplars
+                ))
+        
+        # 検索した記憶を追加
+        if knowledge_hits:
+            prompt_parts.append("## 関連する記憶")
+            prompt_parts.append("\n\n".join(hit.document.content for hit in knowledge_hits))
         
-        # 現在の入力を追加
-        prompt_parts.append("## 現在の入力")
-        prompt_parts.append(user_input)
+        # 入力に関係するユーザーについての事実を追加
+        facts = self.memory.get_relevant_facts(user_input)
+        if facts:
+            self.thought_flow.add_thought(f"関連する事実を{len(facts)}件追加します", "process")
+            prompt_parts.append("## ユーザーについて分かっていること")
+            prompt_parts.append("\n".join(f"- {fact.category}: {fact.value}" for fact in facts))
         
-        full_prompt = "\n\n".join(prompt_parts)
+        # 直近の履歴より古いターンから関連するものを追加
+        episodes = self.memory.get_relevant_episodes(user_input, k=self.episode_k)
+        if episodes:
+            self.thought_flow.add_thought(f"関連する過去の会話を{len(episodes)}件呼び戻します", "process")
+            prompt_parts.append("## 関連する過去の会話")
+            prompt_parts.append("\n\n".join(
+                f"ユーザー: {ep.user}\nエージェント: {ep.agent}" for ep in sorted(episodes, key=lambda ep: ep.turn)
+            ))
+        
+        # 会話履歴と現在の入力を追加
+        if self.memory.conversation_history:
+            self.thought_flow.add_thought(f"会話履歴を追加します（{len(self.memory.conversation_history)}件）", "process")
+        full_prompt = self._assemble_prompt(prompt_parts, user_input, len(self.memory.conversation_history))
+        if self.client.context_sizer is not None:
+            full_prompt = self._fit_context(prompt_parts, user_input, full_prompt)
+        if self.client.use_context:
+            full_prompt = self._continue_context(prompt_parts, user_input, full_prompt)
         
         self.thought_flow.add_thought("プロンプト構築完了", "process")
         self.thought_flow.add_thought(f"プロンプトの長さ: {len(full_prompt)}文字", "process")
         
         return full_prompt
     
+    def _assemble_prompt(self, prompt_parts: List[str], user_input: str, history_turns: int) -> str:
+        """直近 history_turns 件の会話履歴と現在の入力を後ろにつなげる"""
+        parts = list(prompt_parts)
+        if history_turns > 0:
+            parts.append("## これまでの会話")
+            parts.append(self.memory.get_history_as_text(history_turns))
+        parts.append("## 現在の入力")
+        parts.append(user_input)
+        return "\n\n".join(parts)
+    
+    def _fit_context(self, prompt_parts: List[str], user_input: str, full_prompt: str) -> str:
+        """num_ctx の上限に収まるまで古い会話履歴から省く（Ollama に先頭のペルソナを切り詰めさせない）"""
+        sizer = self.client.context_sizer
+        budget = sizer.prompt_budget(self.client.options)
+        total = kept = len(self.memory.conversation_history)
+        while kept > 0 and estimate_tokens(full_prompt) > budget:
+            kept -= 1
+            full_prompt = self._assemble_prompt(prompt_parts, user_input, kept)
+        if kept < total:
+            record_trimmed(total - kept)
+            warning = f"プロンプトが num_ctx の上限に収まらないため、古い会話履歴を{total - kept}件省きました"
+            print(f"警告: {warning}")
+            self.thought_flow.add_thought(warning, "process")
+        tokens = estimate_tokens(full_prompt)
+        if tokens > budget:
+            warning = f"会話履歴を省いてもプロンプト（推定{tokens}トークン）が num_ctx の上限に収まりません（{budget}トークンまで）"
+            print(f"警告: {warning}")
+            self.thought_flow.add_thought(warning, "process")
+        return full_prompt
+    
+    def _continue_context(self, prompt_parts: List[str], user_input: str, full_prompt: str) -> str:
+        """前のターンの Ollama の context に続けられるなら、ペルソナと会話履歴を除いた新しい部分だけを返す
+        
+        ペルソナと履歴は context に入っているので評価し直さずに済む。続けられないときは
+        context を捨てて組み立てたプロンプト全体を返す（ルーターでモデルが変わる場合も続けない）。
+        """
+        client = self.client
+        if self.router is None and client.has_context():
+            delta = "\n\n".join(prompt_parts[1:] + ["## 現在の入力", user_input])
+            if client.context_fits(estimate_tokens(delta)):
+                self.thought_flow.add_thought(
+                    f"前のターンまでの context（{len(client.context)}トークン）に続けて、新しい部分だけを送ります", "process"
+                )
+                return delta
+            self.thought_flow.add_thought("context が num_ctx の上限に近いため、プロンプト全体を送り直します", "process")
+        client.context = None
+        return full_prompt
+    
     def _analyze_response(self, response: str, user_input: str) -> str:
         """応答を分析して適切に処理する
         
@@ -348,6 +932,7 @@ class AIPersonaAgent:
         
         # エラーメッセージかどうかを確認
         if response.startswith("エラー:"):
+            self.last_error = response
             self.thought_flow.add_thought(f"エラーが発生しました: {response}", "error")
             return f"すみません、技術的な問題が発生しました。{response}"
         
@@ -357,7 +942,7 @@ class AIPersonaAgent:
             response = f"まあ、そうだね... {response} もう少し詳しく説明すると、この質問は興味深いポイントを含んでいるよ。"
             
         # ペルソナの口癖を追加する可能性
-        if random.random() < 0.3 and "まあ、そうだね" not in response:
+        if self.rng.random() < 0.3 and "まあ、そうだね" not in response:
             self.thought_flow.add_thought("ペルソナの口癖を追加します", "thinking")
             sentences = response.split('。')
             insert_index = min(1, len(sentences) - 1)
@@ -377,29 +962,118 @@ class AIPersonaAgent:
             エージェントの応答
         """
         try:
-            self.thought_flow.add_thought("入力処理を開始", "process")
-            
-            # プロンプトを構築
-            prompt = self._build_prompt(user_input)
-            
-            # モデルに問い合わせ
-            self.thought_flow.add_thought("モデルに問い合わせ中...", "api")
-            response = self.client.generate(prompt)
-            self.thought_flow.add_thought(f"モデルから応答を受信: '{response[:100]}...'", "api")
-            
-            # 応答を分析
-            final_response = self._analyze_response(response, user_input)
+            prompt = self._begin_turn(user_input)
+            if self.router is None:
+                response = self.client.generate(prompt)
+            else:
+                with self.router.track(self._route(user_input)):
+                    response = self.client.generate(prompt)
+            return self._finish_turn(user_input, response)
             
-            # 会話履歴を更新
-            self.memory.add_interaction(user_input, final_response)
+        except Exception as e:
+            return self._handle_error(e)
+    
+    async def aprocess_input(
+        self,
+        user_input: str,
+        deadline: Optional[Deadline] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """process_input の非同期版（サーバー用）
+        
+        タスクがキャンセルされると生成も止め、途中までの応答は会話履歴に残さない
+        （asyncio.CancelledError はそのまま呼び出し元に伝わる）。
+        
+        Args:
+            user_input: ユーザーからの入力
+            deadline: このターンの締め切り。間に合わなければ劣化した応答を返し last_degraded に理由を入れる
+            on_token: 生成された断片ごとに呼ぶ関数（後処理前の生の出力）
             
-            self.thought_flow.add_thought("処理完了、応答を返します", "process")
-            return final_response
+        Returns:
+            エージェントの応答
+        """
+        try:
+            # 検索・特徴の選択・長期記憶の検索（埋め込みの HTTP 呼び出しを含むことがある）で
+            # イベントループを止めないよう、プロンプトはワーカースレッドで組み立てる
+            prompt = await asyncio.to_thread(self._begin_turn, user_input)
+            if self.router is None:
+                response = await self.client.agenerate(prompt, deadline=deadline, on_token=on_token)
+            else:
+                with self.router.track(self._route(user_input, deadline)):
+                    response = await self.client.agenerate(prompt, deadline=deadline, on_token=on_token)
+            self.last_degraded = self.client.last_degraded
+            if self.last_degraded:
+                self.thought_flow.add_thought(f"締め切りに間に合わないため劣化した応答を返します（{self.last_degraded}）", "api")
+            return self._finish_turn(user_input, response)
             
+        except asyncio.CancelledError:
+            self.thought_flow.add_thought("呼び出し元が切断したため生成を中止しました", "process")
+            raise
         except Exception as e:
-            error_msg = f"予期せぬエラーが発生しました: {str(e)}"
-            self.thought_flow.add_thought(error_msg, "error")
-            return f"すみません、処理中に問題が発生しました: {str(e)}"
+            return self._handle_error(e)
+    
+    def accept_prefetched(self, user_input: str, turn: Any) -> str:
+        """事前に生成しておいた応答（prefetch.PrefetchedTurn）をこのターンの応答として記録する
+
+        Args:
+            user_input: ユーザーからの入力（台本のターン）
+            turn: 同じ入力で生成した応答と、そのときの Ollama の context
+
+        Returns:
+            エージェントの応答
+        """
+        self.last_error = None
+        self.last_degraded = None
+        self.thought_flow.add_thought("台本どおりの入力なので、事前に生成しておいた応答を使います", "process")
+        self.memory.add_interaction(user_input, turn.reply)
+        # 次のターンは事前生成のときの context に続けられる（モデルが違えば has_context が使わない）
+        self.client.context = turn.context
+        self.client.context_model = turn.context_model
+        return turn.reply
+
+    def _route(self, user_input: str, deadline: Optional[Deadline] = None) -> Any:
+        """ルーターでこのターンのモデルを選び、クライアントに設定する"""
+        decision = self.router.route(user_input, deadline)
+        self.last_route = decision
+        self.client.model_name = decision.model
+        self.thought_flow.add_thought(
+            f"モデル {decision.model} を選択しました（{decision.route}: {decision.reason}）", "api"
+        )
+        return decision
+    
+    def _begin_turn(self, user_input: str) -> str:
+        self.last_error = None
+        self.last_degraded = None
+        self.thought_flow.add_thought("入力処理を開始", "process")
+        
+        # プロンプトを構築
+        prompt = self._build_prompt(user_input)
+        
+        # モデルに問い合わせ
+        self.thought_flow.add_thought("モデルに問い合わせ中...", "api")
+        return prompt
+    
+    def _finish_turn(self, user_input: str, response: str) -> str:
+        self.thought_flow.add_thought(f"モデルから応答を受信: '{response[:100]}...'", "api")
+        
+        # 応答を分析
+        final_response = self._analyze_response(response, user_input)
+        
+        # 会話履歴を更新。エラーのお詫びと、締め切りに間に合わず返したシミュレーションの応答（fallback）は
+        # ペルソナの発言ではないので残さない（次のターンがそれを前提にしないように）。やり直せば改めて生成する
+        if self.last_error is None and self.last_degraded != "fallback":
+            self.memory.add_interaction(user_input, final_response)
+        elif self.last_degraded == "fallback":
+            self.thought_flow.add_thought("代わりの応答なので会話履歴には残しません", "process")
+        
+        self.thought_flow.add_thought("処理完了、応答を返します", "process")
+        return final_response
+    
+    def _handle_error(self, e: Exception) -> str:
+        error_msg = f"予期せぬエラーが発生しました: {str(e)}"
+        self.last_error = error_msg
+        self.thought_flow.add_thought(error_msg, "error")
+        return f"すみません、処理中に問題が発生しました: {str(e)}"
     
     def get_thought_process(self) -> List[Dict[str, str]]:
         """思考プロセスを取得"""
@@ -411,7 +1085,8 @@ class AIPersonaAgent:
     
     def reset_conversation(self) -> None:
         """会話をリセットする"""
-        self.memory.conversation_history = []
+        self.memory.clear()
+        self.client.context = None
         self.thought_flow.add_thought("会話履歴をリセットしました", "process")
 
 
@@ -526,11 +1201,20 @@ def create_yamada_taro_persona() -> PersonaTemplate:
     )
 
 
-def check_ollama_available(base_url: str = "http://localhost:11434/api") -> bool:
+def ollama_api_base() -> str:
+    """OLLAMA_HOST（ollama パッケージと同じ環境変数）から API のベースURLを求める"""
+    host = os.getenv("OLLAMA_HOST", "http://localhost:11434").rstrip("/")
+    if not host.startswith(("http://", "https://")):
+        host = f"http://{host}"
+    return f"{host}/api"
+
+
+def check_ollama_available(base_url: Optional[str] = None) -> bool:
     """Ollamaサービスが利用可能かチェックする"""
+    base_url = base_url or ollama_api_base()
     try:
-        response = requests.get(f"{base_url}/version", timeout=2)
-        return response.status_code == 200
+        with urllib.request.urlopen(f"{base_url}/version", timeout=2) as response:
+            return response.status == 200
     except:
         return False
 
@@ -1,12 +1,46 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import dataclasses
+import functools
+import json
 import os
-from typing import Dict, Optional
+import sys
+import threading
+import time
+import traceback
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Literal, Optional, Tuple
 
-from fastapi import FastAPI
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, PrivateAttr, ValidationError
 
-from clone_agentAI import AIPersonaAgent, check_ollama_available, create_yamada_taro_persona
+from clone_agentAI import (
+    PERSONA_PROMPT_MODES,
+    AIPersonaAgent,
+    _default_transport,
+    cassette_replay_enabled,
+    check_ollama_available,
+    load_ollama,
+)
+from backend_pool import BackendPool, get_backend_pool
+from concurrency import BATCH, INTERACTIVE, PRIORITIES, AdaptiveLimiter
+from context_window import ContextSizer
+from deadline import Deadline
+from exemplars import ExemplarIndex
+from idempotency import NEW, IdempotencyCache, IdempotencyConflict
+from metrics import REGISTRY
+from personas import CompiledPersona, get_registry
+from prefetch import PrefetchService
+from retrieval import HybridRetriever, load_knowledge_markdown
+from router import ModelRouter, RouterConfig
+from session_store import SessionStore, StaleSessionError
+from snapshot import SessionSnapshot, SnapshotStore, persona_digest, record_restore
+from ws_session import ChannelRegistry, SessionChannel
 
 
 class ChatRequest(BaseModel):
@@ -14,55 +48,986 @@ class ChatRequest(BaseModel):
     session_id: str = Field("default")
     reset: bool = Field(False)
     model_name: Optional[str] = Field(None, description="Override Ollama model (e.g. 'gemma3:1b')")
+    persona_id: Optional[str] = Field(None, description="Persona from the registry (default persona if omitted)")
+    deadline_ms: Optional[int] = Field(
+        None, gt=0, description="Time budget for this request (CLONEAI_DEADLINE_MS if omitted)"
+    )
+    priority: Literal["interactive", "background", "batch"] = Field(
+        INTERACTIVE, description="Scheduling class; participants are interactive, offline tools use batch"
+    )
+    idempotency_key: Optional[str] = Field(
+        None, max_length=200, description="Retries with the same key share one reply (also the Idempotency-Key header)"
+    )
 
 
 class ChatResponse(BaseModel):
     reply: str
     session_id: str
     model_name: str
+    persona_id: str
+    degraded: bool = Field(False, description="True if the deadline forced a partial or fallback reply")
+    degraded_reason: Optional[str] = Field(None, description="'partial' or 'fallback' when degraded")
+    error: bool = Field(False, description="True if the backend failed and the reply is an apology, not a generated turn")
+    replayed: bool = Field(False, description="True if this reply was generated for an earlier request with the same idempotency_key")
+    prefetched: bool = Field(False, description="True if this scripted turn was answered from the prefetch pool")
+    # Whether the turn went into the session's history (not for errors or deadline fallbacks)
+    _recorded: bool = PrivateAttr(False)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so the port opens (and /health answers) right away;
+    # /ready turns 200 once shared indexes are built and the backend has been probed.
+    task = asyncio.create_task(asyncio.to_thread(warm_up))
+    prefetching = asyncio.create_task(_start_prefetch(task)) if _prefetch is not None else None
+    yield
+    if not task.done():
+        task.cancel()
+    if prefetching is not None:
+        prefetching.cancel()
+        await _prefetch.stop()
 
 
-app = FastAPI(title="cloneAI local chat server", version="0.1.0")
+app = FastAPI(title="cloneAI local chat server", version="0.1.0", lifespan=lifespan)
+
+_ready = threading.Event()
+_warmup_ms: Dict[str, float] = {}
+_warmup_errors: Dict[str, str] = {}
+
+# Backend probe result, reused by new sessions instead of an HTTP round-trip on every one
+_backend_check: Tuple[float, bool] = (float("-inf"), False)
+_BACKEND_CHECK_TTL_S = 30.0
 
 # Very small in-memory session store for PoC
 _sessions: Dict[str, AIPersonaAgent] = {}
 
+# Shared session state for multi-worker deployments (enabled via CLONEAI_SESSION_DB).
+# _sessions then acts as a per-worker cache and _session_versions tracks what each cached agent holds.
+# _session_episodes is the last episodic turn already in the store, so a save only writes the new ones.
+_session_store: Optional[SessionStore] = None
+_session_versions: Dict[str, int] = {}
+_session_episodes: Dict[str, int] = {}
+_session_store_lock = threading.Lock()
+_SAVE_RETRIES = 3
 
-def _get_agent(session_id: str, model_name: Optional[str]) -> AIPersonaAgent:
-    if session_id in _sessions:
-        agent = _sessions[session_id]
-        if model_name and getattr(agent.client, "model_name", None) != model_name:
-            agent.client.model_name = model_name
-        return agent
 
-    persona = create_yamada_taro_persona()
+def _get_session_store() -> Optional[SessionStore]:
+    global _session_store
+    db_path = os.getenv("CLONEAI_SESSION_DB")
+    if not db_path:
+        return None
+    with _session_store_lock:
+        if _session_store is None:
+            _session_store = SessionStore(Path(db_path))
+    return _session_store
+
+
+def _sync_session(store: SessionStore, session_id: str, agent: AIPersonaAgent, model_name: Optional[str]) -> None:
+    """Pull the session's state if another worker has written a newer version."""
+    record = store.load(session_id, known_version=_session_versions.get(session_id))
+    if record is None:
+        _session_episodes.pop(session_id, None)
+        if _session_versions.pop(session_id, None) is not None:
+            agent.memory.clear()
+        return
+    if record.state is not None:
+        agent.memory.restore_state(record.state)
+        episodes = record.state.get("e")
+        _session_episodes[session_id] = episodes[-1][0] if episodes else 0
+        # The backend context no longer matches the history another worker wrote
+        agent.client.context = None
+        if record.model_name and not model_name:
+            agent.client.model_name = record.model_name
+    _session_versions[session_id] = record.version
+
+
+def _save_session(
+    store: SessionStore,
+    session_id: str,
+    agent: AIPersonaAgent,
+    message: str,
+    reply: str,
+    recorded: bool,
+    reset: bool = False,
+) -> None:
+    """Write the session back; on a conflict, replay this turn (and its reset) on top of the newer state.
+
+    Only the episodic turns added since the last save are written; a reset replaces all of them.
+    """
+    for _ in range(_SAVE_RETRIES):
+        episodes_after = 0 if reset else _session_episodes.get(session_id, 0)
+        state = agent.memory.to_state(episodes_after=episodes_after)
+        try:
+            _session_versions[session_id] = store.save(
+                session_id,
+                state,
+                expected_version=_session_versions.get(session_id, 0),
+                model_name=agent.client.model_name,
+                episodes_after=episodes_after,
+            )
+            episodes = state.get("e")
+            _session_episodes[session_id] = episodes[-1][0] if episodes else episodes_after
+            return
+        except StaleSessionError:
+            _sync_session(store, session_id, agent, agent.client.model_name)
+            if reset:
+                agent.reset_conversation()
+            if recorded:
+                agent.memory.add_interaction(message, reply)
+    raise StaleSessionError(session_id, _session_versions.get(session_id, 0))
+
+# Per-session snapshots on disk (enabled via CLONEAI_SNAPSHOT_DIR), read back lazily on a session's
+# next request after a restart so the conversation and the backend context carry on.
+_snapshot_store: Optional[SnapshotStore] = None
+
+
+def _get_snapshot_store() -> Optional[SnapshotStore]:
+    global _snapshot_store
+    directory = os.getenv("CLONEAI_SNAPSHOT_DIR")
+    if not directory:
+        return None
+    with _session_store_lock:
+        if _snapshot_store is None or _snapshot_store.directory != Path(directory):
+            _snapshot_store = SnapshotStore(Path(directory))
+    return _snapshot_store
+
+
+def _save_snapshot(snapshots: SnapshotStore, session_id: str, agent: AIPersonaAgent, persona: CompiledPersona) -> None:
+    client = agent.client
+    snapshots.save(session_id, SessionSnapshot(
+        state=agent.memory.to_state(),
+        model_name=client.model_name,
+        persona_digest=persona_digest(persona.template.to_prompt()),
+        context=client.context,
+        context_model=client.context_model,
+        store_version=_session_versions.get(session_id),
+    ))
+
+
+def _restore_snapshot(session_id: str, agent: AIPersonaAgent, persona: CompiledPersona, model_name: Optional[str]) -> None:
+    """Bring back a session this process does not hold yet from its snapshot, if there is one."""
+    snapshots = _get_snapshot_store()
+    snap = snapshots.load(session_id) if snapshots is not None else None
+    if snap is None:
+        return
+    agent.memory.restore_state(snap.state)
+    if snap.model_name and not model_name and agent.router is None:
+        agent.client.model_name = snap.model_name
+    # The context is only valid for the model and persona prompt that produced it
+    reuse = (
+        bool(snap.context)
+        and snap.context_model == agent.client.model_name
+        and snap.persona_digest == persona_digest(persona.template.to_prompt())
+    )
+    if reuse:
+        agent.client.context = snap.context
+        agent.client.context_model = snap.context_model
+    if snap.store_version is not None:
+        # Lets _sync_session skip reloading a store version the snapshot already holds
+        _session_versions[session_id] = snap.store_version
+        episodes = snap.state.get("e")
+        _session_episodes[session_id] = episodes[-1][0] if episodes else 0
+    record_restore(reuse)
+
+# Lifelog knowledge index shared by all sessions (enabled via CLONEAI_KNOWLEDGE_PATH)
+_retriever: Optional[HybridRetriever] = None
+_retriever_lock = threading.Lock()
+
+
+def _get_retriever() -> Optional[HybridRetriever]:
+    global _retriever
+    knowledge_path = os.getenv("CLONEAI_KNOWLEDGE_PATH")
+    if not knowledge_path:
+        return None
+    with _retriever_lock:
+        if _retriever is None:
+            retriever = HybridRetriever()
+            path = Path(knowledge_path)
+            if path.exists():
+                retriever.add_documents(load_knowledge_markdown(path))
+            _retriever = retriever
+    return _retriever
+
+
+# Exemplar index is built offline (python exemplars.py ...) and memory-mapped once
+_exemplar_index: Optional[ExemplarIndex] = None
+
+
+def _get_exemplar_index() -> Optional[ExemplarIndex]:
+    global _exemplar_index
+    index_path = os.getenv("CLONEAI_EXEMPLAR_INDEX")
+    if not index_path or not Path(index_path).exists():
+        return None
+    with _retriever_lock:
+        if _exemplar_index is None:
+            _exemplar_index = ExemplarIndex(Path(index_path))
+    return _exemplar_index
+
+
+# Personas are compiled once per process (CLONEAI_PERSONA_DIR) and shared by all their sessions;
+# "full" sends the complete persona dump, "selective" only the traits related to the input.
+# The server defaults to "selective"; AIPersonaAgent and the CLI keep "full" as their default.
+_PERSONA_PROMPT_MODE = os.getenv("CLONEAI_PERSONA_PROMPT_MODE", "selective")
+if _PERSONA_PROMPT_MODE not in PERSONA_PROMPT_MODES:
+    # Fail at startup rather than on the first /chat (a typo would otherwise look like a valid mode)
+    raise ValueError(
+        f"CLONEAI_PERSONA_PROMPT_MODE must be one of {', '.join(PERSONA_PROMPT_MODES)}: {_PERSONA_PROMPT_MODE!r}"
+    )
+
+
+# Fast/large model cascade shared by all sessions (enabled via CLONEAI_LARGE_MODEL)
+_router: Optional[ModelRouter] = None
+_router_config = RouterConfig.from_env()
+
+_chat_requests = REGISTRY.counter("cloneai_chat_requests_total", "/chat requests by outcome")
+_chat_latency = REGISTRY.histogram("cloneai_chat_latency_seconds", "End-to-end /chat latency")
+
 
+def _get_router() -> Optional[ModelRouter]:
+    global _router
+    if _router_config is None:
+        return None
+    with _retriever_lock:
+        if _router is None:
+            _router = ModelRouter(_router_config)
+    return _router
+
+
+# Default time budget per /chat request; kept under the Next.js proxy's 30s timeout
+_DEFAULT_DEADLINE_MS = float(os.getenv("CLONEAI_DEADLINE_MS", "25000"))
+
+# How often /chat checks whether the caller is still connected while a reply is generated
+_DISCONNECT_POLL_S = float(os.getenv("CLONEAI_DISCONNECT_POLL_S", "0.25"))
+
+
+class ClientDisconnected(Exception):
+    """The caller went away before the reply was ready."""
+
+
+async def _run_while_connected(request: Request, work: Awaitable[Any]) -> Any:
+    """Await `work`, cancelling it as soon as the client disconnects.
+
+    Cancellation reaches the backend stream (see OllamaClient.agenerate), so the model stops
+    generating and the partial turn is never written to memory.
+    """
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=_DISCONNECT_POLL_S)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                break
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    raise ClientDisconnected()
+
+
+# Replies by idempotency key: in-flight turns to join and recent results to replay.
+# Only turns that were recorded are kept; a retry after an error or fallback generates the turn again.
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+_idempotent: IdempotencyCache[ChatResponse] = IdempotencyCache.from_env(keep=lambda res: res._recorded)
+
+# Process-wide cap on concurrent generations, tuned from observed latency (CLONEAI_CONCURRENCY_LIMIT)
+_limiter: Optional[AdaptiveLimiter] = AdaptiveLimiter.from_env()
+
+# Picks num_ctx per generation from the prompt length (CLONEAI_NUM_CTX)
+_context_sizer: Optional[ContextSizer] = ContextSizer.from_env()
+
+
+def _session_key(persona: CompiledPersona, session_id: str) -> str:
+    """Sessions of the default persona keep their plain id; others are namespaced by persona."""
+    if persona.persona_id == get_registry().default_id:
+        return session_id
+    return f"{persona.persona_id}/{session_id}"
+
+
+def _backend_available() -> bool:
+    global _backend_check
+    pool = get_backend_pool()
+    if pool is not None and not cassette_replay_enabled():
+        # The pool health-checks its endpoints in the background; no extra probe needed
+        return pool.any_healthy()
+    checked_at, available = _backend_check
+    if time.monotonic() - checked_at > _BACKEND_CHECK_TTL_S:
+        available = cassette_replay_enabled() or check_ollama_available()
+        _backend_check = (time.monotonic(), available)
+    return available
+
+
+def _start_backend_pool() -> Optional[BackendPool]:
+    """Probe every endpoint of CLONEAI_OLLAMA_HOSTS once, then keep checking in the background."""
+    pool = get_backend_pool()
+    if pool is not None:
+        pool.check_all()
+        pool.start()
+    return pool
+
+
+def warm_up() -> Dict[str, float]:
+    """Build shared indexes, open the session store and probe the backend ahead of the first /chat."""
+    steps = (
+        ("personas", get_registry),
+        ("retriever", _get_retriever),
+        ("exemplar_index", _get_exemplar_index),
+        ("session_store", _get_session_store),
+        ("backend_pool", _start_backend_pool),
+        ("backend_probe", _backend_available),
+    )
+    # A failing step is logged and reported by /ready instead of leaving the server unready forever;
+    # every step is a lazy getter, so /chat retries it on first use.
+    for name, step in steps + (("ollama_import", _import_ollama_if_used),):
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as exc:
+            _warmup_errors[name] = f"{type(exc).__name__}: {exc}"
+            print(f"warning: warm-up step {name!r} failed", file=sys.stderr)
+            traceback.print_exc()
+            continue
+        _warmup_ms[name] = round((time.perf_counter() - started) * 1000.0, 1)
+    _ready.set()
+    return dict(_warmup_ms)
+
+
+def _import_ollama_if_used() -> None:
+    if _backend_available() and not cassette_replay_enabled():
+        load_ollama()
+
+
+def _new_agent(persona: CompiledPersona, model_name: Optional[str]) -> AIPersonaAgent:
     default_model = os.getenv("CLONEAI_OLLAMA_MODEL", "gemma3:1b")
     chosen_model = model_name or default_model
+    # An explicit model_name pins the session to that model instead of routing
+    router = None if model_name else _get_router()
 
     # For PoC, automatically fall back to simulation if Ollama isn't reachable.
-    simulation_mode = not check_ollama_available()
-    agent = AIPersonaAgent(persona, model_name=chosen_model, simulation_mode=simulation_mode)
+    simulation_mode = not _backend_available()
+    agent = AIPersonaAgent(
+        persona.template,
+        model_name=chosen_model,
+        simulation_mode=simulation_mode,
+        retriever=_get_retriever(),
+        persona_prompt_mode=_PERSONA_PROMPT_MODE,
+        trait_index=persona.trait_index,
+        exemplar_index=_get_exemplar_index(),
+        episodic_memory=os.getenv("CLONEAI_EPISODIC_MEMORY", "1") != "0",
+        fact_memory=os.getenv("CLONEAI_FACT_MEMORY", "1") != "0",
+        generation_options=persona.options or None,
+        router=router,
+    )
+    agent.client.pool = get_backend_pool()
+    agent.client.limiter = _limiter
+    agent.client.context_sizer = _context_sizer
+    # Continue each turn from the /api/generate context of the previous one (CLONEAI_OLLAMA_CONTEXT=1)
+    agent.client.use_context = os.getenv("CLONEAI_OLLAMA_CONTEXT", "0") == "1"
+    return agent
+
+
+def _get_agent(session_id: str, persona: CompiledPersona, model_name: Optional[str]) -> AIPersonaAgent:
+    if session_id in _sessions:
+        agent = _sessions[session_id]
+        if model_name and getattr(agent.client, "model_name", None) != model_name:
+            agent.client.model_name = model_name
+            agent.router = None
+        return agent
+
+    agent = _new_agent(persona, model_name)
+    # With several Ollama endpoints, keep each session on one of them for KV-cache reuse
+    agent.client.session_key = session_id
+    _restore_snapshot(session_id, agent, persona, model_name)
     _sessions[session_id] = agent
     return agent
 
 
+def _prefetch_agent(persona_id: str, model_name: Optional[str]) -> Optional[AIPersonaAgent]:
+    """A throwaway agent for pre-generating scripted turns; None while no backend is reachable."""
+    if not _backend_available():
+        return None
+    return _new_agent(get_registry().get(persona_id), model_name)
+
+
+# Scripted opening turns answered from a pool generated while the backend is idle (CLONEAI_PREFETCH_POOL)
+_prefetch: Optional[PrefetchService] = PrefetchService.from_env(_prefetch_agent, _limiter)
+
+
+async def _start_prefetch(warming: Awaitable[Any]) -> None:
+    """Start filling the default persona's pool once warm-up has probed the backend."""
+    await warming
+    _prefetch.watch(get_registry().default_id)
+    _prefetch.start()
+
+
 @app.get("/health")
 def health():
+    """Liveness: the process is up and serving HTTP."""
     return {"ok": True}
 
 
-@app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
-    agent = _get_agent(req.session_id, req.model_name)
+@app.get("/ready")
+def ready(response: Response):
+    """Readiness: warm-up has finished, so /chat will not block on first-use setup."""
+    if not _ready.is_set():
+        response.status_code = 503
+        return {"ready": False}
+    body: Dict[str, Any] = {"ready": True, "warmup_ms": _warmup_ms}
+    if _warmup_errors:
+        body["warmup_errors"] = _warmup_errors
+    pool = get_backend_pool()
+    if pool is not None:
+        body["backends"] = pool.snapshot()
+    if _limiter is not None:
+        body["concurrency"] = _limiter.snapshot()
+    if _prefetch is not None:
+        body["prefetch"] = _prefetch.snapshot()
+    return body
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus text format: routing decisions, per-route latency, /chat outcomes."""
+    return REGISTRY.render()
+
+
+@app.get("/personas")
+def personas():
+    registry = get_registry()
+    return {
+        "default": registry.default_id,
+        "personas": [{"id": pid, "name": registry.get(pid).template.name} for pid in registry.ids()],
+    }
+
+
+async def _open_session(
+    persona_id: Optional[str], session_id: str, model_name: Optional[str]
+) -> Tuple[CompiledPersona, str, AIPersonaAgent]:
+    """Resolve the persona and return (persona, session key, agent); 404 for an unknown persona."""
+    registry = await asyncio.to_thread(get_registry)
+    try:
+        persona = registry.get(persona_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown persona_id: {persona_id}")
+    key = _session_key(persona, session_id)
+    agent = await asyncio.to_thread(_get_agent, key, persona, model_name)
+    return persona, key, agent
+
+
+async def _chat_turn(
+    req: ChatRequest,
+    persona: CompiledPersona,
+    key: str,
+    agent: AIPersonaAgent,
+    started: float,
+    request: Optional[Request] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> ChatResponse:
+    """Run one turn on an already resolved session, save it and record the outcome.
+
+    The deadline counts from `started` (when the turn arrived), so time spent resolving the
+    session or waiting behind earlier turns comes out of the same budget.
+    """
+    budget_ms = req.deadline_ms or _DEFAULT_DEADLINE_MS
+    deadline = Deadline.after_ms(budget_ms - (time.perf_counter() - started) * 1000.0)
+    store = _get_session_store()
+    if store is not None:
+        await asyncio.to_thread(_sync_session, store, key, agent, req.model_name)
 
     if req.reset:
         agent.reset_conversation()
 
-    reply = agent.process_input(req.message)
+    agent.client.priority = req.priority
+    turns_before = agent.memory.turn_count
+    prefetched = None
+    if _prefetch is not None:
+        prefetched = _prefetch.claim(persona.persona_id, req.model_name, key, agent, req.message, req.priority)
+    if prefetched is not None:
+        reply = agent.accept_prefetched(req.message, prefetched)
+        if on_token is not None:
+            on_token(prefetched.reply)
+    else:
+        turn = agent.aprocess_input(req.message, deadline, on_token=on_token)
+        reply = await (_run_while_connected(request, turn) if request is not None else turn)
+
+    recorded = agent.memory.turn_count != turns_before
+    if store is not None:
+        await asyncio.to_thread(_save_session, store, key, agent, req.message, reply, recorded, req.reset)
+    snapshots = _get_snapshot_store()
+    if snapshots is not None:
+        await asyncio.to_thread(_save_snapshot, snapshots, key, agent, persona)
 
-    return ChatResponse(
+    if agent.last_error:
+        outcome = "error"
+    elif agent.last_degraded:
+        outcome = "degraded"
+    else:
+        outcome = "ok"
+    _chat_requests.inc(outcome=outcome)
+    _chat_latency.observe(time.perf_counter() - started)
+
+    res = ChatResponse(
         reply=reply,
         session_id=req.session_id,
         model_name=agent.client.model_name,
+        persona_id=persona.persona_id,
+        degraded=agent.last_degraded is not None,
+        degraded_reason=agent.last_degraded,
+        error=agent.last_error is not None,
+        prefetched=prefetched is not None,
+    )
+    res._recorded = recorded
+    return res
+
+
+async def _chat_once(req: ChatRequest, request: Optional[Request] = None) -> ChatResponse:
+    started = time.perf_counter()
+    persona, key, agent = await _open_session(req.persona_id, req.session_id, req.model_name)
+    return await _chat_turn(req, persona, key, agent, started, request=request)
+
+
+async def _handle_chat(req: ChatRequest, request: Optional[Request] = None) -> ChatResponse:
+    """One chat turn; with `request`, the turn is cancelled if that client disconnects.
+
+    With an idempotency_key, a retry joins the turn still being generated for the same key or gets
+    its stored reply, so the turn is generated and recorded once. The shared turn keeps running
+    while any caller waits (see IdempotencyCache), hence it runs without a `request` of its own.
+    """
+    if not req.idempotency_key:
+        return await _chat_once(req, request)
+    scope = (req.persona_id, req.session_id, req.idempotency_key)
+    fingerprint = (req.message, req.reset, req.model_name)
+    work = _idempotent.run(scope, fingerprint, functools.partial(_chat_once, req))
+    try:
+        res, how = await (_run_while_connected(request, work) if request is not None else work)
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail="idempotency_key was already used for a different request")
+    return res if how == NEW else res.model_copy(update={"replayed": True})
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(req: ChatRequest, request: Request):
+    header_key = request.headers.get(IDEMPOTENCY_HEADER)
+    if header_key and not req.idempotency_key:
+        req = req.model_copy(update={"idempotency_key": header_key})
+    try:
+        return await _handle_chat(req, request)
+    except ClientDisconnected:
+        _chat_requests.inc(outcome="cancelled")
+        # Nobody reads this; 499 follows the nginx convention for "client closed request"
+        return Response(status_code=499)
+
+
+# ---- Bulk chat ----
+_BATCH_MAX_ITEMS = int(os.getenv("CLONEAI_CHAT_BATCH_MAX_ITEMS", "256"))
+# Sessions of one /chat/batch call run at most this many at a time; generations are further
+# bounded by the shared concurrency limiter like any other /chat turn
+_BATCH_MAX_PARALLEL = int(os.getenv("CLONEAI_CHAT_BATCH_PARALLEL", "16"))
+
+
+class ChatBatchRequest(BaseModel):
+    items: List[ChatRequest] = Field(..., min_length=1)
+
+
+async def _batch_item(index: int, req: ChatRequest) -> Dict[str, Any]:
+    try:
+        res = await _handle_chat(req)
+        return {"index": index, "ok": True, "result": res.model_dump()}
+    except HTTPException as exc:
+        return {"index": index, "ok": False, "status": exc.status_code, "error": str(exc.detail)}
+    except Exception as exc:
+        _chat_requests.inc(outcome="error")
+        return {"index": index, "ok": False, "status": 500, "error": str(exc)}
+
+
+@app.post("/chat/batch")
+async def chat_batch(batch: ChatBatchRequest):
+    """Run many chat turns in one request and stream one NDJSON line per item as each completes.
+
+    Items of the same session run in the order given (each turn builds on the previous one);
+    different sessions run concurrently. Items run at batch priority unless they set `priority`,
+    so a large batch does not compete with live participants. Each line is {"index", "ok", "result"}
+    or {"index", "ok": false, "status", "error"}. Closing the connection cancels the unfinished items.
+    """
+    if len(batch.items) > _BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {_BATCH_MAX_ITEMS} items per batch")
+
+    registry = await asyncio.to_thread(get_registry)
+    # Grouped by the resolved session key: persona_id=None and the default id share one agent
+    sessions: Dict[Any, List[Tuple[int, ChatRequest]]] = {}
+    for index, item in enumerate(batch.items):
+        if "priority" not in item.model_fields_set:
+            item = item.model_copy(update={"priority": BATCH})
+        try:
+            key: Any = _session_key(registry.get(item.persona_id), item.session_id)
+        except KeyError:
+            key = (item.persona_id, item.session_id)  # answered with 404 by _open_session
+        sessions.setdefault(key, []).append((index, item))
+
+    async def stream() -> AsyncIterator[bytes]:
+        results: asyncio.Queue = asyncio.Queue()
+        parallel = asyncio.Semaphore(max(1, _BATCH_MAX_PARALLEL))
+
+        async def run_session(items: List[Tuple[int, ChatRequest]]) -> None:
+            async with parallel:
+                for index, item in items:
+                    await results.put(await _batch_item(index, item))
+
+        tasks = [asyncio.create_task(run_session(items)) for items in sessions.values()]
+        remaining = len(batch.items)
+        try:
+            while remaining:
+                result = await results.get()
+                remaining -= 1
+                yield (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8")
+        finally:
+            unfinished = [t for t in tasks if not t.done()]
+            for task in unfinished:
+                task.cancel()
+            if remaining:
+                _chat_requests.inc(remaining, outcome="cancelled")
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+# ---- WebSocket sessions ----
+_WS_HEARTBEAT_S = float(os.getenv("CLONEAI_WS_HEARTBEAT_S", "20"))
+_WS_RESUME_GRACE_S = float(os.getenv("CLONEAI_WS_RESUME_GRACE_S", "30"))
+_WS_EVENT_INTERVAL_S = float(os.getenv("CLONEAI_WS_EVENT_INTERVAL_S", "10"))
+# A client that sends nothing (not even a pong) for this many heartbeat intervals is treated as gone
+_WS_MISSED_HEARTBEATS = 2.5
+# Close codes in the 4000-4999 range reserved for applications
+WS_CLOSE_UNKNOWN_PERSONA = 4404
+WS_CLOSE_HEARTBEAT_TIMEOUT = 4408
+WS_CLOSE_RESUMED_ELSEWHERE = 4409
+
+_channels = ChannelRegistry()
+
+
+def _ws_metrics_event(channel: SessionChannel, agent: AIPersonaAgent) -> Dict[str, Any]:
+    event: Dict[str, Any] = {
+        "type": "event",
+        "event": "metrics",
+        "turn_count": agent.memory.turn_count,
+        "pending_turns": len(channel.turns),
+    }
+    if _limiter is not None:
+        event["concurrency"] = _limiter.snapshot()
+    return event
+
+
+async def _ws_push_new_facts(channel: SessionChannel, agent: AIPersonaAgent, turn_id: str, before: Dict[str, Any]) -> None:
+    """Push what the agent learned about the user in this turn (fact extraction runs in the background)."""
+    await asyncio.to_thread(agent.memory.flush, 2.0)
+    learned = {k: v for k, v in agent.memory.key_facts.items() if before.get(k) != v}
+    if learned:
+        channel.push({"type": "event", "event": "facts", "id": turn_id, "facts": learned})
+
+
+async def _ws_run_turn(
+    channel: SessionChannel,
+    turn_id: str,
+    req: ChatRequest,
+    persona: CompiledPersona,
+    key: str,
+    agent: AIPersonaAgent,
+    started: float,
+) -> None:
+    loop = asyncio.get_running_loop()
+
+    def on_token(text: str) -> None:
+        # Called from the generation worker thread with a real backend
+        with contextlib.suppress(RuntimeError):  # loop already closed on shutdown
+            loop.call_soon_threadsafe(channel.send, {"type": "token", "id": turn_id, "text": text})
+
+    try:
+        async with channel.turn_lock:
+            facts_before = dict(agent.memory.key_facts)
+            res = await _chat_turn(req, persona, key, agent, started, on_token=on_token)
+        channel.push({"type": "reply", "id": turn_id, **res.model_dump()})
+    except asyncio.CancelledError:
+        _chat_requests.inc(outcome="cancelled")
+        channel.push({"type": "cancelled", "id": turn_id})
+        raise
+    except Exception as exc:
+        _chat_requests.inc(outcome="error")
+        channel.push({"type": "error", "id": turn_id, "status": 500, "error": str(exc)})
+        return
+    finally:
+        channel.turns.pop(turn_id, None)
+    await _ws_push_new_facts(channel, agent, turn_id, facts_before)
+
+
+def _ws_start_turn(
+    channel: SessionChannel,
+    frame: Dict[str, Any],
+    session_id: str,
+    persona: CompiledPersona,
+    key: str,
+    agent: AIPersonaAgent,
+    model_name: Optional[str],
+) -> None:
+    started = time.perf_counter()
+    turn_id = str(frame.get("id") or uuid.uuid4().hex[:12])
+    if turn_id in channel.turns:
+        channel.push({"type": "error", "id": turn_id, "status": 409, "error": "A turn with this id is still running"})
+        return
+    try:
+        req = ChatRequest(
+            message=frame.get("message") or "",
+            session_id=session_id,
+            persona_id=persona.persona_id,
+            model_name=model_name,
+            reset=bool(frame.get("reset", False)),
+            deadline_ms=frame.get("deadline_ms"),
+            priority=frame.get("priority") or INTERACTIVE,
+        )
+    except ValidationError as exc:
+        channel.push({"type": "error", "id": turn_id, "status": 422, "error": str(exc)})
+        return
+    channel.turns[turn_id] = asyncio.create_task(
+        _ws_run_turn(channel, turn_id, req, persona, key, agent, started)
     )
+
+
+@app.websocket("/ws/session/{session_id}")
+async def ws_session(
+    websocket: WebSocket,
+    session_id: str,
+    persona_id: Optional[str] = None,
+    model_name: Optional[str] = None,
+    resume: Optional[str] = None,
+    last_seq: int = 0,
+):
+    """A persistent channel bound to one session, for long multi-turn runs without per-turn HTTP.
+
+    The session is resolved once at connect time. Client frames (JSON objects):
+    {"type": "turn", "id", "message", "reset"?, "deadline_ms"?, "priority"?}, {"type": "cancel", "id"},
+    {"type": "ping"} and {"type": "pong"}. Server frames: "ready" (with resume_token), "token"
+    (raw model output as it is generated), "reply" (the /chat response fields), "error", "cancelled",
+    "ping"/"pong" and "event" ("facts" learned after a turn, periodic "metrics").
+    Turns of one channel run in order. reply/error/cancelled/facts frames carry a seq; reconnecting
+    with ?resume=<resume_token>&last_seq=<seq> within CLONEAI_WS_RESUME_GRACE_S replays the ones
+    missed, and turns keep running in between.
+    """
+    try:
+        persona, key, agent = await _open_session(persona_id, session_id, model_name)
+    except HTTPException as exc:
+        await websocket.close(code=WS_CLOSE_UNKNOWN_PERSONA, reason=str(exc.detail))
+        return
+    channel = _channels.open(key, resume)
+    resumed = resume is not None and channel.resume_token == resume
+    await websocket.accept()
+    await websocket.send_json({
+        "type": "ready",
+        "session_id": session_id,
+        "persona_id": persona.persona_id,
+        "model_name": agent.client.model_name,
+        "resume_token": channel.resume_token,
+        "resumed": resumed,
+        "seq": channel.seq,
+        "turn_count": agent.memory.turn_count,
+        "heartbeat_s": _WS_HEARTBEAT_S,
+    })
+    outbox = channel.attach(last_seq if resumed else 0)
+    last_seen = time.monotonic()
+
+    async def send_loop() -> None:
+        while True:
+            frame = await outbox.get()
+            if frame is None:
+                return
+            await websocket.send_json(frame)
+
+    async def receive_loop() -> None:
+        nonlocal last_seen
+        while True:
+            try:
+                text = await websocket.receive_text()
+            except WebSocketDisconnect:
+                return
+            last_seen = time.monotonic()
+            try:
+                frame = json.loads(text)
+            except ValueError:
+                frame = None
+            if not isinstance(frame, dict):
+                outbox.put_nowait({"type": "error", "status": 400, "error": "Frames must be JSON objects"})
+                continue
+            kind = frame.get("type")
+            if kind == "turn":
+                _ws_start_turn(channel, frame, session_id, persona, key, agent, model_name)
+            elif kind == "cancel":
+                task = channel.turns.get(str(frame.get("id")))
+                if task is not None:
+                    task.cancel()
+            elif kind == "ping":
+                outbox.put_nowait({"type": "pong", "ts": frame.get("ts")})
+            elif kind != "pong":
+                outbox.put_nowait({"type": "error", "status": 400, "error": f"Unknown frame type: {kind}"})
+
+    async def heartbeat_loop() -> None:
+        while True:
+            await asyncio.sleep(_WS_HEARTBEAT_S)
+            if time.monotonic() - last_seen > _WS_HEARTBEAT_S * _WS_MISSED_HEARTBEATS:
+                return
+            outbox.put_nowait({"type": "ping", "ts": time.time()})
+
+    async def event_loop() -> None:
+        while True:
+            await asyncio.sleep(_WS_EVENT_INTERVAL_S)
+            outbox.put_nowait(_ws_metrics_event(channel, agent))
+
+    sender = asyncio.create_task(send_loop())
+    receiver = asyncio.create_task(receive_loop())
+    heartbeat = asyncio.create_task(heartbeat_loop())
+    tasks = [sender, receiver, heartbeat]
+    if _WS_EVENT_INTERVAL_S > 0:
+        tasks.append(asyncio.create_task(event_loop()))
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        channel.detach(outbox, _WS_RESUME_GRACE_S, _channels.drop)
+    # A send or receive failure means the client is already gone; nothing left to close
+    failed = any(task.exception() is not None for task in done)
+    if heartbeat in done:
+        code = WS_CLOSE_HEARTBEAT_TIMEOUT
+    elif sender in done and not failed:
+        code = WS_CLOSE_RESUMED_ELSEWHERE
+    else:
+        return
+    with contextlib.suppress(Exception):
+        await websocket.close(code=code)
+
+
+# ---- Ollama-compatible proxy ----
+# Offline tools (benchmark/evaluate_models.py, benchmark/batch_generate.py) point an ollama.Client at this
+# server instead of at Ollama, so their generations share the scheduler with /chat at a lower priority.
+PRIORITY_HEADER = "X-CloneAI-Priority"
+_PASS_THROUGH_KEYS = ("format", "keep_alive", "think", "tools")
+
+
+def _backend_chat() -> Callable[..., Any]:
+    pool = get_backend_pool()
+    if pool is not None:
+        return functools.partial(pool.chat, None)
+    transport = _default_transport()
+    if transport is not None:
+        return transport.chat
+    ollama = load_ollama()
+    if ollama is None:
+        raise HTTPException(status_code=503, detail="ollama package is not installed")
+    return ollama.chat
+
+
+def _chunk_to_dict(chunk: Any) -> Dict[str, Any]:
+    if hasattr(chunk, "model_dump"):
+        return chunk.model_dump(mode="json", exclude_none=True)
+    if dataclasses.is_dataclass(chunk):
+        return {k: v for k, v in dataclasses.asdict(chunk).items() if v is not None}
+    return dict(chunk)
+
+
+async def _stream_backend(chat: Callable[..., Any], kwargs: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    """Run the blocking backend stream in a worker thread; closing this generator stops it at the next chunk."""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    cancel = threading.Event()
+    finished = object()
+
+    def put(item: Any) -> None:
+        with contextlib.suppress(RuntimeError):  # loop already closed on shutdown
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def produce() -> None:
+        chunks = None
+        try:
+            chunks = chat(**kwargs)
+            for chunk in chunks:
+                if cancel.is_set():
+                    break
+                put(_chunk_to_dict(chunk))
+        except Exception as exc:
+            put(exc)
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            put(finished)
+
+    loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancel.set()
+
+
+async def _scheduled_chat(kwargs: Dict[str, Any], priority: str) -> AsyncIterator[Dict[str, Any]]:
+    chat = _backend_chat()
+    slot = _limiter.acquire(priority=priority) if _limiter is not None else contextlib.nullcontext()
+    async with slot as permit:
+        chars = 0
+        async for chunk in _stream_backend(chat, kwargs):
+            chars += len((chunk.get("message") or {}).get("content") or "")
+            yield chunk
+        if permit is not None:
+            permit.units = chars
+
+
+@app.get("/api/version")
+def ollama_version():
+    """Lets ollama clients and check_ollama_available() probe this server like an Ollama endpoint."""
+    return {"version": f"cloneai-{app.version}"}
+
+
+@app.post("/api/chat")
+async def ollama_chat(request: Request):
+    """Ollama /api/chat through the shared scheduler (priority from the X-CloneAI-Priority header, default batch)."""
+    body = await request.json()
+    priority = request.headers.get(PRIORITY_HEADER, BATCH).lower()
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"{PRIORITY_HEADER} must be one of {', '.join(PRIORITIES)}")
+    if not body.get("model"):
+        raise HTTPException(status_code=400, detail="model is required")
+    if not _backend_available():
+        raise HTTPException(status_code=503, detail="No Ollama backend is reachable")
+    kwargs = {
+        "model": body["model"],
+        "messages": body.get("messages") or [],
+        "options": body.get("options"),
+        "stream": True,
+        **{k: body[k] for k in _PASS_THROUGH_KEYS if k in body},
+    }
+
+    if body.get("stream", True):
+        async def ndjson() -> AsyncIterator[bytes]:
+            try:
+                async for chunk in _scheduled_chat(kwargs, priority):
+                    yield (json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8")
+            except Exception as exc:
+                yield (json.dumps({"error": str(exc)}, ensure_ascii=False) + "\n").encode("utf-8")
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    final: Dict[str, Any] = {}
+    parts = []
+    try:
+        async for chunk in _scheduled_chat(kwargs, priority):
+            parts.append((chunk.get("message") or {}).get("content") or "")
+            final = chunk
+    except Exception as exc:
+        raise HTTPException(status_code=502, detail=str(exc))
+    final.setdefault("message", {"role": "assistant"})["content"] = "".join(parts)
+    return JSONResponse(final)
@@ -0,0 +1,260 @@
+"""バックエンドへの同時生成数を実測レイテンシから自動調整するリミッター
+
+Netflix の concurrency-limits の Gradient と同じ考え方で、負荷の無いときのレイテンシ
+（観測した最小値）と直近のレイテンシの比から許可する同時実行数を増減する。
+Ollama の並列スロットを使い切っていないうちはレイテンシが変わらないので上限を広げ、
+Ollama の中で待ちが発生してレイテンシが伸び始めたら狭める。上限を超えた分はここで待たせる。
+
+生成時間は応答の長さに比例するので、サンプルは「応答1文字あたりの時間」に揃えてから比べる。
+
+待っている生成は優先度クラスごとに並べ、空いた枠は interactive（/chat の参加者）から渡す。
+background・batch が待ち続けないよう、上位のクラスに続けて譲った回数が quota に達したら1回回す。
+さらに background・batch は上限のうち reserve 分の枠を使えないので、interactive の入力が来たときは
+実行中のバッチの生成が終わるのを待たずに始められる（実行中の生成は無駄になるので止めない）。
+
+    CLONEAI_CONCURRENCY_LIMIT=adaptive   # 既定。整数なら固定、off で無効
+    CLONEAI_CONCURRENCY_MAX=32
+    CLONEAI_BATCH_RESERVE=0.25           # interactive のために空けておく割合
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Deque, Dict, Mapping, Optional
+
+from metrics import REGISTRY
+
+_limit_gauge = REGISTRY.gauge("cloneai_concurrency_limit", "Generations allowed to run at the same time")
+_in_flight_gauge = REGISTRY.gauge("cloneai_concurrency_in_flight", "Generations currently running")
+_queue_gauge = REGISTRY.gauge("cloneai_concurrency_queue_depth", "Generations waiting for a slot")
+_timeouts = REGISTRY.counter("cloneai_concurrency_queue_timeouts_total", "Generations that gave up waiting for a slot")
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+BATCH = "batch"
+# 優先度の高い順
+PRIORITIES = (INTERACTIVE, BACKGROUND, BATCH)
+# 上位のクラスにこの回数続けて譲ったら、次の枠はこのクラスに回す
+DEFAULT_QUOTAS: Mapping[str, int] = {BACKGROUND: 3, BATCH: 6}
+
+
+class LimiterTimeout(Exception):
+    """締め切りまでに実行枠が空かなかった"""
+
+
+@dataclass
+class Permit:
+    """acquire() の間に呼び出し元が設定する。units は仕事量（応答の文字数）で、サンプルをこれで割る
+
+    sample を False にするとレイテンシを記録しない（エラーや締め切りで打ち切った応答など、
+    バックエンドが最後まで生成しなかったもの。負荷の無いときの値は最小値なので、すぐ返った失敗が
+    1件入るだけで以後の生成がすべて混んでいるように見えてしまう）。
+    """
+    units: Optional[int] = None
+    sample: bool = True
+
+
+class AdaptiveLimiter:
+    """asyncio 用の同時実行数リミッター（イベントループのスレッドからだけ使う）"""
+    def __init__(
+        self,
+        initial_limit: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        smoothing: float = 0.2,
+        tolerance: float = 1.5,
+        drift: float = 0.05,
+        name: str = "generation",
+        quotas: Mapping[str, int] = DEFAULT_QUOTAS,
+        reserve: float = 0.25,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.smoothing = smoothing
+        # 直近のレイテンシが負荷の無いときのこの倍までなら上限を下げない
+        self.tolerance = tolerance
+        self.drift = drift
+        self.name = name
+        self.quotas = dict(quotas)
+        # interactive 以外が使えない枠の割合（上限が2以上のときだけ、少なくとも1枠）
+        self.reserve = reserve
+        self._limit = float(min(self.max_limit, max(min_limit, initial_limit)))
+        self._in_flight = 0
+        self._in_flight_by: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {p: deque() for p in PRIORITIES}
+        self._passed_over: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        self._noload_rtt: Optional[float] = None
+        self._short_rtt: Optional[float] = None
+        self._samples = 0
+        self._publish()
+
+    @classmethod
+    def from_env(cls) -> Optional["AdaptiveLimiter"]:
+        """CLONEAI_CONCURRENCY_LIMIT: adaptive（既定）/ 固定の整数 / off"""
+        mode = os.getenv("CLONEAI_CONCURRENCY_LIMIT", "adaptive").strip().lower()
+        if mode in ("off", "0", "none", ""):
+            return None
+        max_limit = int(os.getenv("CLONEAI_CONCURRENCY_MAX", "32"))
+        reserve = float(os.getenv("CLONEAI_BATCH_RESERVE", "0.25"))
+        if mode == "adaptive":
+            return cls(max_limit=max_limit, reserve=reserve)
+        fixed = int(mode)
+        return cls(initial_limit=fixed, min_limit=fixed, max_limit=fixed, reserve=reserve)
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(self.queue_depth_of(p) for p in PRIORITIES)
+
+    def queue_depth_of(self, priority: str) -> int:
+        return sum(1 for f in self._waiters[priority] if not f.done())
+
+    def in_flight_of(self, priority: str) -> int:
+        return self._in_flight_by[priority]
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "by_priority": {
+                p: {"in_flight": self._in_flight_by[p], "queue_depth": self.queue_depth_of(p)} for p in PRIORITIES
+            },
+            "noload_rtt_ms": None if self._noload_rtt is None else round(self._noload_rtt * 1000.0, 3),
+            "short_rtt_ms": None if self._short_rtt is None else round(self._short_rtt * 1000.0, 3),
+        }
+
+    @asynccontextmanager
+    async def acquire(self, timeout: Optional[float] = None, priority: str = INTERACTIVE) -> AsyncIterator[Permit]:
+        """実行枠を1つ借りる。timeout 秒待っても空かなければ LimiterTimeout"""
+        if priority not in self._waiters:
+            raise ValueError(f"unknown priority: {priority}")
+        await self._wait_for_slot(timeout, priority)
+        permit = Permit()
+        started = time.monotonic()
+        try:
+            yield permit
+        except BaseException:
+            self._release(priority)
+            raise
+        in_flight = self._in_flight
+        self._release(priority)
+        if not permit.sample:
+            return
+        elapsed = time.monotonic() - started
+        self.record(elapsed / max(1, permit.units) if permit.units else elapsed, in_flight)
+
+    def _can_start(self, priority: str) -> bool:
+        if self._in_flight >= self.limit:
+            return False
+        if priority == INTERACTIVE:
+            return True
+        reserved = max(1, round(self.limit * self.reserve)) if self.limit > 1 and self.reserve > 0 else 0
+        lower = self._in_flight - self._in_flight_by[INTERACTIVE]
+        return lower < self.limit - reserved
+
+    def _start(self, priority: str) -> None:
+        self._in_flight += 1
+        self._in_flight_by[priority] += 1
+
+    async def _wait_for_slot(self, timeout: Optional[float], priority: str) -> None:
+        if self.queue_depth == 0 and self._can_start(priority):
+            self._start(priority)
+            self._publish()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(future)
+        # 先に並んでいるのが枠を使えない低い優先度の待ちだけなら、空いている枠をすぐ渡す
+        self._wake()
+        try:
+            if timeout is None:
+                await future
+            else:
+                await asyncio.wait_for(future, timeout=max(0.0, timeout))
+        except BaseException as exc:
+            if future.done() and not future.cancelled():
+                # 枠を渡されたのと同時に諦めた：受け取った枠を返す
+                self._release(priority)
+            else:
+                future.cancel()
+                try:
+                    self._waiters[priority].remove(future)
+                except ValueError:
+                    pass
+                self._publish()
+            if isinstance(exc, asyncio.TimeoutError):
+                _timeouts.inc(limiter=self.name, priority=priority)
+                raise LimiterTimeout() from None
+            raise
+
+    def _release(self, priority: str) -> None:
+        self._in_flight -= 1
+        self._in_flight_by[priority] -= 1
+        self._wake()
+
+    def _next_priority(self) -> Optional[str]:
+        """次に枠を渡すクラス。quota に達したクラスがあればそれを、なければ優先度の高いものを選ぶ"""
+        waiting = [p for p in PRIORITIES if self.queue_depth_of(p) and self._can_start(p)]
+        if not waiting:
+            return None
+        starved = [p for p in waiting if p in self.quotas and self._passed_over[p] >= self.quotas[p]]
+        chosen = starved[-1] if starved else waiting[0]
+        for p in waiting:
+            self._passed_over[p] = 0 if p == chosen else self._passed_over[p] + 1
+        return chosen
+
+    def _wake(self) -> None:
+        """空いている枠の数だけ、優先度と quota に従って渡す"""
+        while True:
+            priority = self._next_priority()
+            if priority is None:
+                break
+            queue = self._waiters[priority]
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    self._start(priority)
+                    future.set_result(None)
+                    break
+        self._publish()
+
+    def record(self, rtt_s: float, in_flight: int) -> None:
+        """完了した生成1件のレイテンシ（仕事量あたり）から上限を更新する"""
+        self._samples += 1
+        if self._noload_rtt is None or self._short_rtt is None:
+            self._noload_rtt = self._short_rtt = rtt_s
+        else:
+            self._short_rtt += 0.5 * (rtt_s - self._short_rtt)
+            if rtt_s < self._noload_rtt:
+                self._noload_rtt = rtt_s
+            elif in_flight <= self._limit / 2:
+                # 負荷の無いときの値は最小値。モデルやハードウェアが変わることもあるので、
+                # 空いているときのサンプルにだけはゆっくり上にも追従させる
+                self._noload_rtt += self.drift * (rtt_s - self._noload_rtt)
+        # 上限の半分も使っていないなら、上限が足りないかどうか判断できない
+        if in_flight <= self._limit / 2:
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self._noload_rtt / self._short_rtt))
+        new_limit = self._limit * gradient + math.sqrt(self._limit)
+        new_limit = self._limit * (1 - self.smoothing) + new_limit * self.smoothing
+        self._limit = max(float(self.min_limit), min(float(self.max_limit), new_limit))
+        self._wake()
+
+    def _publish(self) -> None:
+        _limit_gauge.set(self.limit, limiter=self.name)
+        for p in PRIORITIES:
+            _in_flight_gauge.set(self._in_flight_by[p], limiter=self.name, priority=p)
+            _queue_gauge.set(self.queue_depth_of(p), limiter=self.name, priority=p)
@@ -0,0 +1,123 @@
+"""組み立てたプロンプトの長さから Ollama の num_ctx を選ぶ
+
+num_ctx が大きすぎると KV キャッシュのメモリを無駄にして遅くなり、小さすぎると Ollama は
+プロンプトの先頭（ペルソナの指示）から黙って切り詰める。そこで1回ごとにプロンプトのトークン数を
+見積もり、「プロンプト + 応答の分（num_predict）」が収まる一番小さいバケットを使う。
+
+num_ctx が変わると Ollama はモデルを読み込み直すので、値はバケット単位に丸め、モデルごとに
+一度広げたバケットは、続けて shrink_after 回小さいバケットで足りるまで狭めない。
+
+上限はペルソナのパラメーターの num_ctx（chat_param_test.py の「文脈理解の深さ」）、
+無ければ CLONEAI_NUM_CTX_MAX。上限に収まらないプロンプトはエージェントが古い会話履歴から省く。
+
+    CLONEAI_NUM_CTX=auto                 # 既定。off でペルソナの num_ctx をそのまま渡す
+    CLONEAI_NUM_CTX_MAX=8192
+    CLONEAI_NUM_CTX_REPLY_TOKENS=256     # num_predict が無いときに応答のために空けておく分
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import threading
+from typing import Any, Dict, Optional, Sequence
+
+from metrics import REGISTRY
+
+_chosen = REGISTRY.counter("cloneai_num_ctx_total", "Generations by the num_ctx bucket sent to Ollama")
+_trimmed = REGISTRY.counter("cloneai_prompt_history_trimmed_total", "History turns left out because the prompt did not fit num_ctx")
+
+DEFAULT_BUCKETS = (1024, 2048, 4096, 8192, 16384, 32768)
+DEFAULT_REPLY_TOKENS = 256
+# チャットテンプレートの役割タグなど、本文以外に入る分
+TEMPLATE_OVERHEAD_TOKENS = 16
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の控えめな見積もり（多めに数える）
+
+    gemma 系のトークナイザーで日本語はおおむね1文字1トークン以下、英数字は3〜4文字で1トークン。
+    """
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + math.ceil(ascii_chars / 3) + TEMPLATE_OVERHEAD_TOKENS
+
+
+def record_trimmed(turns: int) -> None:
+    _trimmed.inc(turns)
+
+
+class ContextSizer:
+    """プロセスで共有する num_ctx の選択（モデルごとに今のバケットを持つ）"""
+    def __init__(
+        self,
+        buckets: Sequence[int] = DEFAULT_BUCKETS,
+        max_ctx: int = 8192,
+        reply_tokens: int = DEFAULT_REPLY_TOKENS,
+        shrink_after: int = 20,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        self.max_ctx = max_ctx
+        self.reply_tokens = reply_tokens
+        self.shrink_after = shrink_after
+        self._current: Dict[str, int] = {}
+        self._fits_smaller: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional["ContextSizer"]:
+        """CLONEAI_NUM_CTX=off なら None"""
+        if os.getenv("CLONEAI_NUM_CTX", "auto").strip().lower() in ("off", "0", "none", ""):
+            return None
+        return cls(
+            max_ctx=int(os.getenv("CLONEAI_NUM_CTX_MAX", "8192")),
+            reply_tokens=int(os.getenv("CLONEAI_NUM_CTX_REPLY_TOKENS", str(DEFAULT_REPLY_TOKENS))),
+        )
+
+    def ceiling(self, options: Optional[Dict[str, Any]]) -> int:
+        """使ってよい num_ctx の上限（ペルソナの num_ctx があればそれ）"""
+        configured = (options or {}).get("num_ctx")
+        return int(configured) if configured else self.max_ctx
+
+    def reply_budget(self, options: Optional[Dict[str, Any]]) -> int:
+        num_predict = (options or {}).get("num_predict")
+        return int(num_predict) if num_predict and num_predict > 0 else self.reply_tokens
+
+    def prompt_budget(self, options: Optional[Dict[str, Any]]) -> int:
+        """プロンプトに使えるトークン数"""
+        return self.ceiling(options) - self.reply_budget(options)
+
+    def bucket_for(self, tokens: int, options: Optional[Dict[str, Any]]) -> int:
+        """プロンプト tokens と応答の分が収まる一番小さいバケット（上限を超えるなら上限）"""
+        need = tokens + self.reply_budget(options)
+        ceiling = self.ceiling(options)
+        for bucket in self.buckets:
+            if bucket >= need:
+                return min(bucket, ceiling)
+        return ceiling
+
+    def choose(self, model: str, tokens: int, options: Optional[Dict[str, Any]]) -> int:
+        """このモデルで使う num_ctx。読み込み直しを避けるため今のバケットで足りればそれを使う"""
+        bucket = self.bucket_for(tokens, options)
+        with self._lock:
+            current = self._current.get(model)
+            if current is None or bucket > current:
+                self._current[model] = bucket
+                self._fits_smaller[model] = 0
+            elif bucket < current:
+                self._fits_smaller[model] = self._fits_smaller.get(model, 0) + 1
+                if self._fits_smaller[model] >= self.shrink_after:
+                    self._current[model] = bucket
+                    self._fits_smaller[model] = 0
+            else:
+                self._fits_smaller[model] = 0
+            chosen = self._current[model]
+        _chosen.inc(num_ctx=chosen)
+        return chosen
+
+    def apply(
+        self, model: str, prompt: str, options: Optional[Dict[str, Any]], context_tokens: int = 0
+    ) -> Dict[str, Any]:
+        """options に num_ctx を設定したものを返す（context_tokens は一緒に送る Ollama の context の長さ）"""
+        merged = dict(options or {})
+        merged["num_ctx"] = self.choose(model, estimate_tokens(prompt) + context_tokens, options)
+        return merged
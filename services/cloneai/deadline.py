@@ -0,0 +1,94 @@
+"""リクエストの締め切りと、残り時間から生成できるトークン数の見積もり
+
+/chat は締め切り（既定 CLONEAI_DEADLINE_MS）を Deadline にしてエージェントに渡し、
+OllamaClient は残り時間に収まるよう num_predict を絞ってから生成する。
+間に合わなかったときは途中までの応答かシミュレーションの応答を「劣化した応答」として返す。
+
+トークンの生成速度と最初のトークンまでの時間は、実際の応答のタイミング項目から
+モデルごとに指数移動平均で推定する（観測が無いうちは CPU 推論を想定した控えめな既定値）。
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+# 観測が無いときの既定値（CPU で gemma3:1b 程度）
+DEFAULT_TOKENS_PER_S = 15.0
+DEFAULT_FIRST_TOKEN_S = 1.0
+# 締め切りの手前に残しておく時間（後処理・レスポンスの送信分）
+RESERVE_S = 0.3
+# これより少ないトークン数しか出せないなら生成を始めない
+MIN_NUM_PREDICT = 8
+
+
+@dataclass(frozen=True)
+class Deadline:
+    """time.monotonic() 基準の締め切り"""
+    expires_at: float
+
+    @classmethod
+    def after_ms(cls, budget_ms: float) -> "Deadline":
+        return cls(time.monotonic() + budget_ms / 1000.0)
+
+    def remaining_s(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining_s() <= 0
+
+
+class ThroughputEstimator:
+    """モデルごとの生成速度 (tokens/s) と最初のトークンまでの時間 (s) の推定"""
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self._stats: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def estimate(self, model: str) -> Tuple[float, float]:
+        with self._lock:
+            return self._stats.get(model, (DEFAULT_TOKENS_PER_S, DEFAULT_FIRST_TOKEN_S))
+
+    def observe(self, model: str, response: Any) -> None:
+        """Ollama の最終チャンク（eval_count / eval_duration などを持つ）から更新する"""
+        eval_count = getattr(response, "eval_count", None)
+        eval_ns = getattr(response, "eval_duration", None)
+        if not eval_count or not eval_ns:
+            return
+        tokens_per_s = eval_count / (eval_ns / 1e9)
+        first_token_s = ((getattr(response, "load_duration", None) or 0)
+                         + (getattr(response, "prompt_eval_duration", None) or 0)) / 1e9
+        with self._lock:
+            if model not in self._stats:
+                self._stats[model] = (tokens_per_s, first_token_s or DEFAULT_FIRST_TOKEN_S)
+                return
+            rate, first = self._stats[model]
+            self._stats[model] = (
+                rate + self.alpha * (tokens_per_s - rate),
+                first + self.alpha * (first_token_s - first) if first_token_s else first,
+            )
+
+    def num_predict(self, model: str, remaining_s: float) -> int:
+        """残り時間で生成できるトークン数（MIN_NUM_PREDICT 未満なら 0）"""
+        tokens_per_s, first_token_s = self.estimate(model)
+        budget = int((remaining_s - first_token_s - RESERVE_S) * tokens_per_s)
+        return budget if budget >= MIN_NUM_PREDICT else 0
+
+
+THROUGHPUT = ThroughputEstimator()
+
+
+def cap_options(
+    options: Optional[Dict[str, Any]], model: str, deadline: Deadline
+) -> Tuple[Optional[Dict[str, Any]], int]:
+    """options の num_predict を残り時間に収まるよう絞る。(新しい options, 上限) を返す（0 なら間に合わない）"""
+    cap = THROUGHPUT.num_predict(model, deadline.remaining_s())
+    if cap == 0:
+        return options, 0
+    merged = dict(options or {})
+    current = merged.get("num_predict")
+    if current is None or current < 0 or current > cap:
+        merged["num_predict"] = cap
+    return merged, cap
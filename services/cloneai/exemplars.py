@@ -0,0 +1,227 @@
+"""本人の実際の返答を few-shot 例として引くための事前計算済みインデックス
+
+`benchmark/build_benchmark_from_limitless_md.py` が抽出する (相手の発話 → 本人の返答) の組を
+オフラインで文字n-gramの TF-IDF 転置インデックスに変換し、単一のバイナリファイルに書き出す。
+推論時はファイルを mmap するだけなので、起動・検索ともにほぼコストがかからない。
+
+ファイル形式（リトルエンディアン）:
+    ヘッダ     : magic "CLEX", version, n_docs, n_buckets, n_postings, blob_size (u32 x6)
+    バケット表 : posting開始位置 u32 [n_buckets + 1]
+    IDF        : f32 [n_buckets]
+    posting    : 文書番号 u32 [n_postings], 重み f32 [n_postings]
+    文書位置   : u32 [n_docs + 1]（JSONブロブ内のオフセット）
+    ブロブ     : 各文書の JSON（prompt / reply / context）を連結したUTF-8
+"""
+
+from __future__ import annotations
+
+import argparse
+import heapq
+import json
+import math
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from retrieval import char_ngrams
+
+MAGIC = b"CLEX"
+VERSION = 1
+_HEADER = struct.Struct("<4s5I")
+DEFAULT_BUCKETS = 1 << 16
+
+
+@dataclass
+class Exemplar:
+    prompt: str
+    reply: str
+    context: str
+    score: float
+
+
+def _bucket(gram: str, n_buckets: int) -> int:
+    return zlib.crc32(gram.encode("utf-8")) % n_buckets
+
+
+def build_exemplar_index(examples: Sequence[dict], output: Path, n_buckets: int = DEFAULT_BUCKETS) -> int:
+    """ベンチマーク形式の例からインデックスファイルを作成する
+
+    Args:
+        examples: build_examples の出力（prompt / reference / context を持つ辞書）
+        output: 書き出し先のパス
+        n_buckets: n-gramをハッシュするバケット数
+
+    Returns:
+        インデックスに含めた例の数
+    """
+    doc_terms: List[Counter] = []
+    docs: List[dict] = []
+    for ex in examples:
+        prompt = ex.get("prompt", "")
+        terms = Counter(_bucket(g, n_buckets) for g in char_ngrams(prompt))
+        if not terms:
+            continue
+        doc_terms.append(terms)
+        docs.append({"prompt": prompt, "reply": ex.get("reference", ""), "context": ex.get("context", "")})
+
+    n_docs = len(docs)
+    df = Counter(b for terms in doc_terms for b in terms)
+    idf = array("f", [0.0]) * n_buckets
+    for b, count in df.items():
+        idf[b] = math.log(1.0 + n_docs / count)
+
+    # 文書ベクトルを L2 正規化した TF-IDF 重みとしてバケットごとに並べる
+    postings: Dict[int, List[tuple]] = {}
+    for doc_id, terms in enumerate(doc_terms):
+        weights = {b: (1.0 + math.log(tf)) * idf[b] for b, tf in terms.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        for b, w in weights.items():
+            postings.setdefault(b, []).append((doc_id, w / norm))
+
+    starts = array("I", [0]) * (n_buckets + 1)
+    posting_docs = array("I")
+    posting_weights = array("f")
+    for b in range(n_buckets):
+        starts[b] = len(posting_docs)
+        for doc_id, weight in postings.get(b, ()):
+            posting_docs.append(doc_id)
+            posting_weights.append(weight)
+    starts[n_buckets] = len(posting_docs)
+
+    blob = bytearray()
+    offsets = array("I", [0])
+    for doc in docs:
+        blob += json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        offsets.append(len(blob))
+
+    for arr in (starts, idf, posting_docs, posting_weights, offsets):
+        if sys.byteorder != "little":  # pragma: no cover
+            arr.byteswap()
+
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open("wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, n_docs, n_buckets, len(posting_docs), len(blob)))
+        for arr in (starts, idf, posting_docs, posting_weights, offsets):
+            arr.tofile(f)
+        f.write(blob)
+    return n_docs
+
+
+class ExemplarIndex:
+    """mmap したインデックスファイルから類似する過去のやり取りを引く"""
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = self.path.open("rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_docs, n_buckets, n_postings, blob_size = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"exemplar index の形式が不正です: {self.path}")
+        if sys.byteorder != "little":  # pragma: no cover
+            self.close()
+            raise ValueError("exemplar index はリトルエンディアン環境でのみ読み込めます")
+
+        self.n_docs = n_docs
+        self.n_buckets = n_buckets
+        view = memoryview(self._mm)
+        pos = _HEADER.size
+
+        def take(count: int, fmt: str) -> memoryview:
+            nonlocal pos
+            size = count * 4
+            section = view[pos:pos + size].cast(fmt)
+            pos += size
+            return section
+
+        self._starts = take(n_buckets + 1, "I")
+        self._idf = take(n_buckets, "f")
+        self._docs = take(n_postings, "I")
+        self._weights = take(n_postings, "f")
+        self._offsets = take(n_docs + 1, "I")
+        self._blob = view[pos:pos + blob_size]
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def search(self, query: str, k: int = 3, max_postings: int = 2048) -> List[Exemplar]:
+        """入力に類似する過去のやり取りを最大k件返す
+
+        IDFの高い（珍しい）n-gramから順に posting を走査し、走査件数が max_postings を
+        超えたら残りのありふれた n-gram は打ち切る。コーパスが大きくても検索時間が一定に収まる。
+
+        Args:
+            query: 現在のユーザー入力
+            k: 返す件数
+            max_postings: 走査する posting 数の上限
+
+        Returns:
+            類似度の高い順の例
+        """
+        terms = Counter(_bucket(g, self.n_buckets) for g in char_ngrams(query))
+        scores: Dict[int, float] = {}
+        starts, idf, docs, weights = self._starts, self._idf, self._docs, self._weights
+        budget = max_postings
+        for b in sorted(terms, key=lambda b: idf[b], reverse=True):
+            q_weight = (1.0 + math.log(terms[b])) * idf[b]
+            if q_weight == 0.0:
+                break
+            if budget <= 0 and scores:
+                break
+            begin, end = starts[b], starts[b + 1]
+            budget -= end - begin
+            for i in range(begin, end):
+                doc_id = docs[i]
+                scores[doc_id] = scores.get(doc_id, 0.0) + q_weight * weights[i]
+        results = []
+        for doc_id, score in heapq.nlargest(k, scores.items(), key=lambda item: item[1]):
+            doc = json.loads(bytes(self._blob[self._offsets[doc_id]:self._offsets[doc_id + 1]]))
+            results.append(Exemplar(prompt=doc["prompt"], reply=doc["reply"], context=doc["context"], score=score))
+        return results
+
+    def close(self) -> None:
+        for name in ("_starts", "_idf", "_docs", "_weights", "_offsets", "_blob"):
+            section = self.__dict__.pop(name, None)
+            if section is not None:
+                section.release()
+        self._mm.close()
+        self._file.close()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    from benchmark.build_benchmark_from_limitless_md import build_examples, iter_utterances_from_md
+
+    parser = argparse.ArgumentParser(description="Build the persona exemplar index from Limitless markdown")
+    parser.add_argument("--input", required=True, help="Path to limitless-knowledge.md")
+    parser.add_argument("--output", required=True, help="Output index path (e.g. data/exemplars.idx)")
+    parser.add_argument(
+        "--hijiri-names",
+        default="聖,Hijiri,福井聖",
+        help="Comma-separated speaker names that correspond to the persona owner",
+    )
+    parser.add_argument("--context-turns", type=int, default=1, help="Number of turns kept as context")
+    parser.add_argument("--buckets", type=int, default=DEFAULT_BUCKETS, help="Number of n-gram hash buckets")
+
+    args = parser.parse_args(argv)
+
+    md_text = Path(args.input).read_text(encoding="utf-8")
+    utterances = list(iter_utterances_from_md(md_text))
+    hijiri_names = [x.strip() for x in str(args.hijiri_names).split(",")]
+    examples = build_examples(utterances, hijiri_names=hijiri_names, context_turns=args.context_turns)
+
+    count = build_exemplar_index(examples, Path(args.output), n_buckets=args.buckets)
+
+    print(f"Utterances parsed: {len(utterances)}")
+    print(f"Exemplars indexed: {count}")
+    print(f"Wrote: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,164 @@
+"""冪等キーによる /chat の重複排除
+
+ブラウザや Next.js のルートが遅い /chat をやり直すと、同じ入力に2回応答を生成して
+会話履歴にも2回積んでしまう。同じ冪等キーのリクエストは
+- 元のリクエストがまだ実行中なら同じタスクの結果を待ち（生成は1回だけ）、
+- 終わったあとなら TTL 付きのキャッシュに残した結果をそのまま返す。
+
+待っている呼び出し元が全員いなくなってから linger_s 秒たっても次が来ないときだけ生成を止めるので、
+タイムアウトした1回目を切断してやり直しても、1回目の生成が続いてその結果が2回目に返る。
+失敗・キャンセルで終わった結果と、keep(結果) が False の結果は残さない（次のやり直しで改めて生成する）。
+
+同じキーに違う内容のリクエストが来たら IdempotencyConflict にする。
+イベントループのスレッドからだけ使う。
+
+    CLONEAI_IDEMPOTENCY_TTL_S=600          # 0 で結果を残さない（実行中の重複だけまとめる）
+    CLONEAI_IDEMPOTENCY_MAX_ENTRIES=4096
+    CLONEAI_IDEMPOTENCY_LINGER_S=2         # 呼び出し元が全員切断してから生成を止めるまで
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+from metrics import REGISTRY
+
+_results = REGISTRY.counter("cloneai_idempotency_requests_total", "Requests with an idempotency key by how they were served")
+_cached = REGISTRY.gauge("cloneai_idempotency_cached", "Completed results kept for idempotent replays")
+
+T = TypeVar("T")
+
+# run() の2つ目の戻り値
+NEW = "new"          # この呼び出しで実行した
+JOINED = "joined"    # 実行中の同じリクエストの結果を待った
+REPLAYED = "replayed"  # キャッシュに残っていた結果を返した
+
+
+class IdempotencyConflict(Exception):
+    """同じ冪等キーで内容の違うリクエストが来た"""
+
+
+@dataclass
+class _InFlight(Generic[T]):
+    task: "asyncio.Future[T]"
+    fingerprint: Hashable
+    waiters: int = 0
+    abandon: Optional[asyncio.TimerHandle] = None
+
+
+class IdempotencyCache(Generic[T]):
+    """実行中のタスクと、終わった結果（TTL と件数の上限付き）を冪等キーで引く"""
+    def __init__(
+        self,
+        ttl_s: float = 600.0,
+        max_entries: int = 4096,
+        linger_s: float = 2.0,
+        keep: Optional[Callable[[Any], bool]] = None,
+    ):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.linger_s = linger_s
+        # 終わった結果をキャッシュに残すか（None ならすべて残す）。実行中に待っていた呼び出し元には常に返す
+        self.keep = keep
+        self._in_flight: Dict[Hashable, _InFlight[T]] = {}
+        # key -> (期限, fingerprint, 結果)。古い順
+        self._done: "OrderedDict[Hashable, Tuple[float, Hashable, T]]" = OrderedDict()
+
+    @classmethod
+    def from_env(cls, keep: Optional[Callable[[Any], bool]] = None) -> "IdempotencyCache":
+        return cls(
+            ttl_s=float(os.getenv("CLONEAI_IDEMPOTENCY_TTL_S", "600")),
+            max_entries=int(os.getenv("CLONEAI_IDEMPOTENCY_MAX_ENTRIES", "4096")),
+            linger_s=float(os.getenv("CLONEAI_IDEMPOTENCY_LINGER_S", "2")),
+            keep=keep,
+        )
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    async def run(
+        self, key: Hashable, fingerprint: Hashable, factory: Callable[[], Awaitable[T]]
+    ) -> Tuple[T, str]:
+        """key の結果を返す。無ければ factory() を実行する。(結果, NEW / JOINED / REPLAYED) を返す
+
+        呼び出し元がキャンセルされても、ほかに待っている呼び出し元がいるか linger_s 秒以内に
+        同じキーで来れば実行は続ける。
+        """
+        hit = self._lookup(key)
+        if hit is not None:
+            if hit[0] != fingerprint:
+                raise IdempotencyConflict(key)
+            _results.inc(result=REPLAYED)
+            return hit[1], REPLAYED
+        entry = self._in_flight.get(key)
+        if entry is None:
+            entry = _InFlight(task=asyncio.ensure_future(factory()), fingerprint=fingerprint)
+            self._in_flight[key] = entry
+            entry.task.add_done_callback(lambda task: self._complete(key, entry))
+            how = NEW
+        elif entry.fingerprint != fingerprint:
+            raise IdempotencyConflict(key)
+        else:
+            how = JOINED
+        _results.inc(result=how)
+        entry.waiters += 1
+        if entry.abandon is not None:
+            entry.abandon.cancel()
+            entry.abandon = None
+        try:
+            return await asyncio.shield(entry.task), how
+        finally:
+            entry.waiters -= 1
+            if entry.waiters == 0 and not entry.task.done():
+                if self.linger_s > 0:
+                    entry.abandon = asyncio.get_running_loop().call_later(self.linger_s, self._abandon, entry)
+                else:
+                    entry.task.cancel()
+
+    @staticmethod
+    def _abandon(entry: _InFlight[T]) -> None:
+        entry.abandon = None
+        if entry.waiters == 0:
+            entry.task.cancel()
+
+    def _lookup(self, key: Hashable) -> Optional[Tuple[Hashable, T]]:
+        item = self._done.get(key)
+        if item is None:
+            return None
+        expires_at, fingerprint, result = item
+        if time.monotonic() >= expires_at:
+            del self._done[key]
+            _cached.set(len(self._done))
+            return None
+        return fingerprint, result
+
+    def _complete(self, key: Hashable, entry: _InFlight[T]) -> None:
+        if self._in_flight.get(key) is entry:
+            del self._in_flight[key]
+        if entry.abandon is not None:
+            entry.abandon.cancel()
+            entry.abandon = None
+        if entry.task.cancelled() or entry.task.exception() is not None or self.ttl_s <= 0:
+            return
+        result = entry.task.result()
+        if self.keep is not None and not self.keep(result):
+            _results.inc(result="not_kept")
+            return
+        self._done[key] = (time.monotonic() + self.ttl_s, entry.fingerprint, result)
+        self._done.move_to_end(key)
+        self._evict()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        # 期限は追加順に並ぶので、先頭から期限切れを落とし、そのあと件数の上限まで古いものを落とす
+        while self._done and (len(self._done) > self.max_entries or next(iter(self._done.values()))[0] <= now):
+            self._done.popitem(last=False)
+        _cached.set(len(self._done))
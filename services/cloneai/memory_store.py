@@ -0,0 +1,287 @@
+"""会話履歴の長期記憶（エピソード記憶と事実テーブル）
+
+MemoryManager は直近 max_history ターンしか保持しないため、それより古いターンは
+セッションごとのインデックスに追加しておき、入力に関連するものだけを呼び戻す。
+ユーザーが話した名前・予定・好みなどは事実として抽出し、入力に関係するものだけを注入する。
+埋め込みや抽出はバックグラウンドスレッドで行い、応答のレイテンシには影響させない。
+"""
+
+from __future__ import annotations
+
+import re
+import threading
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from retrieval import Document, Embedder, HybridRetriever, char_ngrams, normalize_text
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def background_executor() -> ThreadPoolExecutor:
+    """記憶の更新に使う共有スレッドプールを取得する"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cloneai-memory")
+    return _executor
+
+
+@dataclass
+class Episode:
+    turn: int
+    user: str
+    agent: str
+    timestamp: str
+    score: float = 0.0
+
+
+class EpisodicMemory:
+    """終了したターンをバックグラウンドで索引化し、関連する過去のターンを検索する"""
+    def __init__(self, embedder: Optional[Embedder] = None, executor: Optional[ThreadPoolExecutor] = None):
+        self._retriever = HybridRetriever(embedder=embedder)
+        self._executor = executor
+        self._pending: List[Future] = []
+        self._lock = threading.Lock()
+        # 索引とは別に (turn, user, agent, timestamp) を記録順に保持する（セッションの永続化用）
+        self._log: List[Tuple[int, str, str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._retriever)
+
+    def add_turn(self, turn: int, user_input: str, agent_response: str, timestamp: str) -> Future:
+        """ターンを索引に追加するジョブを投入する
+
+        Args:
+            turn: セッション内の通し番号（1始まり）
+            user_input: ユーザーの入力
+            agent_response: エージェントの応答
+            timestamp: ターンの時刻
+
+        Returns:
+            索引への追加が完了すると解決する Future
+        """
+        document = Document(
+            id=str(turn),
+            content=f"ユーザー: {user_input}\nエージェント: {agent_response}",
+            metadata={"turn": turn, "user": user_input, "agent": agent_response, "timestamp": timestamp},
+        )
+        executor = self._executor or background_executor()
+        future = executor.submit(self._retriever.add_documents, [document])
+        with self._lock:
+            self._log.append((turn, user_input, agent_response, timestamp))
+            self._pending = [f for f in self._pending if not f.done()]
+            self._pending.append(future)
+        return future
+
+    def turns(self, after: int = 0) -> List[Tuple[int, str, str, str]]:
+        """追加済みのターンを (turn, user, agent, timestamp) の記録順で返す
+
+        Args:
+            after: 指定した場合はこの番号より後のターンだけを返す（末尾から数えるので差分の大きさで済む）
+        """
+        with self._lock:
+            start = len(self._log)
+            while start > 0 and self._log[start - 1][0] > after:
+                start -= 1
+            return self._log[start:]
+
+    def restore(self, turns: List[Tuple[int, str, str, str]]) -> None:
+        """保存されたターン列に合わせる
+
+        手元のターン列が保存されたものの先頭と一致していれば差分だけを索引化し、
+        そうでなければ索引を作り直す。
+        """
+        local = self.turns()
+        if len(local) <= len(turns) and all(tuple(a) == tuple(b) for a, b in zip(local, turns)):
+            new_turns = turns[len(local):]
+        else:
+            self.clear()
+            new_turns = turns
+        for turn, user_input, agent_response, timestamp in new_turns:
+            self.add_turn(turn, user_input, agent_response, timestamp)
+
+    def search(self, query: str, k: int = 3, before_turn: Optional[int] = None) -> List[Episode]:
+        """入力に関連する過去のターンを返す
+
+        Args:
+            query: 現在のユーザー入力
+            k: 返す件数
+            before_turn: 指定した場合はこの番号より前のターンだけを対象にする
+                （直近の履歴ウィンドウとの重複を避けるため）
+
+        Returns:
+            関連度順のエピソード（索引化が済んだターンのみ）
+        """
+        limit = k
+        if before_turn is not None:
+            # 除外するターンが全部上位に来ても k 件残るよう、その数だけ多めに取る
+            with self._lock:
+                limit += sum(1 for turn, *_ in self._log if turn >= before_turn)
+        hits = self._retriever.search(query, k=limit)
+        episodes = []
+        for hit in hits:
+            meta = hit.document.metadata
+            if before_turn is not None and meta["turn"] >= before_turn:
+                continue
+            episodes.append(
+                Episode(
+                    turn=meta["turn"],
+                    user=meta["user"],
+                    agent=meta["agent"],
+                    timestamp=meta["timestamp"],
+                    score=hit.score,
+                )
+            )
+            if len(episodes) >= k:
+                break
+        return episodes
+
+    def clear(self) -> None:
+        """索引を空にする（実行中のジョブは古い索引に書き込まれて破棄される）"""
+        with self._lock:
+            self._retriever = HybridRetriever(embedder=self._retriever.embedder)
+            self._pending = []
+            self._log = []
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """投入済みの索引化ジョブの完了を待つ"""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout=timeout)
+
+
+# 事実のカテゴリ: (単一値か, 入力にこの語が含まれたら関連とみなす語)
+FACT_CATEGORIES: Dict[str, Tuple[bool, Tuple[str, ...]]] = {
+    "名前": (True, ("名前", "誰", "呼")),
+    "住んでいる場所": (True, ("住", "どこ", "家")),
+    "出身": (True, ("出身", "地元", "生まれ")),
+    "好きなもの": (False, ("好き", "ハマ", "趣味", "おすすめ")),
+    "苦手なもの": (False, ("嫌い", "苦手", "無理")),
+    "予定": (False, ("予定", "今日", "明日", "週末", "来週", "今度", "休み", "何する")),
+    "ペット": (False, ("ペット", "飼", "猫", "犬")),
+}
+
+_NOUN = r"[^\s、。！？!?,はがをもにでの]{1,15}"
+_FACT_PATTERNS: List[Tuple[str, "re.Pattern[str]"]] = [
+    ("名前", re.compile(r"名前は\s*(" + _NOUN + r"?)(?:です|だよ|だ|って|や|。|！|!|$)")),
+    ("名前", re.compile(r"(" + _NOUN + r")(?:と申します|っていいます|って言います|といいます|と言います)")),
+    ("住んでいる場所", re.compile(r"(" + _NOUN + r")に住んで")),
+    ("出身", re.compile(r"(" + _NOUN + r")(?:の)?出身")),
+    ("好きなもの", re.compile(r"(" + _NOUN + r")が(?:大)?好き")),
+    ("苦手なもの", re.compile(r"(" + _NOUN + r")が(?:嫌い|苦手)")),
+    ("ペット", re.compile(r"(" + _NOUN + r")を飼って")),
+    ("予定", re.compile(
+        r"((?:今日|明日|明後日|今夜|今週末|週末|来週|来月|今度|夏休み|春休み|冬休み)"
+        r"[^。！？!?]{0,30}?(?:予定|つもり|行く|いく|する|します))"
+    )),
+]
+
+# 質問（文末が ? か「か」「の」）と、相手（ペルソナ）についての文からは抽出しない。
+# 聖は既定のペルソナの呼び名
+_CLAUSE_RE = re.compile(r"[^。!?\n]+[。!?]*")
+_QUESTION_END_RE = re.compile(r"(?:\?|か|の)[。!\s]*$")
+_SECOND_PERSON_RE = re.compile(r"(?:君|きみ|あなた|あんた|お前|おまえ|聖)(?:は|の|って|も|が|こそ)")
+# 疑問詞を値にしない（「名前はなん」「どこに住んで」「何が好き」「今日は何する」）
+_INTERROGATIVE_RE = re.compile(r"^(?:なん|なに|どこ|どちら|どっち|だれ|いつ|どう|どれ|どんな|いくつ)|何|誰")
+
+
+@dataclass
+class Fact:
+    category: str
+    value: str
+    turn: int
+
+
+class RuleFactExtractor:
+    """ユーザーの発話から名前・予定・好みなどの事実をルールで抽出する"""
+    def extract(self, text: str) -> List[Tuple[str, str]]:
+        """発話から (カテゴリ, 値) の組を抽出する
+
+        Args:
+            text: ユーザーの発話
+
+        Returns:
+            抽出された事実のリスト（重複なし・出現順）
+        """
+        normalized = unicodedata.normalize("NFKC", text).strip()
+        clauses = [
+            c for c in _CLAUSE_RE.findall(normalized)
+            if not _QUESTION_END_RE.search(c) and not _SECOND_PERSON_RE.search(c)
+        ]
+        found: List[Tuple[str, str]] = []
+        for category, pattern in _FACT_PATTERNS:
+            for clause in clauses:
+                for m in pattern.finditer(clause):
+                    value = m.group(1).strip()
+                    if value and not _INTERROGATIVE_RE.search(value) and (category, value) not in found:
+                        found.append((category, value))
+        return found
+
+
+class FactStore:
+    """セッションごとの事実テーブル（カテゴリと値のn-gramで索引化）"""
+    def __init__(self):
+        self._facts: Dict[Tuple[str, str], Fact] = {}
+        self._by_gram: Dict[str, Set[Tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._facts)
+
+    def add(self, category: str, value: str, turn: int = 0) -> Fact:
+        """事実を追加する。同じ値は重複させず、単一値のカテゴリは最新の値で置き換える"""
+        single_valued = FACT_CATEGORIES.get(category, (False, ()))[0]
+        key = (category, normalize_text(value))
+        fact = Fact(category=category, value=value, turn=turn)
+        with self._lock:
+            if single_valued:
+                for old_key in [k for k in self._facts if k[0] == category and k != key]:
+                    self._remove(old_key)
+            self._facts[key] = fact
+            for gram in char_ngrams(value, (2,)) or [normalize_text(value)]:
+                self._by_gram.setdefault(gram, set()).add(key)
+        return fact
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        fact = self._facts.pop(key)
+        for gram in char_ngrams(fact.value, (2,)) or [normalize_text(fact.value)]:
+            keys = self._by_gram.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_gram[gram]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._facts.clear()
+            self._by_gram.clear()
+
+    def all(self) -> List[Fact]:
+        with self._lock:
+            return sorted(self._facts.values(), key=lambda f: f.turn)
+
+    def match(self, text: str, limit: int = 5) -> List[Fact]:
+        """入力に含まれる語（カテゴリの手がかり語・事実の値）に一致する事実だけを返す
+
+        Args:
+            text: 現在のユーザー入力
+            limit: 返す最大件数
+
+        Returns:
+            一致した事実（新しい順）
+        """
+        norm = normalize_text(text)
+        with self._lock:
+            matched = set()
+            for category, (_, cues) in FACT_CATEGORIES.items():
+                if any(cue in norm for cue in cues):
+                    matched.update(k for k in self._facts if k[0] == category)
+            for gram in set(char_ngrams(text, (2,))):
+                matched.update(self._by_gram.get(gram, ()))
+            facts = [self._facts[k] for k in matched]
+        facts.sort(key=lambda f: f.turn, reverse=True)
+        return facts[:limit]
@@ -0,0 +1,194 @@
+"""プロセス内のメトリクス（Prometheus テキスト形式で /metrics に出力する）
+
+外部ライブラリを使わない最小限の Counter / Gauge / Histogram。ラベルはキーワード引数で渡す。
+
+    from metrics import REGISTRY
+    decisions = REGISTRY.counter("cloneai_route_decisions_total", "Routing decisions")
+    decisions.inc(route="fast", reason="simple")
+"""
+
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# 秒単位のレイテンシ向けの既定のバケット
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+
+
+def _key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{v.replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: object) -> float:
+        with self._lock:
+            return self._values.get(_key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: Dict[LabelKey, float] = {}
+
+    def set(self, value: float, **labels: object) -> None:
+        with self._lock:
+            self._values[_key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: object) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: object) -> float:
+        with self._lock:
+            return self._values.get(_key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルごとに (バケットごとの件数, 合計, 件数)
+        self._series: Dict[LabelKey, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = _key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._series.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[index] += 1
+            self._series[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels: object) -> int:
+        with self._lock:
+            series = self._series.get(_key(labels))
+        return series[2] if series else 0
+
+    def quantile(self, q: float, **labels: object) -> Optional[float]:
+        """バケットから線形補間した分位点の推定値（観測が無ければ None）"""
+        with self._lock:
+            series = self._series.get(_key(labels))
+            if not series or series[2] == 0:
+                return None
+            counts, _, total = list(series[0]), series[1], series[2]
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for i, upper in enumerate(self.buckets + (math.inf,)):
+            if cumulative + counts[i] >= rank and counts[i] > 0:
+                if math.isinf(upper):
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / counts[i]
+            cumulative += counts[i]
+            lower = upper
+        return lower
+
+    def render(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for upper, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_value(upper)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """名前でメトリクスを登録・取得する（同じ名前なら同じオブジェクトを返す）"""
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, help_text: str, **kwargs) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help_text, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"metric {name} is already registered as a {metric.kind}")
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._get(Counter, name, help_text)  # type: ignore[return-value]
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._get(Gauge, name, help_text)  # type: ignore[return-value]
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help_text, buckets=buckets)  # type: ignore[return-value]
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,346 @@
+"""ペルソナレジストリ
+
+CLONEAI_PERSONA_DIR の JSON / YAML ファイルから複数のペルソナと生成パラメーターを読み込む。
+各ファイルは起動時に一度だけ検証し、変更できない共有テンプレート（全特徴のプロンプトと
+特徴インデックスを事前に構築したもの）にコンパイルする。セッションはこれを参照するだけなので、
+ペルソナごとのメモリはセッション数に比例して増えない。
+
+ファイルの形式（YAML も同じ構造。YAML の読み込みには PyYAML が必要）:
+
+    {
+        "id": "fukui_sho",                      # 省略時はファイル名
+        "name": "福井聖",
+        "description": "21歳の日本人大学生。...",
+        "traits": {"口癖": "たしかに..."},
+        "background": "...", "personality": "...", "speech_style": "...",
+        "knowledge_areas": ["..."], "values": ["..."],
+        "parameters": {"temperature": 1.0, ...}, # または "parameters_file": "../福井聖AIパラメーター.json"
+        "default": true                         # 既定のペルソナにする
+    }
+
+ディレクトリが無い場合やファイルに無い場合でも、組み込みの福井聖（create_yamada_taro_persona）を
+"fukui_sho" として登録する。組み込みのペルソナはモデルの既定のサンプリングと元の話し方のままで、
+CLONEAI_BUILTIN_PERSONA_PARAMS=1 のときだけ 福井聖AIパラメーター.json（temperature 1.41 や
+フォーマル度などの口調の指示）を使う。既存のセッションの振る舞いを黙って変えないため。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, Mapping, Optional
+
+from clone_agentAI import PersonaTemplate, create_yamada_taro_persona
+from retrieval import PersonaTraitIndex
+
+BUILTIN_PERSONA_ID = "fukui_sho"
+BUILTIN_PARAMETERS_PATH = Path(__file__).resolve().parent / "福井聖AIパラメーター.json"
+
+_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_TEXT_FIELDS = ("background", "personality", "speech_style")
+_LIST_FIELDS = ("knowledge_areas", "values")
+
+
+class PersonaConfigError(ValueError):
+    """ペルソナ定義ファイルの内容が不正"""
+
+    def __init__(self, source: str, message: str):
+        super().__init__(f"{source}: {message}")
+        self.source = source
+
+
+@dataclass(frozen=True)
+class GenerationParams:
+    """chat_param_test.py が出力する生成パラメーター（値の範囲も同じ）"""
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    presence_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    num_ctx: Optional[int] = None
+    repeat_penalty: Optional[float] = None
+    mirostat_mode: Optional[int] = None
+    max_tokens: Optional[int] = None
+    # 口調の指標（1-5）。サンプリングではなくプロンプトの話し方の指示に使う
+    jargon_level: Optional[int] = None
+    formality_level: Optional[int] = None
+    abstraction_level: Optional[int] = None
+
+    # 型注釈が無いのでフィールドではなくクラス属性になる
+    _RANGES = {
+        "temperature": (0.0, 2.0),
+        "top_p": (0.0, 1.0),
+        "presence_penalty": (-2.0, 2.0),
+        "frequency_penalty": (-2.0, 2.0),
+        "num_ctx": (256, 131072),
+        "repeat_penalty": (0.0, 3.0),
+        "mirostat_mode": (0, 2),
+        "max_tokens": (1, 32768),
+        "jargon_level": (1, 5),
+        "formality_level": (1, 5),
+        "abstraction_level": (1, 5),
+    }
+
+    @classmethod
+    def from_mapping(cls, data: Mapping[str, Any], source: str) -> "GenerationParams":
+        known = {f.name for f in fields(cls)}
+        unknown = sorted(set(data) - known)
+        if unknown:
+            raise PersonaConfigError(source, f"unknown parameters: {', '.join(unknown)}")
+        values: Dict[str, Any] = {}
+        for name, value in data.items():
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise PersonaConfigError(source, f"parameter {name!r} must be a number")
+            low, high = cls._RANGES[name]
+            if not low <= value <= high:
+                raise PersonaConfigError(source, f"parameter {name!r}={value} is outside [{low}, {high}]")
+            values[name] = value
+        return cls(**values)
+
+    def to_ollama_options(self) -> Dict[str, Any]:
+        """Ollama の options に渡す値（口調の指標は含めない）"""
+        mapping = (
+            ("temperature", "temperature"),
+            ("top_p", "top_p"),
+            ("presence_penalty", "presence_penalty"),
+            ("frequency_penalty", "frequency_penalty"),
+            ("num_ctx", "num_ctx"),
+            ("repeat_penalty", "repeat_penalty"),
+            ("mirostat_mode", "mirostat"),
+            ("max_tokens", "num_predict"),
+        )
+        return {option: getattr(self, name) for name, option in mapping if getattr(self, name) is not None}
+
+    def style_notes(self) -> List[str]:
+        notes = []
+        if self.jargon_level is not None:
+            notes.append(f"専門用語の使用: {self.jargon_level}/5")
+        if self.formality_level is not None:
+            notes.append(f"フォーマル度: {self.formality_level}/5")
+        if self.abstraction_level is not None:
+            notes.append(f"抽象度: {self.abstraction_level}/5（1は具体例中心）")
+        return notes
+
+
+class CompiledPersonaTemplate(PersonaTemplate):
+    """検証済みで変更できないペルソナ。全特徴のプロンプトは一度だけ組み立てる"""
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        object.__setattr__(self, "traits", MappingProxyType(dict(self.traits)))
+        object.__setattr__(self, "knowledge_areas", tuple(self.knowledge_areas))
+        object.__setattr__(self, "values", tuple(self.values))
+        object.__setattr__(self, "_entries", tuple(super().trait_entries()))
+        object.__setattr__(self, "_full_prompt", super().to_prompt())
+        object.__setattr__(self, "_frozen", True)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if getattr(self, "_frozen", False):
+            raise AttributeError(f"compiled persona is immutable (tried to set {name!r})")
+        object.__setattr__(self, name, value)
+
+    def trait_entries(self) -> List[str]:
+        return list(self._entries)
+
+    def to_prompt(self, selected_entries: Optional[List[str]] = None) -> str:
+        if selected_entries is None:
+            return self._full_prompt
+        return super().to_prompt(selected_entries)
+
+
+@dataclass(frozen=True)
+class CompiledPersona:
+    persona_id: str
+    template: CompiledPersonaTemplate
+    params: GenerationParams
+    trait_index: PersonaTraitIndex = field(repr=False, compare=False)
+    source: str = "<builtin>"
+
+    @property
+    def options(self) -> Dict[str, Any]:
+        return self.params.to_ollama_options()
+
+
+def compile_persona(data: Mapping[str, Any], source: str, default_id: Optional[str] = None) -> CompiledPersona:
+    """ペルソナ定義を検証してコンパイルする
+
+    Args:
+        data: ペルソナ定義（JSON / YAML を読み込んだ辞書）
+        source: エラーメッセージに使う読み込み元
+        default_id: "id" が無い場合に使う ID
+
+    Raises:
+        PersonaConfigError: 定義が不正な場合
+    """
+    if not isinstance(data, Mapping):
+        raise PersonaConfigError(source, "persona definition must be an object")
+    persona_id = data.get("id", default_id)
+    if not isinstance(persona_id, str) or not _ID_RE.match(persona_id):
+        raise PersonaConfigError(source, f"invalid persona id: {persona_id!r}")
+    for name in ("name", "description"):
+        if not isinstance(data.get(name), str) or not data[name].strip():
+            raise PersonaConfigError(source, f"{name!r} is required and must be a non-empty string")
+    for name in _TEXT_FIELDS:
+        if data.get(name) is not None and not isinstance(data[name], str):
+            raise PersonaConfigError(source, f"{name!r} must be a string")
+    for name in _LIST_FIELDS:
+        value = data.get(name)
+        if value is not None and (not isinstance(value, list) or not all(isinstance(v, str) for v in value)):
+            raise PersonaConfigError(source, f"{name!r} must be a list of strings")
+    traits = data.get("traits") or {}
+    if not isinstance(traits, Mapping):
+        raise PersonaConfigError(source, "'traits' must be an object")
+
+    params_data: Dict[str, Any] = {}
+    if data.get("parameters_file"):
+        params_path = Path(data["parameters_file"])
+        if not params_path.is_absolute() and source != "<builtin>":
+            params_path = Path(source).parent / params_path
+        try:
+            params_data.update(json.loads(params_path.read_text(encoding="utf-8")))
+        except (OSError, ValueError) as e:
+            raise PersonaConfigError(source, f"cannot read parameters_file {params_path}: {e}") from e
+    if data.get("parameters") is not None:
+        if not isinstance(data["parameters"], Mapping):
+            raise PersonaConfigError(source, "'parameters' must be an object")
+        params_data.update(data["parameters"])
+    params = GenerationParams.from_mapping(params_data, source)
+
+    speech_style = data.get("speech_style")
+    notes = params.style_notes()
+    if notes:
+        speech_style = "\n".join(filter(None, [speech_style, "、".join(notes)]))
+
+    template = CompiledPersonaTemplate(
+        name=data["name"].strip(),
+        description=data["description"].strip(),
+        traits={str(k): v for k, v in traits.items()},
+        background=data.get("background"),
+        personality=data.get("personality"),
+        speech_style=speech_style,
+        knowledge_areas=list(data.get("knowledge_areas") or []),
+        values=list(data.get("values") or []),
+    )
+    return CompiledPersona(
+        persona_id=persona_id,
+        template=template,
+        params=params,
+        trait_index=PersonaTraitIndex(template.trait_entries()),
+        source=source,
+    )
+
+
+def builtin_persona(with_parameters: Optional[bool] = None) -> CompiledPersona:
+    """組み込みの福井聖（create_yamada_taro_persona）
+
+    Args:
+        with_parameters: 福井聖AIパラメーター.json を使うか（Noneなら CLONEAI_BUILTIN_PERSONA_PARAMS=1 のとき）
+    """
+    if with_parameters is None:
+        with_parameters = os.getenv("CLONEAI_BUILTIN_PERSONA_PARAMS", "0") == "1"
+    persona = create_yamada_taro_persona()
+    data: Dict[str, Any] = {
+        "id": BUILTIN_PERSONA_ID,
+        "name": persona.name,
+        "description": persona.description,
+        "traits": persona.traits,
+        "background": persona.background,
+        "personality": persona.personality,
+        "speech_style": persona.speech_style,
+        "knowledge_areas": persona.knowledge_areas,
+        "values": persona.values,
+    }
+    if with_parameters and BUILTIN_PARAMETERS_PATH.exists():
+        data["parameters_file"] = str(BUILTIN_PARAMETERS_PATH)
+    return compile_persona(data, "<builtin>")
+
+
+def _read_definition(path: Path) -> Any:
+    text = path.read_text(encoding="utf-8")
+    if path.suffix == ".json":
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise PersonaConfigError(str(path), f"invalid JSON: {e}") from e
+    try:
+        import yaml  # type: ignore
+    except ImportError as e:
+        raise PersonaConfigError(str(path), "PyYAML is required to load YAML personas (pip install pyyaml)") from e
+    try:
+        return yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise PersonaConfigError(str(path), f"invalid YAML: {e}") from e
+
+
+class PersonaRegistry:
+    """ペルソナIDからコンパイル済みペルソナを引く（読み込み後は変更しない）"""
+    def __init__(self, personas: Iterable[CompiledPersona], default_id: Optional[str] = None):
+        self._personas: Dict[str, CompiledPersona] = {}
+        for persona in personas:
+            if persona.persona_id in self._personas:
+                raise PersonaConfigError(
+                    persona.source,
+                    f"duplicate persona id {persona.persona_id!r} (also in {self._personas[persona.persona_id].source})",
+                )
+            self._personas[persona.persona_id] = persona
+        if not self._personas:
+            raise ValueError("persona registry is empty")
+        self.default_id = default_id if default_id in self._personas else next(iter(self._personas))
+
+    def __len__(self) -> int:
+        return len(self._personas)
+
+    def __contains__(self, persona_id: str) -> bool:
+        return persona_id in self._personas
+
+    def ids(self) -> List[str]:
+        return list(self._personas)
+
+    def get(self, persona_id: Optional[str] = None) -> CompiledPersona:
+        """ペルソナを取得する（Noneなら既定のペルソナ）
+
+        Raises:
+            KeyError: 登録されていないIDの場合
+        """
+        return self._personas[persona_id or self.default_id]
+
+    @classmethod
+    def load_dir(cls, directory: Optional[Path], include_builtin: bool = True) -> "PersonaRegistry":
+        """ディレクトリ内の *.json / *.yaml / *.yml を読み込む
+
+        Raises:
+            PersonaConfigError: いずれかのファイルが不正な場合（起動時に気づけるよう、読み飛ばさない）
+        """
+        personas: List[CompiledPersona] = []
+        default_id: Optional[str] = None
+        if directory is not None and Path(directory).is_dir():
+            for path in sorted(Path(directory).iterdir()):
+                if path.suffix not in (".json", ".yaml", ".yml") or not path.is_file():
+                    continue
+                data = _read_definition(path)
+                persona = compile_persona(data, str(path), default_id=path.stem)
+                personas.append(persona)
+                if isinstance(data, Mapping) and data.get("default"):
+                    default_id = persona.persona_id
+        if include_builtin and all(p.persona_id != BUILTIN_PERSONA_ID for p in personas):
+            personas.insert(0, builtin_persona())
+        return cls(personas, default_id=default_id or (BUILTIN_PERSONA_ID if include_builtin else None))
+
+
+_registry: Optional[PersonaRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> PersonaRegistry:
+    """CLONEAI_PERSONA_DIR から読み込んだプロセス共有のレジストリ"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            directory = os.getenv("CLONEAI_PERSONA_DIR")
+            _registry = PersonaRegistry.load_dir(Path(directory) if directory else None)
+    return _registry
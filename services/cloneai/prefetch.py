@@ -0,0 +1,275 @@
+"""台本どおりのターンの応答を空いているときに先に生成しておく（プリフェッチ）
+
+実験のセッションは決まった台本のターン（clone_agentAI.test_mode の「こんにちは、自己紹介してください」など）で
+始まり、参加者はみな同じターンの生成をその場で待っている。そこでペルソナと条件（model_name。指定なしなら
+ルーターか既定のモデル）ごとに、台本を最初から最後まで通した会話をいくつか用意しておき、新しいセッションが
+台本どおりに話しかけてきたらその応答をすぐ返す。使った分はバックエンドが空いているときに補充する。
+
+- 1件は台本を1回通した会話（各ターンの応答と、あれば Ollama の context）。2ターン目以降の応答は前の応答に
+  依存するので、1つのセッションには最初に渡した1件の続きだけを使う。台本から外れたらそこからは普通に生成する。
+- 補充は background の優先度で1件ずつ、interactive の生成が実行中でも待ち中でもないときだけ行う。
+- 多様さ（variety、既定で有効）: 1件ごとに違う seed で生成し、用意した中からランダムに選んで渡す。
+  無効なら用意した順に渡す。
+- ペルソナのプロンプトが変わった（snapshot.persona_digest）会話と ttl_s を過ぎた会話は捨てる。
+- 台本の入力は前後の空白を除いて比べる。
+
+    CLONEAI_PREFETCH_POOL=0          # ペルソナ・条件ごとに用意しておく会話の数。0 で無効（既定）
+    CLONEAI_PREFETCH_SCRIPT=...      # 台本（JSON の文字列の配列）のファイル。無ければ DEFAULT_SCRIPT
+    CLONEAI_PREFETCH_VARIETY=1
+    CLONEAI_PREFETCH_TTL_S=3600
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from concurrency import BACKGROUND, INTERACTIVE
+from metrics import REGISTRY
+from snapshot import persona_digest
+
+_claims = REGISTRY.counter("cloneai_prefetch_claims_total", "Scripted turns by whether a prefetched reply was served")
+_runs = REGISTRY.counter("cloneai_prefetch_runs_total", "Prefetched conversations by outcome")
+_pool_gauge = REGISTRY.gauge("cloneai_prefetch_pool_size", "Prefetched conversations ready per persona and condition")
+
+DEFAULT_SCRIPT = ("こんにちは、自己紹介してください",)
+
+# (persona_id, model_name) -> 生成に使うエージェント。今は生成できない（バックエンドが無い）なら None
+AgentFactory = Callable[[str, Optional[str]], Optional[Any]]
+
+
+@dataclass
+class PrefetchedTurn:
+    message: str
+    reply: str
+    model_name: str
+    # このターンまでを表す Ollama の context（use_context のときだけ）
+    context: Optional[List[int]] = None
+    context_model: Optional[str] = None
+
+
+@dataclass
+class PrefetchedRun:
+    """台本を1回通した会話"""
+    turns: List[PrefetchedTurn]
+    persona_digest: str
+    created_at: float = field(default_factory=time.monotonic)
+
+
+def _normalize(message: str) -> str:
+    return message.strip()
+
+
+def load_script(path: Optional[str]) -> Tuple[str, ...]:
+    if not path:
+        return DEFAULT_SCRIPT
+    script = json.loads(Path(path).read_text(encoding="utf-8"))
+    if not isinstance(script, list) or not all(isinstance(m, str) and m.strip() for m in script):
+        raise ValueError(f"{path}: the prefetch script must be a JSON array of non-empty strings")
+    return tuple(script)
+
+
+class PrefetchService:
+    """ペルソナ・条件ごとの会話のプールと、それを補充するバックグラウンドのタスク（イベントループのスレッドから使う）"""
+    def __init__(
+        self,
+        make_agent: AgentFactory,
+        script: Sequence[str] = DEFAULT_SCRIPT,
+        pool_size: int = 3,
+        variety: bool = True,
+        ttl_s: float = 3600.0,
+        limiter: Any = None,
+        idle_poll_s: float = 1.0,
+        max_claims: int = 4096,
+    ):
+        if not script:
+            raise ValueError("the prefetch script is empty")
+        self.make_agent = make_agent
+        self.script = tuple(_normalize(m) for m in script)
+        self.pool_size = pool_size
+        self.variety = variety
+        self.ttl_s = ttl_s
+        # concurrency.AdaptiveLimiter。interactive の生成があるあいだは補充しない
+        self.limiter = limiter
+        self.idle_poll_s = idle_poll_s
+        self.max_claims = max_claims
+        self._pools: Dict[Tuple[str, Optional[str]], List[PrefetchedRun]] = {}
+        # 台本の途中のセッション -> 渡している会話
+        self._claims: "OrderedDict[str, PrefetchedRun]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, make_agent: AgentFactory, limiter: Any = None) -> Optional["PrefetchService"]:
+        """CLONEAI_PREFETCH_POOL が 0（既定）なら None"""
+        pool_size = int(os.getenv("CLONEAI_PREFETCH_POOL", "0"))
+        if pool_size <= 0:
+            return None
+        return cls(
+            make_agent,
+            script=load_script(os.getenv("CLONEAI_PREFETCH_SCRIPT")),
+            pool_size=pool_size,
+            variety=os.getenv("CLONEAI_PREFETCH_VARIETY", "1") != "0",
+            ttl_s=float(os.getenv("CLONEAI_PREFETCH_TTL_S", "3600")),
+            limiter=limiter,
+        )
+
+    def watch(self, persona_id: str, condition: Optional[str] = None) -> None:
+        """このペルソナ・条件のプールを用意し始める"""
+        self._pools.setdefault((persona_id, condition), [])
+
+    def ready(self, persona_id: str, condition: Optional[str] = None) -> int:
+        """すぐ渡せる会話の数"""
+        return len(self._pools.get((persona_id, condition), ()))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "pool_size": self.pool_size,
+            "script_turns": len(self.script),
+            "pools": [
+                {"persona_id": pid, "condition": condition, "ready": len(runs)}
+                for (pid, condition), runs in self._pools.items()
+            ],
+            "sessions_in_script": len(self._claims),
+        }
+
+    def claim(
+        self,
+        persona_id: str,
+        condition: Optional[str],
+        session_key: str,
+        agent: Any,
+        message: str,
+        priority: str = INTERACTIVE,
+    ) -> Optional[PrefetchedTurn]:
+        """このターンが台本どおりなら事前に生成した応答を返す（無ければ None で、普通に生成する）
+
+        参加者を待たせないためのものなので interactive のターンだけが使う。
+        """
+        position = agent.memory.turn_count
+        if priority != INTERACTIVE or position >= len(self.script) or _normalize(message) != self.script[position]:
+            self._claims.pop(session_key, None)
+            return None
+        if position == 0:
+            self.watch(persona_id, condition)
+            run = self._take(persona_id, condition, persona_digest(agent.persona.to_prompt()))
+            if run is None:
+                self._claims.pop(session_key, None)
+                _claims.inc(result="miss")
+                return None
+            self._claims[session_key] = run
+            self._claims.move_to_end(session_key)
+            while len(self._claims) > self.max_claims:
+                self._claims.popitem(last=False)
+        else:
+            run = self._claims.get(session_key)
+            if run is None or not self._continues(run, agent, position):
+                self._claims.pop(session_key, None)
+                return None
+        if position == len(self.script) - 1:
+            self._claims.pop(session_key, None)
+        _claims.inc(result="hit")
+        return run.turns[position]
+
+    @staticmethod
+    def _continues(run: PrefetchedRun, agent: Any, position: int) -> bool:
+        """セッションの履歴がこの会話のここまでと同じか（途中で台本から外れていないか）"""
+        history = agent.memory.conversation_history[-position:]
+        if len(history) != position:
+            return False
+        return all(h["user"] == t.message and h["agent"] == t.reply for h, t in zip(history, run.turns))
+
+    def _take(self, persona_id: str, condition: Optional[str], digest: str) -> Optional[PrefetchedRun]:
+        pool = self._pools.get((persona_id, condition))
+        if not pool:
+            return None
+        now = time.monotonic()
+        fresh = [r for r in pool if r.persona_digest == digest and now - r.created_at <= self.ttl_s]
+        if len(fresh) != len(pool):
+            _runs.inc(len(pool) - len(fresh), outcome="expired")
+        run = None
+        if fresh:
+            run = fresh.pop(random.randrange(len(fresh)) if self.variety else 0)
+        self._pools[(persona_id, condition)] = fresh
+        self._publish(persona_id, condition)
+        return run
+
+    def idle(self) -> bool:
+        if self.limiter is None:
+            return True
+        return self.limiter.in_flight_of(INTERACTIVE) == 0 and self.limiter.queue_depth_of(INTERACTIVE) == 0
+
+    def _next_to_fill(self) -> Optional[Tuple[str, Optional[str]]]:
+        """いちばん足りていないプール"""
+        short = [(len(runs), key) for key, runs in self._pools.items() if len(runs) < self.pool_size]
+        return min(short, key=lambda item: item[0])[1] if short else None
+
+    async def fill_once(self) -> bool:
+        """空いていれば足りないプールに1件補充する。生成したら True"""
+        key = self._next_to_fill()
+        if key is None or not self.idle():
+            return False
+        run = await self._generate(*key)
+        if run is None:
+            return False
+        self._pools.setdefault(key, []).append(run)
+        self._publish(*key)
+        return True
+
+    async def _generate(self, persona_id: str, condition: Optional[str]) -> Optional[PrefetchedRun]:
+        agent = await asyncio.to_thread(self.make_agent, persona_id, condition)
+        if agent is None:
+            return None
+        client = agent.client
+        client.priority = BACKGROUND
+        if self.variety:
+            client.options = {**(client.options or {}), "seed": random.randrange(2 ** 31)}
+        turns: List[PrefetchedTurn] = []
+        for message in self.script:
+            reply = await agent.aprocess_input(message)
+            if agent.last_error or agent.last_degraded:
+                _runs.inc(outcome="failed")
+                return None
+            turns.append(PrefetchedTurn(
+                message=message,
+                reply=reply,
+                model_name=client.model_name,
+                context=list(client.context) if client.context else None,
+                context_model=client.context_model,
+            ))
+        _runs.inc(outcome="stored")
+        return PrefetchedRun(turns=turns, persona_digest=persona_digest(agent.persona.to_prompt()))
+
+    async def run(self) -> None:
+        """プールを補充し続ける（start() がタスクにする）"""
+        while True:
+            try:
+                filled = await self.fill_once()
+            except Exception as exc:
+                print(f"警告: 応答のプリフェッチに失敗しました: {exc}")
+                _runs.inc(outcome="failed")
+                filled = False
+            if not filled:
+                await asyncio.sleep(self.idle_poll_s)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _publish(self, persona_id: str, condition: Optional[str]) -> None:
+        _pool_gauge.set(self.ready(persona_id, condition), persona=persona_id, condition=condition or "default")
@@ -0,0 +1,346 @@
+"""ライフログ知識のハイブリッド検索（文字n-gram BM25 + ベクトル検索）
+
+Limitless の書き起こしは分かち書きが不安定な日本語で固有名詞も多いため、
+埋め込みだけでは取りこぼしが出る。文字バイグラム/トライグラムの転置インデックスを
+ベクトルストアと同時に増分構築し、両方の順位を Reciprocal Rank Fusion で統合する。
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import re
+import threading
+import unicodedata
+import zlib
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_UTTERANCE_RE = re.compile(r"^(?:[-*]\s+)?\*\*(?P<speaker>[^*]+)\*\*:\s*(?P<content>.+?)\s*$")
+
+
+def normalize_text(text: str) -> str:
+    """NFKC正規化・小文字化し、書き起こしの区切り空白を取り除く"""
+    return _WHITESPACE_RE.sub("", unicodedata.normalize("NFKC", text).lower())
+
+
+def char_ngrams(text: str, sizes: Sequence[int] = (2, 3)) -> List[str]:
+    """正規化済みテキストから文字n-gramを列挙する
+
+    Args:
+        text: 対象テキスト
+        sizes: 生成するn-gramの長さ
+
+    Returns:
+        n-gramのリスト（重複あり）。1文字しかない場合はその文字を返す
+    """
+    norm = normalize_text(text)
+    grams: List[str] = []
+    for n in sizes:
+        grams.extend(norm[i:i + n] for i in range(len(norm) - n + 1))
+    if not grams and norm:
+        grams.append(norm)
+    return grams
+
+
+@dataclass
+class Document:
+    id: str
+    content: str
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class SearchHit:
+    document: Document
+    score: float
+    lexical_rank: Optional[int] = None
+    vector_rank: Optional[int] = None
+
+
+class Embedder:
+    """テキストを埋め込みベクトルに変換する抽象基底クラス"""
+    def embed(self, text: str) -> List[float]:
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def embed_many(self, texts: Sequence[str]) -> List[List[float]]:
+        return [self.embed(text) for text in texts]
+
+
+class HashingEmbedder(Embedder):
+    """文字n-gramの特徴ハッシュによる軽量な埋め込み（モデル不要・決定的）"""
+    def __init__(self, dim: int = 256, sizes: Sequence[int] = (2, 3)):
+        self.dim = dim
+        self.sizes = tuple(sizes)
+
+    def embed(self, text: str) -> List[float]:
+        vec = [0.0] * self.dim
+        for gram in char_ngrams(text, self.sizes):
+            h = zlib.crc32(gram.encode("utf-8"))
+            vec[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        return _l2_normalize(vec)
+
+
+class OllamaEmbedder(Embedder):
+    """Ollama の埋め込みAPIを使うエンベッダー"""
+    def __init__(self, model_name: Optional[str] = None):
+        self.model_name = model_name or os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
+
+    def embed(self, text: str) -> List[float]:
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts: Sequence[str]) -> List[List[float]]:
+        try:
+            import ollama  # type: ignore  # 起動を速くするため最初に使うときに読み込む
+        except Exception as e:  # pragma: no cover
+            raise RuntimeError("ollama パッケージが見つかりません") from e
+        response = ollama.embed(model=self.model_name, input=list(texts))
+        return [_l2_normalize(list(v)) for v in response.embeddings]
+
+
+def create_embedder(kind: Optional[str] = None) -> Embedder:
+    """環境変数 CLONEAI_EMBEDDER（hashing / ollama）に応じてエンベッダーを作る"""
+    kind = (kind or os.getenv("CLONEAI_EMBEDDER", "hashing")).lower()
+    if kind == "ollama":
+        return OllamaEmbedder()
+    return HashingEmbedder()
+
+
+def _l2_normalize(vec: List[float]) -> List[float]:
+    norm = math.sqrt(sum(v * v for v in vec))
+    if norm == 0.0:
+        return vec
+    return [v / norm for v in vec]
+
+
+def _dot(a: Sequence[float], b: Sequence[float]) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+class LexicalIndex:
+    """文字n-gramの転置インデックスとBM25スコアリング"""
+    def __init__(self, k1: float = 1.5, b: float = 0.75, sizes: Sequence[int] = (2, 3)):
+        self.k1 = k1
+        self.b = b
+        self.sizes = tuple(sizes)
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_lengths: List[int] = []
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, text: str) -> int:
+        """文書を追加し、その内部番号を返す"""
+        doc_idx = len(self.doc_lengths)
+        grams = char_ngrams(text, self.sizes)
+        for gram, tf in Counter(grams).items():
+            self.postings.setdefault(gram, {})[doc_idx] = tf
+        self.doc_lengths.append(len(grams))
+        self._total_length += len(grams)
+        return doc_idx
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[int, float]]:
+        """BM25スコア上位k件の (内部番号, スコア) を返す"""
+        n_docs = len(self.doc_lengths)
+        if n_docs == 0:
+            return []
+        avg_len = self._total_length / n_docs or 1.0
+        scores: Dict[int, float] = {}
+        for gram, qtf in Counter(char_ngrams(query, self.sizes)).items():
+            posting = self.postings.get(gram)
+            if not posting:
+                continue
+            df = len(posting)
+            idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+            for doc_idx, tf in posting.items():
+                norm = self.k1 * (1.0 - self.b + self.b * self.doc_lengths[doc_idx] / avg_len)
+                scores[doc_idx] = scores.get(doc_idx, 0.0) + qtf * idf * tf * (self.k1 + 1.0) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+class VectorStore:
+    """正規化済みベクトルのコサイン類似度検索（全走査または候補集合のみ）"""
+    def __init__(self):
+        self.vectors: List[List[float]] = []
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def add(self, vector: Sequence[float]) -> int:
+        self.vectors.append(list(vector))
+        return len(self.vectors) - 1
+
+    def search(
+        self,
+        query_vector: Sequence[float],
+        k: int = 10,
+        candidates: Optional[Iterable[int]] = None,
+    ) -> List[Tuple[int, float]]:
+        indices = range(len(self.vectors)) if candidates is None else candidates
+        scored = [(idx, _dot(query_vector, self.vectors[idx])) for idx in indices]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:k]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """複数の順位リストを Reciprocal Rank Fusion で統合する
+
+    Args:
+        rankings: 内部番号の順位リスト（良い順）の列
+        k: RRFの平滑化定数
+
+    Returns:
+        (内部番号, 融合スコア) の降順リスト
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_idx in enumerate(ranking, start=1):
+            fused[doc_idx] = fused.get(doc_idx, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridRetriever:
+    """語彙検索とベクトル検索を組み合わせたリトリーバー
+
+    語彙インデックスで候補を絞り込んでからベクトルスコアを計算するため、
+    文書数が増えても埋め込みとの内積計算は prefilter_size 件に収まる。
+    """
+    def __init__(
+        self,
+        embedder: Optional[Embedder] = None,
+        prefilter_size: int = 100,
+        rrf_k: int = 60,
+    ):
+        self.embedder = embedder or create_embedder()
+        self.prefilter_size = prefilter_size
+        self.rrf_k = rrf_k
+        self.documents: List[Document] = []
+        self.lexical = LexicalIndex()
+        self.vectors = VectorStore()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def add_documents(self, documents: Sequence[Document]) -> None:
+        """文書を語彙インデックスとベクトルストアに同時に追加する"""
+        if not documents:
+            return
+        embeddings = self.embedder.embed_many([doc.content for doc in documents])
+        with self._lock:
+            for doc, vector in zip(documents, embeddings):
+                self.lexical.add(doc.content)
+                self.vectors.add(vector)
+                self.documents.append(doc)
+
+    def search(self, query: str, k: int = 5) -> List[SearchHit]:
+        """クエリに関連する文書を検索する
+
+        Args:
+            query: 検索クエリ
+            k: 返す件数
+
+        Returns:
+            融合スコア順の検索結果
+        """
+        if not self.documents or not query.strip():
+            return []
+        query_vector = self.embedder.embed(query)
+        with self._lock:
+            lexical_hits = self.lexical.search(query, self.prefilter_size)
+            # 語彙で十分な候補が得られない場合（言い換え等）は全走査にフォールバック
+            candidates = [idx for idx, _ in lexical_hits] if len(lexical_hits) >= k else None
+            vector_hits = self.vectors.search(query_vector, self.prefilter_size, candidates)
+            documents = list(self.documents)
+
+        lexical_ranks = {idx: rank for rank, (idx, _) in enumerate(lexical_hits, start=1)}
+        vector_ranks = {idx: rank for rank, (idx, _) in enumerate(vector_hits, start=1)}
+        fused = reciprocal_rank_fusion(
+            [[idx for idx, _ in lexical_hits], [idx for idx, _ in vector_hits]],
+            k=self.rrf_k,
+        )
+        return [
+            SearchHit(
+                document=documents[idx],
+                score=score,
+                lexical_rank=lexical_ranks.get(idx),
+                vector_rank=vector_ranks.get(idx),
+            )
+            for idx, score in fused[:k]
+        ]
+
+
+def load_knowledge_markdown(path: Path, max_utterances: int = 8) -> List[Document]:
+    """limitless-knowledge.md を見出し単位・発話数上限付きのチャンクに分割する
+
+    Args:
+        path: Markdownファイルのパス
+        max_utterances: 1チャンクに含める発話の最大数
+
+    Returns:
+        チャンク化された文書のリスト
+    """
+    documents: List[Document] = []
+    title = ""
+    section = ""
+    lines: List[str] = []
+
+    def flush() -> None:
+        for start in range(0, len(lines), max_utterances):
+            window = lines[start:start + max_utterances]
+            heading = section or title
+            content = "\n".join(([heading] if heading else []) + window)
+            documents.append(
+                Document(
+                    id=f"chunk_{len(documents) + 1:05d}",
+                    content=content,
+                    metadata={"source": str(path), "title": title, "section": section},
+                )
+            )
+        lines.clear()
+
+    for raw_line in Path(path).read_text(encoding="utf-8").splitlines():
+        line = raw_line.strip()
+        if line.startswith("#"):
+            flush()
+            level = len(line) - len(line.lstrip("#"))
+            heading = line.lstrip("#").strip()
+            if level == 1:
+                title, section = heading, ""
+            elif level >= 3:
+                section = heading
+            continue
+        m = _UTTERANCE_RE.match(line)
+        if m:
+            lines.append(f"{m.group('speaker').strip()}: {m.group('content')}")
+    flush()
+    return documents
+
+
+class PersonaTraitIndex:
+    """ペルソナの特徴エントリを一度だけ索引化し、入力に関連する上位k件を選ぶ"""
+    def __init__(self, entries: Sequence[str], embedder: Optional[Embedder] = None):
+        self.entries = list(entries)
+        self._retriever = HybridRetriever(embedder=embedder, prefilter_size=max(1, len(self.entries)))
+        self._retriever.add_documents(
+            [Document(id=str(i), content=entry) for i, entry in enumerate(self.entries)]
+        )
+
+    def select(self, query: str, k: int = 8) -> List[str]:
+        """入力に関連するエントリを元の並び順のまま返す
+
+        Args:
+            query: 現在のユーザー入力
+            k: 選ぶエントリ数
+
+        Returns:
+            選ばれたエントリのリスト
+        """
+        hits = self._retriever.search(query, k=k)
+        order = sorted(int(hit.document.id) for hit in hits)
+        return [self.entries[i] for i in order]
@@ -0,0 +1,157 @@
+"""入力に応じて小さい高速モデルと大きいモデルを振り分けるルーター
+
+挨拶や短い相づちは高速モデルに、理由や比較を尋ねる長めの質問は大きいモデルに送る。
+大きいモデルの実行待ちが深いとき、または直近のレイテンシから SLO を超えると予測されるときは
+高速モデルに落とす。振り分けの理由とルートごとのレイテンシは metrics.REGISTRY に出力する。
+
+    CLONEAI_FAST_MODEL=gemma3:1b
+    CLONEAI_LARGE_MODEL=gemma3:4b       # 設定するとルーターが有効になる
+    CLONEAI_ROUTER_SLO_MS=4000
+    CLONEAI_ROUTER_MAX_LARGE_QUEUE=2
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional
+
+from deadline import Deadline
+from metrics import REGISTRY
+
+FAST = "fast"
+LARGE = "large"
+
+# clone_agentAI._build_prompt が挨拶として検出する語にいくつか加えたもの
+GREETING_KEYWORDS = ("こんにちは", "おはよう", "こんばんは", "初めまして", "はじめまして", "よろしく", "やあ")
+# 考える必要がある質問の手がかり
+HARD_KEYWORDS = (
+    "なぜ", "なんで", "どうして", "理由", "比較", "違い", "説明", "詳しく", "どう思", "教えて",
+    "メリット", "デメリット", "方法", "やり方", "why", "how", "explain", "compare",
+)
+
+_decisions = REGISTRY.counter("cloneai_route_decisions_total", "Model routing decisions by route and reason")
+_latency = REGISTRY.histogram("cloneai_route_latency_seconds", "Generation latency by route")
+_in_flight = REGISTRY.gauge("cloneai_route_in_flight", "Generations currently running per route")
+
+
+@dataclass(frozen=True)
+class InputFeatures:
+    chars: int
+    is_greeting: bool
+    is_question: bool
+    hard_cues: int
+
+    @classmethod
+    def of(cls, user_input: str) -> "InputFeatures":
+        text = user_input.strip()
+        lower = text.lower()
+        return cls(
+            chars=len(text),
+            is_greeting=any(k in lower for k in GREETING_KEYWORDS),
+            is_question="?" in text or "？" in text,
+            hard_cues=sum(1 for k in HARD_KEYWORDS if k in lower),
+        )
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    route: str
+    model: str
+    reason: str
+
+
+@dataclass
+class RouterConfig:
+    fast_model: str = "gemma3:1b"
+    large_model: str = "gemma3:4b"
+    slo_ms: float = 4000.0
+    max_large_queue: int = 2
+    # これより短く手がかりの無い入力は高速モデルで十分とみなす
+    short_chars: int = 25
+
+    @classmethod
+    def from_env(cls) -> Optional["RouterConfig"]:
+        """CLONEAI_LARGE_MODEL が設定されていなければ None（ルーター無効）"""
+        large = os.getenv("CLONEAI_LARGE_MODEL")
+        if not large:
+            return None
+        return cls(
+            fast_model=os.getenv("CLONEAI_FAST_MODEL") or os.getenv("CLONEAI_OLLAMA_MODEL", "gemma3:1b"),
+            large_model=large,
+            slo_ms=float(os.getenv("CLONEAI_ROUTER_SLO_MS", "4000")),
+            max_large_queue=int(os.getenv("CLONEAI_ROUTER_MAX_LARGE_QUEUE", "2")),
+        )
+
+
+class ModelRouter:
+    """プロセスで共有するルーター（実行中の数とレイテンシの指数移動平均をルートごとに持つ）"""
+    def __init__(self, config: RouterConfig, ewma_alpha: float = 0.2, probe_interval_s: float = 10.0):
+        self.config = config
+        self.ewma_alpha = ewma_alpha
+        # SLO で落とし続けると大きいモデルの推定が更新されないので、この間隔で1件は通して測り直す
+        self.probe_interval_s = probe_interval_s
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, int] = {FAST: 0, LARGE: 0}
+        self._ewma_s: Dict[str, Optional[float]] = {FAST: None, LARGE: None}
+        self._last_started: Dict[str, float] = {FAST: float("-inf"), LARGE: float("-inf")}
+
+    def in_flight(self, route: str) -> int:
+        with self._lock:
+            return self._in_flight[route]
+
+    def predicted_latency_ms(self, route: str) -> Optional[float]:
+        """直近のレイテンシ × (待っている数 + 1)。まだ観測が無ければ None"""
+        with self._lock:
+            ewma = self._ewma_s[route]
+            queued = self._in_flight[route]
+        if ewma is None:
+            return None
+        return ewma * 1000.0 * (queued + 1)
+
+    def route(self, user_input: str, deadline: Optional[Deadline] = None) -> RouteDecision:
+        features = InputFeatures.of(user_input)
+        if features.hard_cues == 0 and (features.is_greeting or features.chars <= self.config.short_chars):
+            return self._decide(FAST, "simple")
+        if self.in_flight(LARGE) >= self.config.max_large_queue:
+            return self._decide(FAST, "queue")
+        predicted = self.predicted_latency_ms(LARGE)
+        if deadline is not None and predicted is not None and predicted > deadline.remaining_s() * 1000.0:
+            # リクエストの締め切りまでに大きいモデルが終わりそうにない
+            return self._decide(FAST, "deadline")
+        if predicted is not None and predicted > self.config.slo_ms:
+            with self._lock:
+                probe_due = time.monotonic() - self._last_started[LARGE] >= self.probe_interval_s
+            if not probe_due:
+                return self._decide(FAST, "slo")
+            return self._decide(LARGE, "probe")
+        return self._decide(LARGE, "hard" if features.hard_cues else "long")
+
+    def _decide(self, route: str, reason: str) -> RouteDecision:
+        _decisions.inc(route=route, reason=reason)
+        model = self.config.fast_model if route == FAST else self.config.large_model
+        return RouteDecision(route=route, model=model, reason=reason)
+
+    @contextmanager
+    def track(self, decision: RouteDecision) -> Iterator[None]:
+        """生成の間、実行中の数を数えて終了時にレイテンシを記録する"""
+        with self._lock:
+            self._in_flight[decision.route] += 1
+            self._last_started[decision.route] = time.monotonic()
+        _in_flight.inc(route=decision.route)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._in_flight[decision.route] -= 1
+                prev = self._ewma_s[decision.route]
+                self._ewma_s[decision.route] = (
+                    elapsed if prev is None else prev + self.ewma_alpha * (elapsed - prev)
+                )
+            _in_flight.dec(route=decision.route)
+            _latency.observe(elapsed, route=decision.route)
@@ -0,0 +1,195 @@
+"""複数ワーカーで共有するセッションストア（SQLite WAL）
+
+clone_server の `_sessions` はプロセスごとの辞書なので、uvicorn --workers N や
+複数のサーバープロセスで動かすと別のワーカーが会話履歴を見られない。
+CLONEAI_SESSION_DB を設定すると MemoryManager の状態をこのストアに保存し、
+各リクエストの前にバージョンだけを確認して、他のワーカーが更新していれば読み直す。
+
+状態は短いキーの JSON を zlib で圧縮して保存する。書き込みは楽観的排他制御で、
+読み込んだときのバージョンが変わっていれば StaleSessionError になる。
+長期記憶のターン（状態の "e"）は会話の長さだけ増えるので別のテーブルに1ターン1行で置き、
+保存のたびには新しいターンだけを書き込む。
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+FORMAT_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    model_name TEXT,
+    state BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    session_id TEXT NOT NULL,
+    turn INTEGER NOT NULL,
+    turn_data TEXT NOT NULL,
+    PRIMARY KEY (session_id, turn)
+);
+"""
+
+
+class StaleSessionError(Exception):
+    """保存しようとした状態が、他のワーカーの更新より古い"""
+
+    def __init__(self, session_id: str, expected_version: int):
+        super().__init__(f"session {session_id!r} was modified (expected version {expected_version})")
+        self.session_id = session_id
+        self.expected_version = expected_version
+
+
+@dataclass
+class SessionRecord:
+    session_id: str
+    version: int
+    model_name: Optional[str]
+    # None のときは呼び出し側が既に同じバージョンを持っている
+    state: Optional[Dict[str, Any]]
+
+
+def encode_state(state: Dict[str, Any]) -> bytes:
+    payload = json.dumps({"v": FORMAT_VERSION, **state}, ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(payload.encode("utf-8"), 6)
+
+
+def decode_state(blob: bytes) -> Dict[str, Any]:
+    state = json.loads(zlib.decompress(blob).decode("utf-8"))
+    version = state.pop("v", None)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"unsupported session state format: {version}")
+    return state
+
+
+class SessionStore:
+    """セッションIDごとに MemoryManager の状態とバージョンを保存する"""
+    def __init__(self, path: Path, busy_timeout_ms: int = 5000):
+        self.path = Path(path)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッドをまたいで使えないのでスレッドごとに開く
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=self.busy_timeout_ms / 1000.0)
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, session_id: str, known_version: Optional[int] = None) -> Optional[SessionRecord]:
+        """セッションを読み込む
+
+        Args:
+            session_id: セッションID
+            known_version: 呼び出し側が持っているバージョン。一致すれば状態の展開を省く
+
+        Returns:
+            保存されていなければ None
+        """
+        conn = self._conn()
+        # 状態と長期記憶のターンを同じ時点のものとして読む
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute(
+                "SELECT version, model_name, CASE WHEN version = ? THEN NULL ELSE state END "
+                "FROM sessions WHERE session_id = ?",
+                (known_version if known_version is not None else -1, session_id),
+            ).fetchone()
+            if row is None:
+                return None
+            version, model_name, blob = row
+            state = None
+            if blob is not None:
+                state = decode_state(blob)
+                episodes = conn.execute(
+                    "SELECT turn, turn_data FROM episodes WHERE session_id = ? ORDER BY turn", (session_id,)
+                ).fetchall()
+                if episodes:
+                    state["e"] = state.get("e", []) + [[turn, *json.loads(data)] for turn, data in episodes]
+        finally:
+            conn.rollback()
+        return SessionRecord(session_id=session_id, version=version, model_name=model_name, state=state)
+
+    def save(
+        self,
+        session_id: str,
+        state: Dict[str, Any],
+        expected_version: int,
+        model_name: Optional[str] = None,
+        episodes_after: int = 0,
+    ) -> int:
+        """状態を保存して新しいバージョンを返す
+
+        Args:
+            session_id: セッションID
+            state: MemoryManager.to_state(episodes_after=...) の戻り値
+            expected_version: 読み込んだときのバージョン（新規セッションは 0）
+            model_name: セッションで使っているモデル名
+            episodes_after: 保存済みの長期記憶のターンのうち残すもの（この番号まで）。
+                state の "e" はこれより後のターンで、保存済みのそれより後のターンと置き換える
+
+        Raises:
+            StaleSessionError: 他のワーカーが先に更新していた場合
+        """
+        state = dict(state)
+        episodes = state.pop("e", None)
+        blob = encode_state(state)
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            if expected_version == 0:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO sessions (session_id, version, model_name, state, updated_at) "
+                    "VALUES (?, 1, ?, ?, ?)",
+                    (session_id, model_name, blob, now),
+                )
+            else:
+                cur = conn.execute(
+                    "UPDATE sessions SET version = version + 1, model_name = ?, state = ?, updated_at = ? "
+                    "WHERE session_id = ? AND version = ?",
+                    (model_name, blob, now, session_id, expected_version),
+                )
+            if cur.rowcount != 1:
+                raise StaleSessionError(session_id, expected_version)
+            if episodes is not None:
+                conn.execute(
+                    "DELETE FROM episodes WHERE session_id = ? AND turn > ?", (session_id, episodes_after)
+                )
+                conn.executemany(
+                    "INSERT INTO episodes (session_id, turn, turn_data) VALUES (?, ?, ?)",
+                    [
+                        (session_id, turn, json.dumps(rest, ensure_ascii=False, separators=(",", ":")))
+                        for turn, *rest in episodes
+                    ],
+                )
+        return expected_version + 1
+
+    def delete(self, session_id: str) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM episodes WHERE session_id = ?", (session_id,))
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
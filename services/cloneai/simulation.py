@@ -0,0 +1,235 @@
+"""Ollama を使わない性能評価用のシミュレーションバックエンド
+
+実機で記録した Ollama のタイミング（load / prompt_eval / eval）から、最初のトークンまでの
+遅延とトークンごとの間隔の対数正規分布を当てはめ、その分布に従って非同期にトークンを出す。
+スレッドを占有しないので、シミュレーションモードでもサーバーの同時実行性能をそのまま測れる。
+
+タイミングの記録は CLONEAI_TIMING_LOG を設定して実際の Ollama で会話すると JSONL に追記される。
+    python simulation.py --input timings.jsonl --output sim_profile.json
+で当てはめたプロファイルは CLONEAI_SIM_PROFILE で読み込める。
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from clone_agentAI import LLMClient
+
+_NAME_RE = re.compile(r"^# ペルソナ設定:\s*(?P<name>.+)$", re.MULTILINE)
+_CATCHPHRASE_RE = re.compile(r"^- 口癖:\s*(?P<value>.+)$", re.MULTILINE)
+_TRAIT_RE = re.compile(r"^- (?P<key>[^:：\n]{1,30})[:：]\s*(?P<value>.+)$", re.MULTILINE)
+_DESCRIPTION_RE = re.compile(r"^## 基本情報\n(?P<value>.+)$", re.MULTILINE)
+_INPUT_MARKER = "## 現在の入力"
+_TRAIT_HEADERS = ("## 個人的特徴", "## この話題に関連する特徴")
+_INSTRUCTIONS_MARKER = "## 指示"
+
+
+@dataclass
+class LatencyModel:
+    """最初のトークンまでの遅延とトークン間隔の対数正規分布（単位: 秒）"""
+    first_token_mu: float = math.log(0.6)
+    first_token_sigma: float = 0.3
+    token_interval_mu: float = math.log(0.04)
+    token_interval_sigma: float = 0.2
+    prompt_eval_per_char: float = 0.0
+    samples: int = 0
+
+    def sample_first_token(self, prompt_chars: int = 0, rng: Optional[random.Random] = None) -> float:
+        rng = rng or random
+        return rng.lognormvariate(self.first_token_mu, self.first_token_sigma) + prompt_chars * self.prompt_eval_per_char
+
+    def sample_token_interval(self, rng: Optional[random.Random] = None) -> float:
+        rng = rng or random
+        return rng.lognormvariate(self.token_interval_mu, self.token_interval_sigma)
+
+    @classmethod
+    def fit(cls, records: Iterable[Dict[str, Any]]) -> "LatencyModel":
+        """Ollama のタイミング記録から分布を当てはめる
+
+        Args:
+            records: load_duration / prompt_eval_duration / eval_count / eval_duration（ナノ秒）を持つ辞書
+
+        Returns:
+            当てはめた LatencyModel（記録が無い場合は既定値）
+        """
+        recs = list(records)
+        model = cls()
+        # prompt長に比例する評価時間は1文字あたりの中央値で近似し、残りを固定の遅延として当てはめる
+        per_char = sorted(
+            rec["prompt_eval_duration"] / 1e9 / rec["prompt_chars"]
+            for rec in recs
+            if rec.get("prompt_chars") and rec.get("prompt_eval_duration")
+        )
+        if per_char:
+            model.prompt_eval_per_char = per_char[len(per_char) // 2]
+        first_logs: List[float] = []
+        interval_logs: List[float] = []
+        for rec in recs:
+            first = ((rec.get("load_duration") or 0) + (rec.get("prompt_eval_duration") or 0)) / 1e9
+            if first > 0:
+                fixed = first - (rec.get("prompt_chars") or 0) * model.prompt_eval_per_char
+                first_logs.append(math.log(max(1e-3, fixed)))
+            count, duration = rec.get("eval_count") or 0, rec.get("eval_duration") or 0
+            if count > 0 and duration > 0:
+                interval_logs.append(math.log(duration / 1e9 / count))
+        if first_logs:
+            model.first_token_mu, model.first_token_sigma = _mean_std(first_logs)
+        if interval_logs:
+            model.token_interval_mu, model.token_interval_sigma = _mean_std(interval_logs)
+        model.samples = max(len(first_logs), len(interval_logs))
+        return model
+
+    @classmethod
+    def load(cls, path: Path) -> "LatencyModel":
+        return cls(**json.loads(Path(path).read_text(encoding="utf-8")))
+
+    def save(self, path: Path) -> None:
+        Path(path).write_text(json.dumps(asdict(self), indent=2), encoding="utf-8")
+
+
+def _mean_std(values: Sequence[float]) -> Tuple[float, float]:
+    mean = sum(values) / len(values)
+    var = sum((v - mean) ** 2 for v in values) / max(1, len(values) - 1)
+    return mean, math.sqrt(var)
+
+
+def default_latency_model() -> LatencyModel:
+    """CLONEAI_SIM_PROFILE があればそれを、なければ既定の分布を使う"""
+    profile = os.getenv("CLONEAI_SIM_PROFILE")
+    if profile and Path(profile).exists():
+        return LatencyModel.load(Path(profile))
+    return LatencyModel()
+
+
+def _persona_section(prompt: str) -> str:
+    """ペルソナ設定の部分（特徴の節の次の「## 」の見出しまで）
+
+    後ろに続くユーザーについての事実や記憶も「- キー: 値」の箇条書きなので、ペルソナの特徴として読まないよう除く。
+    """
+    for header in _TRAIT_HEADERS:
+        start = prompt.find(header)
+        if start >= 0:
+            end = prompt.find("\n## ", start + len(header))
+            return prompt if end < 0 else prompt[:end]
+    end = prompt.find(_INSTRUCTIONS_MARKER)
+    return prompt[:end] if end >= 0 else ""
+
+
+def compose_reply(prompt: str) -> str:
+    """プロンプトに書かれたペルソナ設定から、そのペルソナらしい定型応答を組み立てる"""
+    persona_section = _persona_section(prompt)
+    name_m = _NAME_RE.search(prompt)
+    name = name_m.group("name").strip() if name_m else "俺"
+    catch_m = _CATCHPHRASE_RE.search(persona_section)
+    catchphrase = catch_m.group("value").strip() if catch_m else "まあ、そうだね..."
+    user_input = prompt.rsplit(_INPUT_MARKER, 1)[-1].strip() if _INPUT_MARKER in prompt else prompt[-200:]
+
+    if "自己紹介" in user_input or "はじめまして" in user_input or "初めまして" in user_input:
+        desc_m = _DESCRIPTION_RE.search(prompt)
+        description = desc_m.group("value").strip() if desc_m else ""
+        return f"{catchphrase} {name}です。{description}よろしくな！"
+
+    best: Optional[Tuple[int, str, str]] = None
+    for m in _TRAIT_RE.finditer(persona_section):
+        key, value = m.group("key").strip(), m.group("value").strip()
+        overlap = sum(1 for i in range(len(key) - 1) if key[i:i + 2] in user_input)
+        if overlap and (best is None or overlap > best[0]):
+            best = (overlap, key, value)
+    if best is not None:
+        return f"{catchphrase} {best[1]}やったら、{best[2]}かな。そっちはどうなん？"
+    return f"{catchphrase} それはおもろい話やな。もうちょっと詳しく聞かせてや。"
+
+
+def tokenize_reply(text: str, chars_per_token: int = 2) -> List[str]:
+    return [text[i:i + chars_per_token] for i in range(0, len(text), chars_per_token)]
+
+
+class SimulatedLLMClient(LLMClient):
+    """レイテンシ分布に従って非同期にトークンを出すシミュレーションクライアント"""
+    def __init__(
+        self,
+        model_name: str = "gemma3:1b",
+        latency: Optional[LatencyModel] = None,
+        speed: float = 1.0,
+        seed: Optional[int] = None,
+    ):
+        self.model_name = model_name
+        self.latency = latency or default_latency_model()
+        # speed > 1 で記録より速く（0 で待ち時間なし）
+        self.speed = speed
+        self._rng = random.Random(seed)
+
+    def _schedule(self, prompt: str) -> Iterator[Tuple[float, str]]:
+        """(待ち時間, トークン) の列を生成する"""
+        scale = 0.0 if self.speed <= 0 else 1.0 / self.speed
+        tokens = tokenize_reply(compose_reply(prompt))
+        for i, token in enumerate(tokens):
+            if i == 0:
+                delay = self.latency.sample_first_token(len(prompt), self._rng)
+            else:
+                delay = self.latency.sample_token_interval(self._rng)
+            yield delay * scale, token
+
+    def generate(self, prompt: str) -> str:
+        """同期版（CLI用）。サーバーからは agenerate / astream を使う"""
+        parts = []
+        for delay, token in self._schedule(prompt):
+            time.sleep(delay)
+            parts.append(token)
+        return "".join(parts)
+
+    async def agenerate(self, prompt: str) -> str:
+        parts = []
+        async for token in self.astream(prompt):
+            parts.append(token)
+        return "".join(parts)
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        for delay, token in self._schedule(prompt):
+            await asyncio.sleep(delay)
+            yield token
+
+
+def _read_records(path: Path) -> List[Dict[str, Any]]:
+    records = []
+    with Path(path).open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Fit the simulation latency profile from recorded Ollama timings")
+    parser.add_argument("--input", required=True, help="JSONL written via CLONEAI_TIMING_LOG")
+    parser.add_argument("--output", required=True, help="Output profile JSON (use with CLONEAI_SIM_PROFILE)")
+
+    args = parser.parse_args(argv)
+
+    model = LatencyModel.fit(_read_records(Path(args.input)))
+    model.save(Path(args.output))
+
+    print(f"Samples: {model.samples}")
+    print(
+        f"First token median: {math.exp(model.first_token_mu) * 1000:.0f} ms (sigma={model.first_token_sigma:.2f})"
+    )
+    print(
+        f"Token interval median: {math.exp(model.token_interval_mu) * 1000:.1f} ms (sigma={model.token_interval_sigma:.2f})"
+    )
+    print(f"Wrote: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
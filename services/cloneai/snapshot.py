@@ -0,0 +1,165 @@
+"""セッションのスナップショット（再起動やキャッシュからの追い出しのあとに続きから再開する）
+
+CLONEAI_SNAPSHOT_DIR を設定すると、clone_server はターンのたびにセッションの状態を
+1セッション1ファイルで書き出し、プロセスに無いセッションへの次のリクエストで読み戻す。
+
+保存するのは MemoryManager.to_state()（履歴・ユーザーについての事実・長期記憶）と、
+Ollama の /api/generate が返した context（ここまでの会話のトークン列）。context があれば
+再開後の最初のターンもペルソナと履歴を評価し直さず、新しい部分だけを送れる
+（OllamaClient.use_context、CLONEAI_OLLAMA_CONTEXT=1 のとき）。
+context はモデルとペルソナのプロンプトに結び付いているので、どちらかが変わっていれば使わない。
+
+ファイルの形式（リトルエンディアン）:
+
+    "CLSN" | 形式のバージョン u8 | フラグ u8 | 予約 u16 | 状態の長さ u32 | 状態
+    （フラグに HAS_CONTEXT があれば）トークン数 u32 | 長さ u32 | zlib(u32 のトークン列)
+
+状態は session_store と同じく短いキーの JSON を zlib で圧縮したもの。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import struct
+import tempfile
+import time
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from metrics import REGISTRY
+from session_store import decode_state, encode_state
+
+_restores = REGISTRY.counter("cloneai_snapshot_restores_total", "Sessions restored from a snapshot by whether the backend context was reused")
+_bytes = REGISTRY.histogram(
+    "cloneai_snapshot_bytes", "Size of written session snapshots", buckets=(1e3, 4e3, 16e3, 64e3, 256e3, 1e6)
+)
+
+MAGIC = b"CLSN"
+FORMAT_VERSION = 1
+HAS_CONTEXT = 0x01
+_HEADER = struct.Struct("<4sBBHI")
+_CONTEXT_HEADER = struct.Struct("<II")
+
+
+class SnapshotError(ValueError):
+    """スナップショットのファイルが壊れているか、読めない形式"""
+
+
+@dataclass
+class SessionSnapshot:
+    # MemoryManager.to_state() の戻り値
+    state: Dict[str, Any]
+    model_name: Optional[str] = None
+    # ペルソナのプロンプトのハッシュ（persona_digest）。context がどのペルソナで作られたか
+    persona_digest: Optional[str] = None
+    # Ollama の context とそれを作ったモデル
+    context: Optional[List[int]] = None
+    context_model: Optional[str] = None
+    # 保存したときの session_store のバージョン（使っていなければ None）
+    store_version: Optional[int] = None
+    saved_at: float = field(default_factory=time.time)
+
+    def to_bytes(self) -> bytes:
+        meta = {
+            "s": self.state,
+            "m": self.model_name,
+            "p": self.persona_digest,
+            "cm": self.context_model,
+            "sv": self.store_version,
+            "at": self.saved_at,
+        }
+        state_blob = encode_state(meta)
+        flags = HAS_CONTEXT if self.context else 0
+        out = [_HEADER.pack(MAGIC, FORMAT_VERSION, flags, 0, len(state_blob)), state_blob]
+        if self.context:
+            tokens = zlib.compress(struct.pack(f"<{len(self.context)}I", *self.context), 6)
+            out.append(_CONTEXT_HEADER.pack(len(self.context), len(tokens)))
+            out.append(tokens)
+        return b"".join(out)
+
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> "SessionSnapshot":
+        try:
+            magic, version, flags, _, state_len = _HEADER.unpack_from(blob, 0)
+            if magic != MAGIC:
+                raise SnapshotError("not a session snapshot")
+            if version > FORMAT_VERSION:
+                raise SnapshotError(f"unsupported snapshot version {version}")
+            offset = _HEADER.size
+            meta = decode_state(blob[offset:offset + state_len])
+            offset += state_len
+            context = None
+            if flags & HAS_CONTEXT:
+                count, tokens_len = _CONTEXT_HEADER.unpack_from(blob, offset)
+                offset += _CONTEXT_HEADER.size
+                context = list(struct.unpack(f"<{count}I", zlib.decompress(blob[offset:offset + tokens_len])))
+        except (struct.error, zlib.error, ValueError) as exc:
+            if isinstance(exc, SnapshotError):
+                raise
+            raise SnapshotError(str(exc)) from exc
+        return cls(
+            state=meta.get("s") or {},
+            model_name=meta.get("m"),
+            persona_digest=meta.get("p"),
+            context=context,
+            context_model=meta.get("cm"),
+            store_version=meta.get("sv"),
+            saved_at=meta.get("at") or 0.0,
+        )
+
+
+def persona_digest(persona_prompt: str) -> str:
+    return hashlib.sha1(persona_prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def record_restore(context_reused: bool) -> None:
+    _restores.inc(context="reused" if context_reused else "none")
+
+
+class SnapshotStore:
+    """ディレクトリに1セッション1ファイルで置く（書き込みは一時ファイルからの置き換えで原子的）"""
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> Optional["SnapshotStore"]:
+        directory = os.getenv("CLONEAI_SNAPSHOT_DIR")
+        return cls(Path(directory)) if directory else None
+
+    def path_for(self, session_id: str) -> Path:
+        # session_id は "persona/session" のように / を含むことがある
+        return self.directory / f"{hashlib.sha1(session_id.encode('utf-8')).hexdigest()}.snap"
+
+    def save(self, session_id: str, snapshot: SessionSnapshot) -> int:
+        """書き出したバイト数を返す"""
+        blob = snapshot.to_bytes()
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(blob)
+            os.replace(tmp, self.path_for(session_id))
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        _bytes.observe(len(blob))
+        return len(blob)
+
+    def load(self, session_id: str) -> Optional[SessionSnapshot]:
+        """無ければ None。壊れたファイルは消して None"""
+        path = self.path_for(session_id)
+        try:
+            blob = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            return SessionSnapshot.from_bytes(blob)
+        except SnapshotError:
+            path.unlink(missing_ok=True)
+            return None
+
+    def delete(self, session_id: str) -> None:
+        self.path_for(session_id).unlink(missing_ok=True)
@@ -1,11 +1,27 @@
-"""Test fixtures and path setup for Limitless API client tests."""
+"""Test fixtures and path setup for the cloneAI service tests."""
 
 from __future__ import annotations
 
+import math
 import sys
 from pathlib import Path
 
+import pytest
+
 ROOT_DIR = Path(__file__).resolve().parents[1]
 SRC_DIR = ROOT_DIR / "src"
-if str(SRC_DIR) not in sys.path:
-    sys.path.insert(0, str(SRC_DIR))
+for path in (SRC_DIR, ROOT_DIR):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+
+@pytest.fixture
+def fast_simulation(tmp_path, monkeypatch):
+    """Near-instant simulated generations, with clone_server forced into simulation mode."""
+    import clone_server
+    from simulation import LatencyModel
+
+    profile = tmp_path / "fast.json"
+    LatencyModel(first_token_mu=math.log(1e-4), token_interval_mu=math.log(1e-5)).save(profile)
+    monkeypatch.setenv("CLONEAI_SIM_PROFILE", str(profile))
+    monkeypatch.setattr(clone_server, "_backend_check", (float("inf"), False))
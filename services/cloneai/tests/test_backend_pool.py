@@ -0,0 +1,123 @@
+import socket
+import time
+
+import pytest
+
+from backend_pool import BackendPool, NoHealthyBackendError
+from benchmark.fake_ollama import FakeOllamaConfig, serve
+
+
+def static_probe(models):
+    """Probe stub: host -> loaded models, or an exception to simulate a dead endpoint."""
+    def probe(endpoint):
+        result = models[endpoint.host]
+        if isinstance(result, Exception):
+            raise result
+        return set(result)
+    return probe
+
+
+def make_pool(models, **kwargs) -> BackendPool:
+    pool = BackendPool(list(models), probe=static_probe(models), **kwargs)
+    pool.check_all()
+    return pool
+
+
+def test_prefers_least_loaded_endpoint_with_model_loaded() -> None:
+    pool = make_pool({"http://a:1": ["gemma3:1b"], "http://b:1": ["gemma3:4b"], "http://c:1": ["gemma3:1b"]})
+
+    with pool.lease("gemma3:1b") as first:
+        assert first.host in ("http://a:1", "http://c:1")
+        second = pool.select("gemma3:1b")
+    assert second.host != first.host and second.has_model("gemma3:1b")
+    assert pool.select("gemma3:4b").host == "http://b:1"
+
+
+def test_pins_sessions_to_one_endpoint() -> None:
+    pool = make_pool({"http://a:1": ["m"], "http://b:1": ["m"]})
+
+    pinned = pool.select("m", session_key="s1")
+    with pool.lease("m", session_key="other"), pool.lease("m", session_key="other2"):
+        assert pool.select("m", session_key="s1") is pinned
+
+
+def test_ejects_failing_endpoint_and_readmits_after_health_check() -> None:
+    models = {"http://a:1": ["m"], "http://b:1": ["m"]}
+    pool = make_pool(models, max_failures=2, eject_s=60)
+    bad = pool.select("m", session_key="s")
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            with pool.lease("m", session_key="s"):
+                raise ConnectionError("refused")
+
+    assert not bad.healthy
+    assert all(pool.select("m", session_key="s") is not bad for _ in range(3))
+    assert pool.check(bad) and bad.healthy
+
+
+def test_failed_health_check_ejects_and_empty_pool_raises() -> None:
+    pool = make_pool({"http://a:1": OSError("down")})
+
+    assert not pool.any_healthy()
+    with pytest.raises(NoHealthyBackendError):
+        pool.select("m")
+
+
+def _unused_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_chat_fails_over_between_real_endpoints() -> None:
+    server = serve("127.0.0.1", 0, FakeOllamaConfig(token_ms=0.1, prompt_eval_ms=0.1, reply_tokens=3))
+    server.start_background()
+    try:
+        dead = f"http://127.0.0.1:{_unused_port()}"
+        pool = BackendPool([dead, server.base_url])
+        assert pool.check_all() == 1
+        assert pool.snapshot()[0]["healthy"] is False
+
+        # The dead endpoint comes back into rotation once its ejection expires; chat() retries elsewhere
+        pool.endpoints[0].healthy = True
+        pool.endpoints[0].ewma_s = 0.0
+        resp = pool.chat("s", model="gemma3:1b", messages=[{"role": "user", "content": "こんにちは"}])
+
+        assert len(resp.message.content) == 3
+        assert pool.select("gemma3:1b", session_key="s").host == server.base_url
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_streamed_connection_errors_fail_over_and_eject() -> None:
+    server = serve("127.0.0.1", 0, FakeOllamaConfig(token_ms=0.1, prompt_eval_ms=0.1, reply_tokens=3))
+    server.start_background()
+    try:
+        dead = f"http://127.0.0.1:{_unused_port()}"
+        pool = BackendPool([dead, server.base_url], max_failures=1)
+        messages = [{"role": "user", "content": "こんにちは"}]
+
+        chunks = list(pool.chat("s", model="gemma3:1b", messages=messages, stream=True))
+
+        assert chunks and chunks[-1].done
+        dead_state, live_state = pool.snapshot()
+        assert dead_state["healthy"] is False and dead_state["loaded_models"] == []
+        assert live_state["loaded_models"] == ["gemma3:1b"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_error_responses_do_not_mark_the_endpoint_healthy_or_the_model_loaded() -> None:
+    pool = make_pool({"http://a:1": []}, max_failures=1)
+    endpoint = pool.endpoints[0]
+    # Ejected earlier and now back on trial
+    endpoint.healthy, endpoint.ejected_until = False, time.monotonic() - 1
+
+    with pytest.raises(RuntimeError):
+        with pool.lease("missing"):
+            raise RuntimeError("model 'missing' not found")
+
+    assert not endpoint.healthy and not endpoint.has_model("missing")
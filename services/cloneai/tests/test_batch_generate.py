@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+from benchmark.batch_generate import BatchItem, completed_hashes, item_hash, parse_item, run_batch, seed_context
+from clone_agentAI import AIPersonaAgent, create_yamada_taro_persona
+
+
+def test_hash_ignores_id_and_covers_generation_settings() -> None:
+    a = parse_item({"id": "a", "turns": ["やあ"]}, 1)
+    b = parse_item({"id": "b", "turns": ["やあ"]}, 2)
+
+    assert item_hash(a, "p", "m", "full") == item_hash(b, "p", "m", "full")
+    assert item_hash(a, "p", "m", "full") != item_hash(a, "p", "other", "full")
+    assert item_hash(a, "p", "m", "full", "simulation") != item_hash(a, "p", "m", "full", "ollama")
+
+
+def test_completed_hashes_skip_errors_and_torn_lines(tmp_path) -> None:
+    out = tmp_path / "out.jsonl"
+    out.write_text(
+        json.dumps({"hash": "ok"}) + "\n" + json.dumps({"hash": "bad", "error": "x"}) + "\n" + '{"hash": "tor',
+        encoding="utf-8",
+    )
+
+    assert completed_hashes(out) == {"ok"}
+
+
+def test_seed_context_pairs_user_and_persona_lines() -> None:
+    agent = AIPersonaAgent(create_yamada_taro_persona(), simulation_mode=True)
+    context = "友達: 久しぶり\n友達: 元気？\n福井聖: おう、元気やで\n友達: 週末なにしてた？"
+
+    assert seed_context(agent, context, ["福井聖"]) == 1
+    assert agent.memory.conversation_history[0]["user"] == "久しぶり\n元気？"
+
+
+def test_run_batch_resumes(fast_simulation, tmp_path) -> None:
+    out = tmp_path / "out.jsonl"
+    items = [
+        BatchItem("c1", ["はじめまして！", "好きな食べ物は？"], "", None, {}),
+        BatchItem("p1", ["週末なにしてた？"], "友達: 久しぶり\n福井聖: おう", None, {"reference": "筋トレ"}),
+    ]
+
+    first = asyncio.run(run_batch(items[:1], out, "gemma3:1b", True, "selective", [], 2))
+    second = asyncio.run(run_batch(items, out, "gemma3:1b", True, "selective", [], 2))
+
+    assert first == (1, 0, 0) and second == (1, 0, 1)
+    records = [json.loads(line) for line in out.read_text(encoding="utf-8").splitlines()]
+    assert [r["id"] for r in records] == ["c1", "p1"]
+    assert len(records[0]["replies"]) == 2 and records[1]["reference"] == "筋トレ"
+    assert all(reply["latency_ms"] >= 0 for r in records for reply in r["replies"])
+
+
+def test_simulated_results_do_not_count_as_done_for_a_real_run(fast_simulation, tmp_path, monkeypatch) -> None:
+    out = tmp_path / "out.jsonl"
+    items = [BatchItem("c1", ["はじめまして！"], "", None, {})]
+
+    assert asyncio.run(run_batch(items, out, "gemma3:1b", True, "selective", [], 1)) == (1, 0, 0)
+    assert asyncio.run(run_batch(items, out, "gemma3:1b", True, "selective", [], 1)) == (0, 0, 1)
+    # Ollama is not running here, so the real run is attempted and fails instead of being skipped
+    monkeypatch.setenv("OLLAMA_HOST", "http://127.0.0.1:9")
+    completed, failed, skipped = asyncio.run(run_batch(items, out, "gemma3:1b", False, "selective", [], 1))
+    assert skipped == 0 and completed + failed == 1
+
+
+def test_refuses_to_fall_back_to_simulation_without_simulate(tmp_path, monkeypatch) -> None:
+    import benchmark.batch_generate as batch_generate
+
+    monkeypatch.setattr(batch_generate, "check_ollama_available", lambda *args: False)
+    monkeypatch.setattr(batch_generate, "cassette_replay_enabled", lambda: False)
+    source = tmp_path / "in.jsonl"
+    source.write_text(json.dumps({"turns": ["やあ"]}) + "\n", encoding="utf-8")
+
+    assert batch_generate.main(["--input", str(source), "--output", str(tmp_path / "out.jsonl")]) == 1
+    assert not (tmp_path / "out.jsonl").exists()
@@ -0,0 +1,130 @@
+import asyncio
+import time
+
+import pytest
+
+from cassette import RecordedMessage, RecordedResponse
+from clone_agentAI import AIPersonaAgent, OllamaClient, create_yamada_taro_persona
+from clone_server import ClientDisconnected, _run_while_connected
+
+
+class SlowStreamTransport:
+    """Streams one chunk every `interval_s` and records how far the consumer got."""
+
+    def __init__(self, chunks: int = 50, interval_s: float = 0.01):
+        self.chunks = chunks
+        self.interval_s = interval_s
+        self.produced = 0
+        self.closed = False
+
+    def chat(self, model, messages, options=None, stream=False):
+        assert stream, "cancellable generations must stream"
+        return self._stream(model)
+
+    def _stream(self, model):
+        try:
+            for _ in range(self.chunks):
+                time.sleep(self.interval_s)
+                self.produced += 1
+                yield RecordedResponse(model=model, message=RecordedMessage("あ"), done=False)
+            yield RecordedResponse(model=model, message=RecordedMessage(""), eval_count=self.chunks)
+        finally:
+            self.closed = True
+
+
+def test_cancelling_agenerate_closes_backend_stream() -> None:
+    client = OllamaClient()
+    client.transport = SlowStreamTransport()
+
+    async def scenario() -> None:
+        task = asyncio.create_task(client.agenerate("こんにちは"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    assert client.transport.closed
+    assert client.transport.produced < client.transport.chunks
+
+
+def test_streamed_generation_returns_full_reply() -> None:
+    client = OllamaClient()
+    client.transport = SlowStreamTransport(chunks=3, interval_s=0)
+
+    assert asyncio.run(client.agenerate("こんにちは")) == "あああ"
+
+
+def test_cancelled_turn_is_not_written_to_memory() -> None:
+    agent = AIPersonaAgent(create_yamada_taro_persona(), simulation_mode=True)
+
+    async def scenario() -> None:
+        task = asyncio.create_task(agent.aprocess_input("こんにちは"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert agent.memory.turn_count == 0
+    assert agent.get_thought_process()[-1]["content"].startswith("呼び出し元が切断")
+
+
+class FakeRequest:
+    def __init__(self, disconnect_after: int):
+        self.polls = 0
+        self.disconnect_after = disconnect_after
+
+    async def is_disconnected(self) -> bool:
+        self.polls += 1
+        return self.polls > self.disconnect_after
+
+
+def test_run_while_connected_cancels_work_on_disconnect(monkeypatch) -> None:
+    monkeypatch.setattr("clone_server._DISCONNECT_POLL_S", 0.01)
+    cancelled = []
+
+    async def work() -> str:
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return "never"
+
+    async def fast() -> str:
+        return "done"
+
+    with pytest.raises(ClientDisconnected):
+        asyncio.run(_run_while_connected(FakeRequest(disconnect_after=2), work()))
+    assert cancelled == [True]
+    assert asyncio.run(_run_while_connected(FakeRequest(disconnect_after=0), fast())) == "done"
+
+
+def test_prompt_is_built_off_the_event_loop() -> None:
+    class BlockingRetriever:
+        """Stands in for an Ollama embedding call made while searching."""
+
+        def search(self, query, k=3):
+            time.sleep(0.2)
+            return []
+
+    agent = AIPersonaAgent(create_yamada_taro_persona(), retriever=BlockingRetriever(), episodic_memory=False)
+    agent.client.transport = SlowStreamTransport(chunks=1, interval_s=0.0)
+
+    async def scenario() -> int:
+        ticks = 0
+
+        async def ticker() -> None:
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await agent.aprocess_input("最近どう？")
+        task.cancel()
+        return ticks
+
+    assert asyncio.run(scenario()) >= 10
@@ -0,0 +1,82 @@
+import time
+
+import pytest
+
+from cassette import Cassette, CassetteMiss, CassetteTransport, RecordedMessage, RecordedResponse
+
+
+def fake_stream(model, messages, options=None, stream=False, **kwargs):
+    for token in ["こん", "にち", "は"]:
+        time.sleep(0.01)
+        yield RecordedResponse(model=model, message=RecordedMessage(token), done=False)
+    yield RecordedResponse(
+        model=model, message=RecordedMessage(""), done=True, prompt_eval_count=12, eval_count=3, eval_duration=30_000_000
+    )
+
+
+MESSAGES = [{"role": "user", "content": "やあ"}]
+
+
+def test_record_then_replay_returns_same_reply_and_timings(tmp_path):
+    path = tmp_path / "run.cassette.jsonl.gz"
+    recorder = CassetteTransport(Cassette(path), mode="record", inner=fake_stream)
+    recorded = recorder.chat(model="gemma3:1b", messages=MESSAGES)
+    assert recorded.message.content == "こんにちは"
+
+    player = CassetteTransport(Cassette(path), mode="replay", speed="fast")
+    replayed = player.chat(model="gemma3:1b", messages=MESSAGES)
+    assert replayed.message.content == "こんにちは"
+    assert replayed.eval_count == 3 and replayed.prompt_eval_count == 12
+
+    chunks = [c.message.content for c in player.chat(model="gemma3:1b", messages=MESSAGES, stream=True)]
+    assert "".join(chunks) == "こんにちは"
+
+
+def test_replay_at_recorded_speed_waits_for_chunk_offsets(tmp_path):
+    path = tmp_path / "run.cassette.jsonl.gz"
+    CassetteTransport(Cassette(path), mode="record", inner=fake_stream).chat(model="m", messages=MESSAGES)
+
+    started = time.perf_counter()
+    CassetteTransport(Cassette(path), mode="replay", speed="recorded").chat(model="m", messages=MESSAGES)
+    assert time.perf_counter() - started >= 0.025
+
+
+def test_replay_miss_raises(tmp_path):
+    player = CassetteTransport(Cassette(tmp_path / "empty.jsonl.gz"), mode="replay")
+    with pytest.raises(CassetteMiss):
+        player.chat(model="m", messages=MESSAGES)
+
+
+def long_stream(model, messages, options=None, stream=False, **kwargs):
+    turn = messages[-1]["content"].count("ユーザー:")
+    for sentence in [f"{turn}番目の返事です。", "今日はいい天気ですね。", "また話しましょう。"]:
+        yield RecordedResponse(model=model, message=RecordedMessage(sentence), done=False)
+    yield RecordedResponse(model=model, message=RecordedMessage(""), done=True)
+
+
+def test_multi_turn_conversation_replays_whatever_the_global_seed(tmp_path, monkeypatch):
+    import random
+
+    import cassette
+    from clone_agentAI import AIPersonaAgent, create_yamada_taro_persona
+
+    def converse(mode: str, seed: int):
+        monkeypatch.setenv("CLONEAI_CASSETTE", str(tmp_path / "turns.cassette.jsonl.gz"))
+        monkeypatch.setenv("CLONEAI_CASSETTE_MODE", mode)
+        monkeypatch.setattr(cassette, "_shared", {})
+        random.seed(seed)
+        agent = AIPersonaAgent(create_yamada_taro_persona(), episodic_memory=False)
+        agent.client.transport._inner = long_stream
+        replies = [agent.process_input(text) for text in ("やあ", "元気？", "何してる？")]
+        assert agent.last_error is None
+        return replies
+
+    assert converse("record", 1) == converse("replay", 7)
+
+
+def test_replay_miss_names_the_model_and_request(tmp_path):
+    player = CassetteTransport(Cassette(tmp_path / "empty.jsonl.gz"), mode="replay")
+    with pytest.raises(CassetteMiss) as excinfo:
+        player.chat(model="gemma3:1b", messages=[{"role": "user", "content": "## 現在の入力\nやあ"}])
+    message = str(excinfo.value)
+    assert "gemma3:1b" in message and "request #1" in message and "やあ" in message
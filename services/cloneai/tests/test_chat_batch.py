@@ -0,0 +1,66 @@
+import json
+
+from fastapi.testclient import TestClient
+
+
+def test_chat_batch_streams_results_with_per_item_errors(fast_simulation) -> None:
+    import clone_server
+
+    client = TestClient(clone_server.app)
+
+    items = [
+        {"message": "はじめまして！", "session_id": "bulk-a"},
+        {"message": "趣味は？", "session_id": "bulk-b"},
+        {"message": "好きな食べ物は？", "session_id": "bulk-a"},
+        {"message": "やあ", "session_id": "bulk-c", "persona_id": "nobody"},
+    ]
+    res = client.post("/chat/batch", json={"items": items})
+
+    assert res.status_code == 200 and res.headers["content-type"].startswith("application/x-ndjson")
+    lines = {line["index"]: line for line in map(json.loads, res.text.splitlines())}
+    assert sorted(lines) == [0, 1, 2, 3]
+    assert all(lines[i]["ok"] and lines[i]["result"]["reply"] for i in (0, 1, 2))
+    assert lines[3] == {"index": 3, "ok": False, "status": 404, "error": "Unknown persona_id: nobody"}
+    # Turns of one session run in order on the same agent
+    assert clone_server._sessions["bulk-a"].memory.turn_count == 2
+
+
+def test_chat_batch_rejects_oversized_batches(monkeypatch) -> None:
+    import clone_server
+
+    monkeypatch.setattr(clone_server, "_BATCH_MAX_ITEMS", 1)
+    client = TestClient(clone_server.app)
+    items = [{"message": "a"}, {"message": "b"}]
+
+    assert client.post("/chat/batch", json={"items": items}).status_code == 413
+    assert client.post("/chat/batch", json={"items": []}).status_code == 422
+
+
+def test_chat_batch_runs_at_batch_priority_and_groups_by_resolved_session(fast_simulation, monkeypatch) -> None:
+    import clone_server
+
+    chat_once = clone_server._chat_once
+    seen, running = [], set()
+
+    async def tracking(req, request=None):
+        assert req.session_id not in running, "two turns of one session ran at once"
+        running.add(req.session_id)
+        try:
+            seen.append((req.message, req.priority))
+            return await chat_once(req, request)
+        finally:
+            running.discard(req.session_id)
+
+    monkeypatch.setattr(clone_server, "_chat_once", tracking)
+    default_id = clone_server.get_registry().default_id
+    items = [
+        {"message": "一つ目", "session_id": "bulk-d"},
+        {"message": "二つ目", "session_id": "bulk-d", "persona_id": default_id},
+        {"message": "急ぎ", "session_id": "bulk-e", "priority": "interactive"},
+    ]
+    res = TestClient(clone_server.app).post("/chat/batch", json={"items": items})
+
+    assert all(line["ok"] for line in map(json.loads, res.text.splitlines()))
+    assert dict(seen) == {"一つ目": "batch", "二つ目": "batch", "急ぎ": "interactive"}
+    history = clone_server._sessions["bulk-d"].memory.conversation_history
+    assert [h["user"] for h in history] == ["一つ目", "二つ目"]
@@ -0,0 +1,203 @@
+import asyncio
+
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from cassette import RecordedMessage, RecordedResponse
+from concurrency import BATCH, INTERACTIVE, AdaptiveLimiter, LimiterTimeout
+
+
+def test_limits_in_flight_and_queues_in_order() -> None:
+    limiter = AdaptiveLimiter(initial_limit=2, min_limit=2, max_limit=2)
+    order = []
+
+    async def job(i: int) -> None:
+        async with limiter.acquire():
+            order.append(i)
+            assert limiter.in_flight <= 2
+            await asyncio.sleep(0.01)
+
+    async def scenario() -> None:
+        tasks = [asyncio.create_task(job(i)) for i in range(6)]
+        await asyncio.sleep(0)
+        assert limiter.in_flight == 2 and limiter.queue_depth == 4
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order == list(range(6)) and limiter.in_flight == 0 and limiter.queue_depth == 0
+
+
+def test_queue_timeout_and_cancellation_free_their_place() -> None:
+    limiter = AdaptiveLimiter(initial_limit=1, min_limit=1, max_limit=1)
+
+    async def scenario() -> None:
+        async with limiter.acquire():
+            with pytest.raises(LimiterTimeout):
+                async with limiter.acquire(timeout=0.01):
+                    pass
+            waiter = asyncio.create_task(limiter.acquire().__aenter__())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.sleep(0)
+            assert limiter.queue_depth == 0
+        assert limiter.in_flight == 0
+        async with limiter.acquire(timeout=0):
+            pass
+
+    asyncio.run(scenario())
+
+
+def test_failed_generation_releases_without_sample() -> None:
+    limiter = AdaptiveLimiter(initial_limit=1)
+
+    async def scenario() -> None:
+        with pytest.raises(RuntimeError):
+            async with limiter.acquire():
+                raise RuntimeError("backend down")
+
+    asyncio.run(scenario())
+    assert limiter.in_flight == 0 and limiter.snapshot()["noload_rtt_ms"] is None
+
+
+def test_error_and_fallback_replies_leave_the_baseline_alone() -> None:
+    from clone_agentAI import OllamaClient
+    from deadline import Deadline
+
+    class DownTransport:
+        def chat(self, **kwargs):
+            raise RuntimeError("backend down")
+
+    limiter = AdaptiveLimiter(initial_limit=1)
+    client = OllamaClient("m")
+    client.transport = DownTransport()
+    client.limiter = limiter
+
+    error = asyncio.run(client.agenerate("やあ"))
+    fallback = asyncio.run(client.agenerate("やあ", deadline=Deadline.after_ms(0)))
+
+    assert error.startswith("エラー:") and client.last_degraded == "fallback" and fallback
+    assert limiter.in_flight == 0 and limiter.snapshot()["noload_rtt_ms"] is None
+
+
+def steady_limit(backend_slots: int) -> int:
+    """Median limit while 32 clients hammer a backend that runs `backend_slots` 5ms jobs at once."""
+    limiter = AdaptiveLimiter(initial_limit=1, max_limit=32)
+    history = []
+
+    async def scenario() -> None:
+        backend = asyncio.Semaphore(backend_slots)
+
+        async def client() -> None:
+            for _ in range(10):
+                async with limiter.acquire():
+                    async with backend:
+                        await asyncio.sleep(0.005)
+                history.append(limiter.limit)
+
+        await asyncio.gather(*(client() for _ in range(32)))
+
+    asyncio.run(scenario())
+    steady = sorted(history[len(history) // 4: -len(history) // 4])
+    return steady[len(steady) // 2]
+
+
+def test_converges_near_backend_parallelism() -> None:
+    single, quad = steady_limit(1), steady_limit(4)
+    assert 1 <= single <= 6
+    assert 4 <= quad <= 14 and quad > single
+
+
+def test_from_env(monkeypatch) -> None:
+    monkeypatch.setenv("CLONEAI_CONCURRENCY_LIMIT", "3")
+    fixed = AdaptiveLimiter.from_env()
+    assert (fixed.min_limit, fixed.limit, fixed.max_limit) == (3, 3, 3)
+    monkeypatch.setenv("CLONEAI_CONCURRENCY_LIMIT", "off")
+    assert AdaptiveLimiter.from_env() is None
+
+
+def test_interactive_overtakes_queued_batch_but_batch_keeps_a_quota() -> None:
+    limiter = AdaptiveLimiter(initial_limit=1, min_limit=1, max_limit=1, quotas={BATCH: 2})
+    order = []
+
+    async def job(name: str, priority: str) -> None:
+        async with limiter.acquire(priority=priority):
+            order.append(name)
+            await asyncio.sleep(0.001)
+
+    async def scenario() -> None:
+        async with limiter.acquire():
+            tasks = [asyncio.create_task(job(f"b{i}", BATCH)) for i in range(3)]
+            tasks += [asyncio.create_task(job(f"i{i}", INTERACTIVE)) for i in range(5)]
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order == ["i0", "i1", "b0", "i2", "i3", "b1", "i4", "b2"]
+
+
+def test_batch_cannot_take_reserved_slots() -> None:
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=4, max_limit=4, reserve=0.25)
+
+    async def scenario() -> None:
+        held = [limiter.acquire(priority=BATCH) for _ in range(3)]
+        for slot in held:
+            await slot.__aenter__()
+        with pytest.raises(LimiterTimeout):
+            async with limiter.acquire(timeout=0.01, priority=BATCH):
+                pass
+        async with limiter.acquire(timeout=0):
+            assert limiter.snapshot()["by_priority"]["interactive"]["in_flight"] == 1
+        for slot in held:
+            await slot.__aexit__(None, None, None)
+
+    asyncio.run(scenario())
+    assert limiter.in_flight == 0
+
+
+def test_interactive_takes_the_reserved_slot_past_a_queued_batch_item() -> None:
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=4, max_limit=4, reserve=0.25)
+
+    async def scenario() -> None:
+        held = [limiter.acquire(priority=BATCH) for _ in range(3)]
+        for slot in held:
+            await slot.__aenter__()
+        queued = asyncio.ensure_future(limiter.acquire(priority=BATCH).__aenter__())
+        await asyncio.sleep(0)
+        assert limiter.queue_depth_of(BATCH) == 1
+        async with limiter.acquire(timeout=1.0, priority=INTERACTIVE):
+            assert limiter.in_flight_of(INTERACTIVE) == 1 and not queued.done()
+        queued.cancel()
+        for slot in held:
+            await slot.__aexit__(None, None, None)
+
+    asyncio.run(scenario())
+    assert limiter.in_flight == 0
+
+
+def test_ollama_compatible_proxy_streams_through_scheduler(monkeypatch) -> None:
+    import clone_server
+
+    calls = []
+
+    def fake_chat(**kwargs):
+        calls.append(kwargs)
+        yield RecordedResponse(model=kwargs["model"], message=RecordedMessage("やあ"), done=False)
+        yield RecordedResponse(model=kwargs["model"], message=RecordedMessage(""), eval_count=1)
+
+    monkeypatch.setattr(clone_server, "_backend_chat", lambda: fake_chat)
+    monkeypatch.setattr(clone_server, "_backend_check", (float("inf"), True))
+    monkeypatch.setattr(clone_server, "_limiter", AdaptiveLimiter(initial_limit=2))
+    client = TestClient(clone_server.app)
+    body = {"model": "gemma3:1b", "messages": [{"role": "user", "content": "hi"}], "options": {"temperature": 0}}
+
+    res = client.post("/api/chat", json=body, headers={"X-CloneAI-Priority": "batch"})
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert [line["message"]["content"] for line in lines] == ["やあ", ""] and lines[-1]["done"] is True
+    assert calls[0]["options"] == {"temperature": 0} and calls[0]["stream"] is True
+
+    res = client.post("/api/chat", json={**body, "stream": False})
+    assert res.json()["message"]["content"] == "やあ" and res.json()["eval_count"] == 1
+    assert client.post("/api/chat", json=body, headers={"X-CloneAI-Priority": "vip"}).status_code == 400
+    assert client.get("/api/version").status_code == 200
@@ -0,0 +1,45 @@
+from clone_agentAI import AIPersonaAgent, create_yamada_taro_persona
+from context_window import TEMPLATE_OVERHEAD_TOKENS, ContextSizer, estimate_tokens
+
+
+def test_estimate_counts_japanese_per_char_and_ascii_per_three() -> None:
+    assert estimate_tokens("こんにちは") == 5 + TEMPLATE_OVERHEAD_TOKENS
+    assert estimate_tokens("abcdef") == 2 + TEMPLATE_OVERHEAD_TOKENS
+
+
+def test_picks_smallest_bucket_within_the_persona_ceiling() -> None:
+    sizer = ContextSizer(buckets=(1024, 2048, 4096), max_ctx=4096, reply_tokens=256)
+
+    assert sizer.bucket_for(500, None) == 1024
+    assert sizer.bucket_for(900, None) == 2048
+    assert sizer.bucket_for(900, {"num_predict": 64}) == 1024
+    # The persona's num_ctx is the ceiling, even when the prompt needs more
+    assert sizer.bucket_for(3000, {"num_ctx": 2048}) == 2048
+    assert sizer.prompt_budget({"num_ctx": 2048, "num_predict": 48}) == 2000
+
+
+def test_bucket_grows_at_once_but_shrinks_only_after_a_run_of_small_prompts() -> None:
+    sizer = ContextSizer(buckets=(1024, 2048, 4096), max_ctx=4096, reply_tokens=256, shrink_after=3)
+
+    assert sizer.choose("m", 100, None) == 1024
+    assert sizer.choose("m", 3000, None) == 4096
+    assert [sizer.choose("m", 100, None) for _ in range(3)] == [4096, 4096, 1024]
+    # Other models keep their own bucket
+    assert sizer.choose("other", 1500, None) == 2048
+    assert sizer.apply("m", "やあ", {"temperature": 0.7}) == {"temperature": 0.7, "num_ctx": 1024}
+
+
+def test_agent_drops_oldest_history_when_the_prompt_does_not_fit() -> None:
+    agent = AIPersonaAgent(create_yamada_taro_persona(), simulation_mode=True, episodic_memory=False)
+    turn = "とても長い話" * 50
+    base = estimate_tokens(agent._build_prompt("最近どう？"))
+    for i in range(4):
+        agent.memory.add_interaction(f"{i}番目: {turn}", "なるほど")
+    per_turn = len(turn) + 20
+    agent.client.context_sizer = ContextSizer(max_ctx=base + 256 + int(per_turn * 2.5), reply_tokens=256)
+
+    prompt = agent._build_prompt("最近どう？")
+
+    assert "3番目" in prompt and "2番目" in prompt and "1番目" not in prompt and "0番目" not in prompt
+    assert agent.memory.turn_count == 4 and len(agent.memory.conversation_history) == 4
+    assert any("古い会話履歴を2件省きました" in t["content"] for t in agent.get_thought_process())
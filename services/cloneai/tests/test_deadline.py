@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+from fastapi.testclient import TestClient
+
+from cassette import RecordedMessage, RecordedResponse
+from clone_agentAI import OllamaClient
+from deadline import MIN_NUM_PREDICT, THROUGHPUT, Deadline, ThroughputEstimator, cap_options
+
+
+class StreamTransport:
+    """Streams `chunks` pieces, one every `interval_s`, and remembers the options it was called with."""
+
+    def __init__(self, chunks, interval_s: float = 0.0):
+        self.chunks = chunks
+        self.interval_s = interval_s
+        self.calls = []
+        self.closed = False
+
+    def chat(self, model, messages, options=None, stream=False):
+        self.calls.append(options)
+        return self._stream(model)
+
+    def _stream(self, model):
+        try:
+            for text in self.chunks:
+                time.sleep(self.interval_s)
+                yield RecordedResponse(model=model, message=RecordedMessage(text), done=False)
+            yield RecordedResponse(
+                model=model, message=RecordedMessage(""), eval_count=40, eval_duration=int(1e9),
+                prompt_eval_duration=int(0.2e9),
+            )
+        finally:
+            self.closed = True
+
+
+def test_num_predict_follows_remaining_budget() -> None:
+    estimator = ThroughputEstimator()
+    assert estimator.num_predict("m", remaining_s=0.5) == 0
+
+    estimator.observe("m", RecordedResponse(model="m", message=RecordedMessage(""),
+                                            eval_count=100, eval_duration=int(2e9), prompt_eval_duration=int(0.2e9)))
+    # 50 tokens/s, 0.2s to the first token, 0.3s reserve
+    assert estimator.num_predict("m", remaining_s=2.5) in (99, 100)
+    assert estimator.num_predict("m", remaining_s=0.5 + MIN_NUM_PREDICT / 50 - 0.01) == 0
+
+
+def test_cap_options_keeps_smaller_persona_limit() -> None:
+    options, cap = cap_options({"temperature": 0.7, "num_predict": 20}, "unseen-model", Deadline.after_ms(60_000))
+    assert cap > 20 and options == {"temperature": 0.7, "num_predict": 20}
+
+    options, cap = cap_options({"num_predict": 10_000}, "unseen-model", Deadline.after_ms(5_000))
+    assert options["num_predict"] == cap < 10_000
+
+
+def test_generation_is_capped_and_completes_within_budget() -> None:
+    client = OllamaClient(model_name="deadline-ok")
+    client.transport = StreamTransport(["今日は", "いい天気", "やな。"])
+
+    reply = asyncio.run(client.agenerate("こんにちは", deadline=Deadline.after_ms(10_000)))
+
+    assert reply == "今日はいい天気やな。" and client.last_degraded is None
+    assert client.transport.calls[0]["num_predict"] > 0
+
+
+def test_slow_stream_returns_truncated_partial_reply() -> None:
+    # 100 tokens/s and 50ms to the first token, so a 600ms budget is worth starting
+    THROUGHPUT.observe("deadline-partial", RecordedResponse(
+        model="deadline-partial", message=RecordedMessage(""),
+        eval_count=100, eval_duration=int(1e9), prompt_eval_duration=int(0.05e9),
+    ))
+    client = OllamaClient(model_name="deadline-partial")
+    client.transport = StreamTransport(["最初の文。", "次の", "文の途中", "で", "終わらない"] * 20, interval_s=0.05)
+
+    started = time.perf_counter()
+    reply = asyncio.run(client.agenerate("こんにちは", deadline=Deadline.after_ms(600)))
+
+    assert time.perf_counter() - started < 0.6
+    assert client.last_degraded == "partial"
+    assert reply.startswith("最初の文。") and len(reply) < 200
+    time.sleep(0.1)
+    assert client.transport.closed
+
+
+def test_no_budget_falls_back_to_simulation_without_calling_backend() -> None:
+    client = OllamaClient(model_name="deadline-none")
+    client.transport = StreamTransport(["unused"])
+
+    reply = asyncio.run(client.agenerate("ユーザー: こんにちは", deadline=Deadline.after_ms(200)))
+
+    assert reply and client.last_degraded == "fallback"
+    assert client.transport.calls == []
+
+
+def test_chat_reports_degraded_reply(monkeypatch) -> None:
+    import clone_server
+
+    monkeypatch.setattr(clone_server, "_backend_check", (float("inf"), False))
+    client = TestClient(clone_server.app)
+
+    res = client.post("/chat", json={"message": "こんにちは", "session_id": "deadline", "deadline_ms": 1})
+    assert res.status_code == 200
+    body = res.json()
+    assert body["degraded"] is True and body["degraded_reason"] == "fallback" and body["reply"]
+    # The canned reply is not something the persona said, so later turns must not build on it
+    assert clone_server._sessions["deadline"].memory.turn_count == 0
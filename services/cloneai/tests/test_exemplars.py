@@ -0,0 +1,39 @@
+from pathlib import Path
+
+import pytest
+
+from exemplars import ExemplarIndex, build_exemplar_index
+
+
+@pytest.fixture
+def index(tmp_path: Path):
+    examples = [
+        {"prompt": "ラーメン 食べ に 行く ?", "reference": "たしかに、行こか。", "context": ""},
+        {"prompt": "テスト 勉強 し てん の ?", "reference": "全然 し てへん。", "context": "友達: テスト ハイ"},
+        {"prompt": "バビロニア 見 た ?", "reference": "ダイジェスト だけ 見た。", "context": ""},
+    ]
+    path = tmp_path / "exemplars.idx"
+    assert build_exemplar_index(examples, path, n_buckets=1024) == 3
+    idx = ExemplarIndex(path)
+    yield idx
+    idx.close()
+
+
+def test_search_returns_most_similar_exchange(index: ExemplarIndex) -> None:
+    results = index.search("勉強してる？", k=1)
+
+    assert len(results) == 1
+    assert results[0].reply == "全然 し てへん。"
+    assert results[0].context == "友達: テスト ハイ"
+
+
+def test_search_without_overlap_returns_nothing(index: ExemplarIndex) -> None:
+    assert index.search("xyz", k=3) == []
+
+
+def test_rejects_unknown_file_format(tmp_path: Path) -> None:
+    path = tmp_path / "broken.idx"
+    path.write_bytes(b"NOPE" + b"\0" * 64)
+
+    with pytest.raises(ValueError):
+        ExemplarIndex(path)
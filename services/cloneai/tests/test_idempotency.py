@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from idempotency import JOINED, NEW, REPLAYED, IdempotencyCache, IdempotencyConflict
+
+
+def test_duplicates_join_the_running_call_then_replay_its_result() -> None:
+    calls = []
+
+    async def work() -> str:
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "reply"
+
+    async def scenario():
+        cache = IdempotencyCache(ttl_s=60)
+        first, second = await asyncio.gather(cache.run("k", "m", work), cache.run("k", "m", work))
+        third = await cache.run("k", "m", work)
+        with pytest.raises(IdempotencyConflict):
+            await cache.run("k", "other message", work)
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert (first, second, third) == (("reply", NEW), ("reply", JOINED), ("reply", REPLAYED))
+    assert len(calls) == 1
+
+
+def test_work_outlives_a_disconnected_caller_until_the_linger_expires() -> None:
+    async def scenario(linger_s: float, retry_after_s: float):
+        cache = IdempotencyCache(ttl_s=60, linger_s=linger_s)
+        calls = []
+
+        async def work() -> str:
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "reply"
+
+        first = asyncio.create_task(cache.run("k", "m", work))
+        await asyncio.sleep(0.02)
+        first.cancel()
+        await asyncio.sleep(retry_after_s)
+        try:
+            result = await cache.run("k", "m", work)
+        finally:
+            assert cache.in_flight() == 0
+        return result, len(calls)
+
+    # The retry arrives within the linger and picks up the original generation
+    assert asyncio.run(scenario(linger_s=0.05, retry_after_s=0.01)) == (("reply", JOINED), 1)
+    # Without a linger the abandoned generation is stopped and nothing is cached
+    assert asyncio.run(scenario(linger_s=0.0, retry_after_s=0.01)) == (("reply", NEW), 2)
+
+
+def test_expired_and_overflowing_results_are_dropped() -> None:
+    async def scenario():
+        cache = IdempotencyCache(ttl_s=0.05, max_entries=2)
+
+        async def work() -> str:
+            return "reply"
+
+        for key in ("a", "b", "c"):
+            await cache.run(key, "m", work)
+        kept = len(cache)
+        await asyncio.sleep(0.06)
+        return kept, (await cache.run("c", "m", work))[1]
+
+    assert asyncio.run(scenario()) == (2, NEW)
+
+
+def test_chat_retry_with_the_same_key_is_not_recorded_twice(fast_simulation, monkeypatch) -> None:
+    import clone_server
+
+    monkeypatch.setattr(clone_server, "_idempotent", IdempotencyCache(ttl_s=60, keep=clone_server._idempotent.keep))
+    client = TestClient(clone_server.app)
+    body = {"message": "はじめまして！", "session_id": "idem-a", "idempotency_key": "msg-1"}
+
+    first = client.post("/chat", json=body).json()
+    retry = client.post("/chat", json=body).json()
+    via_header = client.post(
+        "/chat", json={k: v for k, v in body.items() if k != "idempotency_key"}, headers={"Idempotency-Key": "msg-1"}
+    ).json()
+
+    assert first["replayed"] is False and retry["replayed"] is True and via_header["replayed"] is True
+    assert retry["reply"] == first["reply"] == via_header["reply"]
+    assert clone_server._sessions["idem-a"].memory.turn_count == 1
+    assert client.post("/chat", json={**body, "message": "別の質問"}).status_code == 422
+
+
+def test_failed_turn_is_generated_again_on_retry(fast_simulation, monkeypatch) -> None:
+    import clone_server
+    from clone_agentAI import OllamaClient
+
+    monkeypatch.setattr(clone_server, "_idempotent", IdempotencyCache(ttl_s=60, keep=clone_server._idempotent.keep))
+    simulate = OllamaClient._simulate_into
+    failures = [RuntimeError("backend down")]
+
+    async def flaky(self, *args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return await simulate(self, *args, **kwargs)
+
+    monkeypatch.setattr(OllamaClient, "_simulate_into", flaky)
+    client = TestClient(clone_server.app)
+    body = {"message": "はじめまして！", "session_id": "idem-b", "idempotency_key": "msg-1"}
+
+    failed = client.post("/chat", json=body).json()
+    assert clone_server._sessions["idem-b"].memory.turn_count == 0
+    retry = client.post("/chat", json=body).json()
+    again = client.post("/chat", json=body).json()
+
+    # The apology is neither recorded nor replayed; the retry generates the turn, which is then kept
+    assert failed["error"] is True and retry["error"] is False
+    assert failed["replayed"] is False and retry["replayed"] is False and retry["reply"] != failed["reply"]
+    assert again["replayed"] is True and again["reply"] == retry["reply"]
+    assert clone_server._sessions["idem-b"].memory.turn_count == 1
@@ -0,0 +1,86 @@
+import threading
+
+import ollama
+import pytest
+import requests_mock
+
+from benchmark.fake_ollama import FakeOllamaConfig, serve
+from benchmark.load_test import Participant, TurnResult, percentile, summarize
+
+
+@pytest.fixture
+def fake_ollama():
+    server = serve("127.0.0.1", 0, FakeOllamaConfig(token_ms=1.0, prompt_eval_ms=0.1, reply_tokens=5))
+    server.start_background()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fake_ollama_serves_chat_with_timing_fields(fake_ollama) -> None:
+    client = ollama.Client(host=fake_ollama.base_url)
+
+    resp = client.chat(model="gemma3:1b", messages=[{"role": "user", "content": "こんにちは"}])
+
+    assert len(resp.message.content) == 5
+    assert resp.eval_count == 5
+    assert resp.prompt_eval_count == 2
+    assert resp.eval_duration > 0
+
+
+def test_fake_ollama_streams_tokens_and_honours_num_predict(fake_ollama) -> None:
+    client = ollama.Client(host=fake_ollama.base_url)
+
+    chunks = list(
+        client.chat(
+            model="gemma3:1b",
+            messages=[{"role": "user", "content": "hi"}],
+            stream=True,
+            options={"num_predict": 3},
+        )
+    )
+
+    assert "".join(c.message.content for c in chunks) == "たしか"
+    assert chunks[-1].done and chunks[-1].eval_count == 3
+
+
+def test_fake_ollama_rejects_unknown_model(fake_ollama) -> None:
+    with pytest.raises(ollama.ResponseError):
+        ollama.Client(host=fake_ollama.base_url).chat(model="nope", messages=[])
+
+
+def test_percentile_uses_nearest_rank() -> None:
+    values = [float(v) for v in range(1, 101)]
+
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([], 50) == 0.0
+
+
+def test_summarize_reports_throughput_and_errors() -> None:
+    results = [
+        TurnResult(0, 0, 0.0, 0.1, True, 200),
+        TurnResult(0, 1, 0.1, 0.3, True, 200),
+        TurnResult(1, 0, 0.0, 1.0, False, 500),
+    ]
+
+    report = summarize(results, "closed", participants=2, duration_s=2.0)
+
+    assert report.turns == 3
+    assert report.errors == 1
+    assert report.throughput_rps == pytest.approx(1.0)
+    assert report.latency_ms["p50"] == pytest.approx(100.0)
+    assert report.error_kinds == {"HTTP 500": 1}
+
+
+def test_participant_counts_backend_failures_as_errors() -> None:
+    participant = Participant(0, "http://clone.test", ["やあ", "元気？"], think_s=0, timeout_s=1.0, model=None)
+    results = []
+    with requests_mock.Mocker() as mock:
+        mock.post("http://clone.test/chat", [
+            {"json": {"reply": "すみません、技術的な問題が発生しました", "error": True}},
+            {"json": {"reply": "おう", "error": False}},
+        ])
+        participant.run(results, threading.Lock())
+
+    assert [(r.ok, r.error) for r in results] == [(False, "backend_error"), (True, None)]
@@ -0,0 +1,147 @@
+import pytest
+
+from clone_agentAI import MemoryManager
+from memory_store import EpisodicMemory, FactStore, RuleFactExtractor
+from retrieval import HashingEmbedder
+
+
+def _memory(max_history: int = 3) -> MemoryManager:
+    return MemoryManager(max_history=max_history, episodic=EpisodicMemory(embedder=HashingEmbedder(dim=128)))
+
+
+def test_recalls_turn_older_than_history_window() -> None:
+    memory = _memory()
+    memory.add_interaction("うちの猫の名前はタマっていうんだ", "かわいい名前やな")
+    for i in range(40):
+        memory.add_interaction(f"雑談 {i}", f"返事 {i}")
+    memory.episodic.flush()
+
+    episodes = memory.get_relevant_episodes("猫の名前覚えてる？", k=2)
+
+    assert len(memory.conversation_history) == 3
+    assert episodes[0].turn == 1
+    assert "タマ" in episodes[0].user
+
+
+def test_does_not_return_turns_still_in_recent_window() -> None:
+    memory = _memory(max_history=5)
+    memory.add_interaction("猫が好き", "俺も")
+    memory.add_interaction("犬も好き", "ええな")
+    memory.episodic.flush()
+
+    assert memory.get_relevant_episodes("猫", k=3) == []
+
+
+def test_finds_older_turns_behind_a_large_window_of_similar_ones() -> None:
+    memory = _memory(max_history=20)
+    memory.add_interaction("猫の話をしよう、うちの猫はタマ", "ええな")
+    for i in range(20):
+        memory.add_interaction(f"猫の話 {i}", f"猫の返事 {i}")
+    memory.episodic.flush()
+
+    # All 20 turns in the window outrank the old one for "猫の話"; k * 4 hits would all be filtered out
+    episodes = memory.get_relevant_episodes("猫の話", k=2)
+
+    assert [e.turn for e in episodes] == [1]
+
+
+def test_clear_resets_long_term_memory() -> None:
+    memory = _memory(max_history=1)
+    memory.add_interaction("猫が好き", "俺も")
+    memory.add_interaction("雑談", "返事")
+    memory.episodic.flush()
+
+    memory.clear()
+
+    assert memory.turn_count == 0
+    assert len(memory.episodic) == 0
+    assert memory.get_relevant_episodes("猫") == []
+
+
+def test_memory_without_episodic_store_returns_nothing() -> None:
+    memory = MemoryManager(max_history=1)
+    memory.add_interaction("猫が好き", "俺も")
+    memory.add_interaction("雑談", "返事")
+
+    assert memory.get_relevant_episodes("猫") == []
+
+
+def test_rule_extractor_finds_name_preferences_and_plans() -> None:
+    facts = RuleFactExtractor().extract("俺の名前はタカシです。ラーメンが好きで、明日は友達と映画に行く予定")
+
+    assert ("名前", "タカシ") in facts
+    assert ("好きなもの", "ラーメン") in facts
+    assert any(category == "予定" and value.startswith("明日") for category, value in facts)
+
+
+
+@pytest.mark.parametrize("text", [
+    "名前はなんですか？",
+    "君はどこに住んでるの？",
+    "何が好き？",
+    "今日は何する予定？",
+    "聖はラーメンが好きなんだっけ",
+    "大阪に住んでるの",
+])
+def test_rule_extractor_ignores_questions_and_statements_about_the_persona(text) -> None:
+    assert RuleFactExtractor().extract(text) == []
+
+
+def test_rule_extractor_keeps_statements_next_to_a_question() -> None:
+    facts = RuleFactExtractor().extract("猫を飼ってるよ。君は何が好き？")
+
+    assert facts == [("ペット", "猫")]
+
+def test_fact_store_dedupes_and_replaces_single_valued_facts() -> None:
+    store = FactStore()
+    store.add("好きなもの", "ラーメン", turn=1)
+    store.add("好きなもの", "ラーメン", turn=2)
+    store.add("名前", "タカシ", turn=1)
+    store.add("名前", "タカシくん", turn=3)
+
+    assert [(f.category, f.value) for f in store.all()] == [("好きなもの", "ラーメン"), ("名前", "タカシくん")]
+
+
+def test_fact_store_matches_only_facts_related_to_input() -> None:
+    store = FactStore()
+    store.add("名前", "タカシ", turn=1)
+    store.add("好きなもの", "ラーメン", turn=2)
+    store.add("ペット", "猫", turn=3)
+
+    assert [f.value for f in store.match("俺の名前覚えてる？")] == ["タカシ"]
+    assert [f.value for f in store.match("今日ラーメン食べた")] == ["ラーメン"]
+
+
+def test_memory_manager_extracts_facts_after_each_turn() -> None:
+    memory = MemoryManager(max_history=1, facts=FactStore(), fact_extractor=RuleFactExtractor())
+    memory.add_interaction("大阪に住んでるタカシっていいます", "よろしく")
+    memory.add_interaction("雑談", "返事")
+    memory.flush()
+
+    assert memory.key_facts["住んでいる場所"] == "大阪"
+    assert [f.value for f in memory.get_relevant_facts("どこに住んでるって言ったっけ？")] == ["大阪"]
+
+
+def test_fact_jobs_queued_before_a_reset_do_not_leak_into_the_next_conversation() -> None:
+    import threading
+
+    release = threading.Event()
+
+    class SlowExtractor(RuleFactExtractor):
+        def extract(self, text):
+            release.wait(timeout=5)
+            return super().extract(text)
+
+    for reset in ("clear", "restore"):
+        memory = MemoryManager(facts=FactStore(), fact_extractor=SlowExtractor())
+        memory.add_interaction("私の名前は田中です", "よろしく")
+        job = memory._fact_jobs[-1]
+        if reset == "clear":
+            memory.clear()
+        else:
+            memory.restore_state({"t": 1, "h": [["こんにちは", "やあ", "2026-01-01 00:00:00"]]})
+        release.set()
+        job.result(timeout=5)
+        release.clear()
+
+        assert memory.key_facts == {} and memory.facts.all() == [] and memory._fact_jobs == []
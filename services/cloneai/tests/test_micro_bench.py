@@ -0,0 +1,23 @@
+from benchmark.micro_bench import CALIBRATION, CaseResult, compare, run
+
+
+def test_compare_flags_only_cases_past_threshold() -> None:
+    baseline = {"threshold": 1.5, "cases": {"a": {"ns_per_call": 100.0}, "b": {"ns_per_call": 100.0}}}
+    results = [CaseResult("a", 140.0, 1), CaseResult("b", 160.0, 1), CaseResult("new", 1e9, 1)]
+
+    assert [r.name for r in compare(results, baseline)] == ["b"]
+
+
+def test_compare_normalises_by_calibration() -> None:
+    baseline = {"cases": {CALIBRATION: {"ns_per_call": 100.0}, "a": {"ns_per_call": 100.0}}}
+    # Machine is uniformly 2x slower: not a regression
+    results = [CaseResult(CALIBRATION, 200.0, 1), CaseResult("a", 200.0, 1)]
+
+    assert compare(results, baseline) == []
+
+
+def test_cases_run() -> None:
+    results = run("to_prompt", min_time=0.001, repeat=1)
+
+    assert {r.name for r in results} == {"persona.to_prompt[full]", "persona.to_prompt[selective]"}
+    assert all(r.ns_per_call > 0 for r in results)
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from personas import BUILTIN_PERSONA_ID, PersonaConfigError, PersonaRegistry, compile_persona
+
+
+def write_persona(directory, name, **data):
+    payload = {"name": "佐藤", "description": "テスト用のペルソナ", **data}
+    (directory / f"{name}.json").write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+
+
+def test_registry_loads_directory_with_builtin(tmp_path) -> None:
+    (tmp_path / "profiles").mkdir()
+    (tmp_path / "profiles" / "sato.json").write_text(json.dumps({"temperature": 0.7, "max_tokens": 200}), encoding="utf-8")
+    write_persona(tmp_path, "sato", traits={"口癖": "なるほど"}, parameters_file="profiles/sato.json")
+    write_persona(tmp_path, "tanaka", parameters={"top_p": 0.5, "formality_level": 2}, default=True)
+
+    registry = PersonaRegistry.load_dir(tmp_path)
+
+    assert set(registry.ids()) == {BUILTIN_PERSONA_ID, "sato", "tanaka"}
+    assert registry.default_id == "tanaka"
+    assert registry.get("sato").options == {"temperature": 0.7, "num_predict": 200}
+    assert "フォーマル度: 2/5" in registry.get("tanaka").template.to_prompt()
+
+    # The built-in persona keeps the model's defaults and its own speech style unless it opts in
+    builtin = registry.get(BUILTIN_PERSONA_ID)
+    assert builtin.options == {} and "フォーマル度" not in builtin.template.to_prompt()
+
+
+def test_builtin_persona_parameters_are_opt_in(monkeypatch) -> None:
+    from personas import builtin_persona
+
+    monkeypatch.setenv("CLONEAI_BUILTIN_PERSONA_PARAMS", "1")
+    persona = builtin_persona()
+
+    assert persona.options["temperature"] == 1.41 and persona.options["presence_penalty"] == 0.76
+    assert "フォーマル度: 5/5" in persona.template.to_prompt()
+
+
+def test_compiled_template_is_immutable_and_prompt_is_cached() -> None:
+    persona = compile_persona({"id": "a", "name": "A", "description": "d", "traits": {"趣味": "釣り"}}, "<test>")
+    template = persona.template
+
+    assert template.to_prompt() is template.to_prompt()
+    with pytest.raises(AttributeError):
+        template.name = "B"
+    with pytest.raises(TypeError):
+        template.traits["趣味"] = "登山"
+
+
+@pytest.mark.parametrize(
+    "data, message",
+    [
+        ({"description": "d"}, "'name' is required"),
+        ({"name": "A", "description": "d", "parameters": {"temperature": 3}}, "outside"),
+        ({"name": "A", "description": "d", "parameters": {"seed_": 1}}, "unknown parameters"),
+        ({"name": "A", "description": "d", "values": "x"}, "list of strings"),
+        ({"id": "bad id", "name": "A", "description": "d"}, "invalid persona id"),
+    ],
+)
+def test_invalid_definitions_are_rejected(data, message) -> None:
+    with pytest.raises(PersonaConfigError, match=message):
+        compile_persona(data, "<test>", default_id="x")
+
+
+def test_chat_selects_persona(tmp_path, monkeypatch) -> None:
+    write_persona(tmp_path, "sato", traits={"口癖": "なるほど"})
+    import clone_server
+    import personas
+
+    monkeypatch.setattr(personas, "_registry", PersonaRegistry.load_dir(tmp_path))
+    monkeypatch.setattr(clone_server, "_backend_check", (float("inf"), False))
+    client = TestClient(clone_server.app)
+
+    res = client.post("/chat", json={"message": "はじめまして！", "session_id": "p1", "persona_id": "sato"})
+    assert res.status_code == 200
+    assert res.json()["persona_id"] == "sato" and "佐藤" in res.json()["reply"]
+    assert client.post("/chat", json={"message": "やあ", "persona_id": "nobody"}).status_code == 404
+    assert {p["id"] for p in client.get("/personas").json()["personas"]} == {BUILTIN_PERSONA_ID, "sato"}
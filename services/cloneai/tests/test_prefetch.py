@@ -0,0 +1,95 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+from clone_agentAI import AIPersonaAgent, create_yamada_taro_persona
+from concurrency import AdaptiveLimiter
+from prefetch import PrefetchService
+
+SCRIPT = ("こんにちは、自己紹介してください", "趣味は何ですか？")
+
+
+def new_agent(persona_id="yamada", model_name=None) -> AIPersonaAgent:
+    return AIPersonaAgent(create_yamada_taro_persona(), simulation_mode=True, episodic_memory=False)
+
+
+def test_sessions_follow_one_prefetched_conversation_through_the_script(fast_simulation) -> None:
+    service = PrefetchService(new_agent, script=SCRIPT, pool_size=2)
+    service.watch("yamada")
+
+    async def scenario():
+        while await service.fill_once():
+            pass
+        assert service.ready("yamada") == 2
+
+        served = {}
+        for session in ("a", "b"):
+            agent = new_agent()
+            first = service.claim("yamada", None, session, agent, "  こんにちは、自己紹介してください")
+            agent.accept_prefetched(SCRIPT[0], first)
+            second = service.claim("yamada", None, session, agent, SCRIPT[1])
+            agent.accept_prefetched(SCRIPT[1], second)
+            served[session] = (first, second, agent)
+
+        # Nothing left for a third session, and other conditions have their own pool
+        assert service.claim("yamada", None, "c", new_agent(), SCRIPT[0]) is None
+        assert service.claim("yamada", "gemma3:4b", "d", new_agent(), SCRIPT[0]) is None
+        return served
+
+    served = asyncio.run(scenario())
+    (a1, a2, agent_a), (b1, b2, _) = served["a"], served["b"]
+    # Each session gets one conversation, in order, and the two sessions got different ones
+    assert a1 is not b1 and a2 is not b2
+    assert agent_a.memory.turn_count == 2
+    assert [h["agent"] for h in agent_a.memory.conversation_history] == [a1.reply, a2.reply]
+    assert service.ready("yamada", "gemma3:4b") == 0 and ("yamada", "gemma3:4b") in service._pools
+
+
+def test_going_off_script_falls_back_to_live_generation(fast_simulation) -> None:
+    service = PrefetchService(new_agent, script=SCRIPT, pool_size=1)
+    service.watch("yamada")
+    asyncio.run(service.fill_once())
+    agent = new_agent()
+
+    agent.accept_prefetched(SCRIPT[0], service.claim("yamada", None, "a", agent, SCRIPT[0]))
+    asyncio.run(agent.aprocess_input("ところで天気はどう？"))
+
+    # The prefetched second reply assumed a different history, so it is not used any more
+    assert service.claim("yamada", None, "a", agent, SCRIPT[1]) is None
+    assert service.claim("yamada", None, "a", agent, SCRIPT[0]) is None
+    # Batch work never takes from the pool
+    assert service.claim("yamada", None, "b", new_agent(), SCRIPT[0], priority="batch") is None
+
+
+def test_refill_waits_while_interactive_generations_run(fast_simulation) -> None:
+    limiter = AdaptiveLimiter(initial_limit=4)
+    service = PrefetchService(new_agent, script=SCRIPT[:1], pool_size=1, limiter=limiter)
+    service.watch("yamada")
+
+    async def scenario():
+        async with limiter.acquire():
+            busy = await service.fill_once()
+        return busy, await service.fill_once(), await service.fill_once()
+
+    assert asyncio.run(scenario()) == (False, True, False)
+
+
+def test_chat_serves_the_scripted_opening_from_the_pool(fast_simulation, monkeypatch) -> None:
+    import clone_server
+
+    registry = clone_server.get_registry()
+    service = PrefetchService(
+        lambda pid, model: clone_server._new_agent(registry.get(pid), model), script=SCRIPT[:1], pool_size=1
+    )
+    service.watch(registry.default_id)
+    asyncio.run(service.fill_once())
+    pooled = service._pools[(registry.default_id, None)][0].turns[0].reply
+    monkeypatch.setattr(clone_server, "_prefetch", service)
+    client = TestClient(clone_server.app)
+
+    first = client.post("/chat", json={"message": SCRIPT[0], "session_id": "pf-a"}).json()
+    second = client.post("/chat", json={"message": SCRIPT[0], "session_id": "pf-b"}).json()
+
+    assert first["prefetched"] is True and first["reply"] == pooled
+    assert second["prefetched"] is False
+    assert clone_server._sessions["pf-a"].memory.turn_count == 1
@@ -0,0 +1,119 @@
+from pathlib import Path
+
+import pytest
+
+from clone_agentAI import AIPersonaAgent, create_yamada_taro_persona
+from retrieval import (
+    Document,
+    HashingEmbedder,
+    HybridRetriever,
+    LexicalIndex,
+    PersonaTraitIndex,
+    char_ngrams,
+    load_knowledge_markdown,
+    reciprocal_rank_fusion,
+)
+
+
+@pytest.fixture
+def retriever() -> HybridRetriever:
+    r = HybridRetriever(embedder=HashingEmbedder(dim=128))
+    r.add_documents(
+        [
+            Document(id="pizza", content="Unknown: ここ に ピザ が ある ね。"),
+            Document(id="babylon", content="Unknown: バビロニア で 忙しい ん じゅう。"),
+            Document(id="study", content="Unknown: え 、 勉強 し てん の ?"),
+        ]
+    )
+    return r
+
+
+def test_char_ngrams_ignore_transcript_spacing() -> None:
+    assert char_ngrams("ピザ が") == char_ngrams("ピザが")
+    assert "ピザが" in char_ngrams("ピザ が")
+
+
+def test_lexical_index_ranks_proper_noun_match_first() -> None:
+    index = LexicalIndex()
+    index.add("バビロニア で 忙しい")
+    index.add("ピザ が ある")
+
+    hits = index.search("バビロニア")
+
+    assert hits[0][0] == 0
+    assert all(idx != 1 for idx, _ in hits)
+
+
+def test_lexical_index_is_incremental() -> None:
+    index = LexicalIndex()
+    index.add("ピザ")
+    assert index.search("勉強") == []
+
+    index.add("勉強 し てる")
+
+    assert index.search("勉強")[0][0] == 1
+
+
+def test_reciprocal_rank_fusion_rewards_agreement() -> None:
+    fused = reciprocal_rank_fusion([[1, 2, 3], [2, 1, 4]])
+
+    assert {fused[0][0], fused[1][0]} == {1, 2}
+    assert fused[-1][0] in (3, 4)
+
+
+def test_hybrid_search_returns_fused_hits(retriever: HybridRetriever) -> None:
+    hits = retriever.search("バビロニアって何？", k=2)
+
+    assert hits[0].document.id == "babylon"
+    assert hits[0].lexical_rank == 1
+    assert hits[0].vector_rank is not None
+
+
+def test_hybrid_search_empty_query(retriever: HybridRetriever) -> None:
+    assert retriever.search("   ") == []
+
+
+def test_load_knowledge_markdown_chunks_bulleted_utterances(tmp_path: Path) -> None:
+    md = tmp_path / "knowledge.md"
+    md.write_text(
+        "# 雑談\n\n## 雑談\n\n### バビロニアについて\n\n"
+        "- **Unknown**: バビロニア で 忙しい。\n\n- **聖**: おもろかった。\n",
+        encoding="utf-8",
+    )
+
+    docs = load_knowledge_markdown(md, max_utterances=1)
+
+    assert [d.content for d in docs] == [
+        "バビロニアについて\nUnknown: バビロニア で 忙しい。",
+        "バビロニアについて\n聖: おもろかった。",
+    ]
+    assert docs[0].metadata["title"] == "雑談"
+
+
+def test_persona_trait_index_selects_relevant_traits() -> None:
+    persona = create_yamada_taro_persona()
+    index = PersonaTraitIndex(persona.trait_entries())
+
+    selected = index.select("好きな食べ物は何？", k=3)
+
+    assert len(selected) == 3
+    assert any(entry.startswith("好きな食べ物") for entry in selected)
+
+
+def test_selective_persona_prompt_is_much_smaller() -> None:
+    persona = create_yamada_taro_persona()
+    selected = PersonaTraitIndex(persona.trait_entries()).select("好きなゲームは？", k=5)
+
+    full = persona.to_prompt()
+    selective = persona.to_prompt(selected_entries=selected)
+
+    assert len(selective) < len(full) / 2
+    assert persona.description in selective
+    assert all(f"- {entry}" in selective for entry in selected)
+    assert selective.split("## 指示", 1)[1] == full.split("## 指示", 1)[1]
+
+
+def test_unknown_persona_prompt_mode_is_rejected() -> None:
+    with pytest.raises(ValueError, match="selctive"):
+        AIPersonaAgent(create_yamada_taro_persona(), simulation_mode=True, persona_prompt_mode="selctive")
+
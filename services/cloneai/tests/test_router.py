@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+from clone_agentAI import AIPersonaAgent, create_yamada_taro_persona
+from deadline import Deadline
+from metrics import MetricsRegistry
+from router import FAST, LARGE, ModelRouter, RouteDecision, RouterConfig
+
+
+def make_router(**overrides) -> ModelRouter:
+    return ModelRouter(RouterConfig(fast_model="small", large_model="big", **overrides))
+
+
+def test_routes_by_input_features() -> None:
+    router = make_router()
+
+    assert router.route("こんにちは！").route == FAST
+    assert router.route("うん").route == FAST
+    decision = router.route("RustとGoの違いを詳しく教えてほしい")
+    assert (decision.route, decision.model, decision.reason) == (LARGE, "big", "hard")
+
+
+def test_falls_back_to_fast_when_large_queue_is_deep() -> None:
+    router = make_router(max_large_queue=1)
+    hard = "なぜ型システムが大事なのか説明して"
+
+    with router.track(RouteDecision(LARGE, "big", "hard")):
+        assert router.route(hard).reason == "queue"
+    assert router.route(hard).route == LARGE
+
+
+def test_falls_back_on_slo_and_probes_again() -> None:
+    router = ModelRouter(RouterConfig(slo_ms=5), probe_interval_s=0.05)
+    hard = "なぜ型システムが大事なのか説明して"
+    with router.track(RouteDecision(LARGE, "big", "hard")):
+        time.sleep(0.02)
+
+    assert router.route(hard).reason == "slo"
+    time.sleep(0.05)
+    assert router.route(hard).reason == "probe"
+
+
+def test_tight_deadline_routes_fast() -> None:
+    router = make_router()
+    hard = "なぜ型システムが大事なのか説明して"
+    with router.track(RouteDecision(LARGE, "big", "hard")):
+        time.sleep(0.02)
+
+    assert router.route(hard, Deadline.after_ms(5)).reason == "deadline"
+    assert router.route(hard, Deadline.after_ms(10_000)).route == LARGE
+
+
+def test_agent_uses_routed_model() -> None:
+    router = make_router()
+    agent = AIPersonaAgent(create_yamada_taro_persona(), simulation_mode=True, router=router)
+    agent.client.simulator.speed = 0
+
+    asyncio.run(agent.aprocess_input("こんにちは"))
+    assert agent.client.model_name == "small" and agent.last_route.reason == "simple"
+    asyncio.run(agent.aprocess_input("RustとGoの違いを詳しく教えてほしい"))
+    assert agent.client.model_name == "big"
+    assert router.in_flight(LARGE) == 0
+
+
+def test_metrics_render_prometheus_text() -> None:
+    registry = MetricsRegistry()
+    registry.counter("c_total", "help").inc(route="fast")
+    hist = registry.histogram("lat_seconds", "help", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 2.0):
+        hist.observe(value, route="fast")
+
+    text = registry.render()
+    assert 'c_total{route="fast"} 1' in text
+    assert 'lat_seconds_bucket{route="fast",le="1"} 3' in text
+    assert 'lat_seconds_bucket{route="fast",le="+Inf"} 4' in text
+    assert 0.1 < hist.quantile(0.5, route="fast") <= 1.0
@@ -0,0 +1,98 @@
+import pytest
+
+from clone_agentAI import MemoryManager
+from memory_store import EpisodicMemory, FactStore, RuleFactExtractor
+from session_store import SessionStore, StaleSessionError
+
+
+def make_memory() -> MemoryManager:
+    return MemoryManager(max_history=2, episodic=EpisodicMemory(), facts=FactStore(), fact_extractor=RuleFactExtractor())
+
+
+def test_save_load_and_optimistic_concurrency(tmp_path) -> None:
+    store = SessionStore(tmp_path / "sessions.db")
+    version = store.save("s1", {"t": 1, "h": [["やあ", "おう", "2025-01-01 00:00:00"]]}, expected_version=0, model_name="m")
+    assert version == 1
+
+    record = store.load("s1")
+    assert record.version == 1 and record.model_name == "m" and record.state["t"] == 1
+    # Same version already held by the caller: the blob is not decoded again
+    assert store.load("s1", known_version=1).state is None
+
+    store.save("s1", {"t": 2}, expected_version=1)
+    with pytest.raises(StaleSessionError):
+        store.save("s1", {"t": 2}, expected_version=1)
+    with pytest.raises(StaleSessionError):
+        store.save("s1", {"t": 1}, expected_version=0)
+    assert store.load("missing") is None
+
+
+def test_memory_state_round_trip_across_workers() -> None:
+    worker_a = make_memory()
+    worker_a.add_interaction("俺の名前は太郎です", "よろしく")
+    worker_a.add_interaction("大阪に住んでる", "ええな")
+    worker_a.add_interaction("猫を飼ってる", "かわいい")
+    state = worker_a.to_state()
+
+    worker_b = make_memory()
+    worker_b.restore_state(state)
+    worker_b.flush()
+    assert worker_b.turn_count == 3
+    assert worker_b.get_history_as_text() == worker_a.get_history_as_text()
+    assert {f.value for f in worker_b.facts.all()} == {"太郎", "大阪", "猫"}
+    assert [e.turn for e in worker_b.get_relevant_episodes("名前は太郎")] == [1]
+
+    # Restoring a newer state only appends the new turns to the episodic index
+    worker_a.add_interaction("明日は映画に行く予定", "ええやん")
+    worker_b.restore_state(worker_a.to_state())
+    assert [t[0] for t in worker_b.episodic.turns()] == [1, 2, 3, 4]
+
+
+def test_saves_write_only_the_new_episodic_turns(tmp_path) -> None:
+    store = SessionStore(tmp_path / "sessions.db")
+    memory = make_memory()
+    memory.add_interaction("俺の名前は太郎です", "よろしく")
+    memory.add_interaction("大阪に住んでる", "ええな")
+    version = store.save("s1", memory.to_state(), expected_version=0)
+
+    memory.add_interaction("猫を飼ってる", "かわいい")
+    state = memory.to_state(episodes_after=2)
+    assert [t[0] for t in state["e"]] == [3]
+    version = store.save("s1", state, expected_version=version, episodes_after=2)
+    assert [t[:2] for t in store.load("s1").state["e"]] == [[1, "俺の名前は太郎です"], [2, "大阪に住んでる"], [3, "猫を飼ってる"]]
+
+    # After a reset everything stored after turn 0 is replaced
+    memory.clear()
+    memory.add_interaction("はじめまして", "どうも")
+    store.save("s1", memory.to_state(), expected_version=version)
+    assert [t[:2] for t in store.load("s1").state["e"]] == [[1, "はじめまして"]]
+    store.delete("s1")
+    assert store.load("s1") is None
+
+
+def test_conflicting_save_replays_the_reset_before_the_turn(tmp_path, monkeypatch) -> None:
+    import clone_server
+    from clone_agentAI import AIPersonaAgent, create_yamada_taro_persona
+
+    monkeypatch.setattr(clone_server, "_session_versions", {})
+    monkeypatch.setattr(clone_server, "_session_episodes", {})
+    store = SessionStore(tmp_path / "sessions.db")
+    agent = AIPersonaAgent(create_yamada_taro_persona(), simulation_mode=True)
+    agent.memory = make_memory()
+    agent.memory.add_interaction("俺の名前は太郎です", "よろしく")
+    clone_server._save_session(store, "s1", agent, "俺の名前は太郎です", "よろしく", recorded=True)
+
+    # Another worker adds a turn in the meantime
+    other = make_memory()
+    other.restore_state(store.load("s1").state)
+    other.add_interaction("大阪に住んでる", "ええな")
+    store.save("s1", other.to_state(), expected_version=1)
+
+    agent.reset_conversation()
+    agent.memory.add_interaction("はじめまして", "どうも")
+    clone_server._save_session(store, "s1", agent, "はじめまして", "どうも", recorded=True, reset=True)
+
+    state = store.load("s1").state
+    assert state["t"] == 1 and [h[0] for h in state["h"]] == ["はじめまして"]
+    assert [t[:2] for t in state["e"]] == [[1, "はじめまして"]]
+    assert agent.memory.turn_count == 1
@@ -0,0 +1,86 @@
+import asyncio
+import math
+import time
+
+import pytest
+
+from clone_agentAI import AIPersonaAgent, create_yamada_taro_persona
+from simulation import LatencyModel, SimulatedLLMClient, compose_reply
+
+FAST = LatencyModel(
+    first_token_mu=math.log(0.05),
+    first_token_sigma=0.01,
+    token_interval_mu=math.log(0.002),
+    token_interval_sigma=0.01,
+)
+
+
+def test_reply_follows_configured_persona() -> None:
+    prompt = create_yamada_taro_persona().to_prompt() + "\n\n## 現在の入力\n\n好きなゲームは？"
+
+    reply = compose_reply(prompt)
+
+    assert reply.startswith("たしかに...")
+    assert "モンハン" in reply
+    assert "山田太郎" not in reply
+
+
+@pytest.mark.parametrize("selective", [False, True])
+def test_reply_does_not_take_the_users_facts_as_persona_traits(selective) -> None:
+    persona = create_yamada_taro_persona()
+    persona_prompt = persona.to_prompt(persona.trait_entries()[:3] if selective else None)
+    prompt = persona_prompt + "\n\n## ユーザーについて分かっていること\n- ペット: 猫\n\n## 現在の入力\n\nペット飼ってる？"
+
+    assert "猫" not in compose_reply(prompt)
+
+def test_self_introduction_uses_persona_name() -> None:
+    prompt = create_yamada_taro_persona().to_prompt() + "\n\n## 現在の入力\n\nこんにちは、自己紹介してください"
+
+    assert "福井聖です" in compose_reply(prompt)
+
+
+def test_concurrent_generations_do_not_block_each_other() -> None:
+    client = SimulatedLLMClient(latency=FAST, seed=1)
+
+    async def run() -> float:
+        started = time.perf_counter()
+        await asyncio.gather(*(client.agenerate("## 現在の入力\n\nこんにちは") for _ in range(20)))
+        return time.perf_counter() - started
+
+    single = sum(delay for delay, _ in client._schedule("## 現在の入力\n\nこんにちは"))
+    assert asyncio.run(run()) < single * 5
+
+
+def test_stream_emits_multiple_tokens() -> None:
+    client = SimulatedLLMClient(latency=FAST, speed=0)
+
+    async def collect():
+        return [token async for token in client.astream("## 現在の入力\n\n週末は何するの？")]
+
+    tokens = asyncio.run(collect())
+
+    assert len(tokens) > 5
+    assert "".join(tokens) == compose_reply("## 現在の入力\n\n週末は何するの？")
+
+
+def test_latency_model_fit_recovers_recorded_distribution() -> None:
+    records = [
+        {"load_duration": 0, "prompt_eval_duration": 200_000_000, "eval_count": 50, "eval_duration": 1_000_000_000},
+        {"load_duration": 0, "prompt_eval_duration": 200_000_000, "eval_count": 100, "eval_duration": 2_000_000_000},
+    ]
+
+    model = LatencyModel.fit(records)
+
+    assert model.samples == 2
+    assert math.exp(model.first_token_mu) == pytest.approx(0.2)
+    assert math.exp(model.token_interval_mu) == pytest.approx(0.02)
+
+
+def test_agent_simulation_mode_uses_async_backend() -> None:
+    agent = AIPersonaAgent(create_yamada_taro_persona(), simulation_mode=True)
+    agent.client.simulator.speed = 0
+
+    reply = asyncio.run(agent.aprocess_input("好きな食べ物は？"))
+
+    assert "とんかつ" in reply
+    assert agent.memory.conversation_history[-1]["agent"] == reply
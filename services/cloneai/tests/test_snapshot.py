@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import ollama
+import pytest
+from fastapi.testclient import TestClient
+
+from benchmark.fake_ollama import FakeOllamaConfig, serve
+from clone_agentAI import AIPersonaAgent, create_yamada_taro_persona
+from snapshot import SessionSnapshot, SnapshotStore
+
+
+class RecordingTransport:
+    """ollama.Client that remembers what each generate call sent and how many prompt tokens were evaluated."""
+
+    def __init__(self, host: str):
+        self.inner = ollama.Client(host=host)
+        self.calls = []
+
+    def chat(self, **kwargs):
+        return self.inner.chat(**kwargs)
+
+    def generate(self, **kwargs):
+        call = {"prompt": kwargs["prompt"], "context": kwargs.get("context"), "prompt_eval_count": None}
+        self.calls.append(call)
+        for chunk in self.inner.generate(**kwargs):
+            if chunk.done:
+                call["prompt_eval_count"] = chunk.prompt_eval_count
+            yield chunk
+
+
+@pytest.fixture
+def fake_ollama():
+    server = serve("127.0.0.1", 0, FakeOllamaConfig(token_ms=0.1, prompt_eval_ms=0.0, reply_tokens=5))
+    server.start_background()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_snapshot_round_trips_state_and_context_in_a_compact_form(tmp_path) -> None:
+    state = {"t": 2, "h": [["こんにちは", "やあ", "2026-01-01 00:00:00"]], "k": {"名前": "田中"}}
+    context = list(range(5000))
+    snap = SessionSnapshot(state=state, model_name="m", persona_digest="abc", context=context, context_model="m")
+
+    blob = snap.to_bytes()
+    restored = SessionSnapshot.from_bytes(blob)
+
+    assert restored.state == state and restored.context == context and restored.context_model == "m"
+    assert len(blob) < len(json.dumps(context)) / 4
+
+    store = SnapshotStore(tmp_path / "snaps")
+    store.save("persona/session", snap)
+    assert store.load("persona/session").context == context
+    store.path_for("broken").write_bytes(b"CLSN garbage")
+    assert store.load("broken") is None and not store.path_for("broken").exists()
+
+
+def test_turns_continue_from_the_backend_context_across_a_restart(tmp_path, monkeypatch, fake_ollama) -> None:
+    import clone_server
+
+    def new_agent():
+        agent = AIPersonaAgent(create_yamada_taro_persona(), simulation_mode=False, episodic_memory=False)
+        agent.client.transport = RecordingTransport(fake_ollama.base_url)
+        agent.client.use_context = True
+        return agent
+
+    persona = clone_server.get_registry().get(None)
+    snapshots = SnapshotStore(tmp_path)
+    agent = new_agent()
+    asyncio.run(agent.aprocess_input("はじめまして！"))
+    asyncio.run(agent.aprocess_input("趣味は何？"))
+    first, second = agent.client.transport.calls
+
+    # The first turn sends the whole prompt; the next one only what is new, on top of the context
+    assert first["context"] is None and agent.persona.name in first["prompt"]
+    assert second["context"] and agent.persona.name not in second["prompt"] and "趣味は何？" in second["prompt"]
+    assert second["prompt_eval_count"] < first["prompt_eval_count"]
+
+    clone_server._save_snapshot(snapshots, "snap-a", agent, persona)
+    restarted = new_agent()
+    restarted.persona = persona.template
+    monkeypatch.setattr(clone_server, "_get_snapshot_store", lambda: snapshots)
+    clone_server._restore_snapshot("snap-a", restarted, persona, None)
+    assert restarted.memory.turn_count == 2 and restarted.client.context == agent.client.context
+
+    asyncio.run(restarted.aprocess_input("どこに住んでるの？"))
+    resumed = restarted.client.transport.calls[0]
+    assert resumed["context"] == agent.client.context and "どこに住んでるの？" in resumed["prompt"]
+    assert resumed["prompt_eval_count"] < first["prompt_eval_count"]
+
+
+def test_server_restores_sessions_lazily_after_a_restart(fast_simulation, tmp_path, monkeypatch) -> None:
+    import clone_server
+
+    monkeypatch.setenv("CLONEAI_SNAPSHOT_DIR", str(tmp_path / "snaps"))
+    client = TestClient(clone_server.app)
+
+    client.post("/chat", json={"message": "私の名前は田中です", "session_id": "snap-b"})
+    monkeypatch.setattr(clone_server, "_sessions", {})
+    client.post("/chat", json={"message": "覚えてる？", "session_id": "snap-b"})
+
+    agent = clone_server._sessions["snap-b"]
+    assert agent.memory.turn_count == 2
+    assert agent.memory.conversation_history[0]["user"] == "私の名前は田中です"
@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+
+from fastapi.testclient import TestClient
+
+from benchmark.startup_profile import SERVICE_DIR, parse_importtime
+
+
+def test_server_import_defers_heavy_backends() -> None:
+    code = "import sys, clone_server; print(','.join(m for m in ('ollama', 'requests', 'httpx') if m in sys.modules))"
+    proc = subprocess.run([sys.executable, "-c", code], cwd=SERVICE_DIR, capture_output=True, text=True, check=True)
+
+    assert proc.stdout.strip() == ""
+
+
+def test_server_refuses_to_start_with_a_mistyped_prompt_mode() -> None:
+    env = {**os.environ, "CLONEAI_PERSONA_PROMPT_MODE": "selctive"}
+    proc = subprocess.run(
+        [sys.executable, "-c", "import clone_server"], cwd=SERVICE_DIR, env=env, capture_output=True, text=True
+    )
+
+    assert proc.returncode != 0 and "CLONEAI_PERSONA_PROMPT_MODE" in proc.stderr
+
+
+def test_parse_importtime() -> None:
+    stderr = (
+        "import time: self [us] | cumulative | imported package\n"
+        "import time:       120 |        120 |   json.decoder\n"
+        "import time:       300 |        420 | json\n"
+    )
+    entries = parse_importtime(stderr)
+
+    assert [(e.module, e.depth, e.cumulative_ms) for e in entries] == [("json.decoder", 1, 0.12), ("json", 0, 0.42)]
+
+
+def test_ready_reports_after_warm_up(monkeypatch) -> None:
+    monkeypatch.setenv("OLLAMA_HOST", "http://127.0.0.1:9")
+    import clone_server
+
+    monkeypatch.setattr(clone_server, "_backend_check", (float("-inf"), False))
+    clone_server._ready.clear()
+    client = TestClient(clone_server.app)
+    assert client.get("/health").json() == {"ok": True}
+    assert client.get("/ready").status_code == 503
+
+    clone_server.warm_up()
+    res = client.get("/ready")
+    assert res.status_code == 200 and "personas" in res.json()["warmup_ms"]
+
+
+def test_failed_warm_up_step_is_reported_instead_of_blocking_ready(monkeypatch) -> None:
+    monkeypatch.setenv("OLLAMA_HOST", "http://127.0.0.1:9")
+    import clone_server
+
+    def broken():
+        raise RuntimeError("index file is corrupt")
+
+    monkeypatch.setattr(clone_server, "_backend_check", (float("-inf"), False))
+    monkeypatch.setattr(clone_server, "_get_retriever", broken)
+    monkeypatch.setattr(clone_server, "_warmup_errors", {})
+    clone_server._ready.clear()
+
+    clone_server.warm_up()
+    res = TestClient(clone_server.app).get("/ready")
+
+    assert res.status_code == 200
+    assert res.json()["warmup_errors"] == {"retriever": "RuntimeError: index file is corrupt"}
+    assert "exemplar_index" in res.json()["warmup_ms"]
@@ -0,0 +1,105 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+
+@pytest.fixture
+def server(fast_simulation, monkeypatch):
+    import clone_server
+
+    monkeypatch.setattr(clone_server, "_WS_EVENT_INTERVAL_S", 0.0)
+    return clone_server
+
+
+def _until(ws, kind):
+    frames = []
+    while True:
+        frame = ws.receive_json()
+        frames.append(frame)
+        if frame["type"] == kind:
+            return frames
+
+
+def test_turns_stream_tokens_then_reply_and_push_learned_facts(server) -> None:
+    with TestClient(server.app) as client:
+        with client.websocket_connect("/ws/session/ws-a") as ws:
+            ready = ws.receive_json()
+            assert ready["type"] == "ready" and ready["resumed"] is False and ready["resume_token"]
+
+            ws.send_json({"type": "turn", "id": "t1", "message": "私の名前は田中です"})
+            frames = _until(ws, "reply")
+            tokens = [f["text"] for f in frames if f["type"] == "token"]
+            reply = frames[-1]
+            assert tokens and all(f["id"] == "t1" for f in frames)
+            assert reply["reply"] and reply["session_id"] == "ws-a" and reply["seq"] == 1
+
+            facts = ws.receive_json()
+            assert facts["type"] == "event" and facts["event"] == "facts" and facts["id"] == "t1"
+            assert facts["facts"]["名前"] == "田中"
+
+            ws.send_json({"type": "ping", "ts": 1})
+            assert ws.receive_json() == {"type": "pong", "ts": 1}
+            ws.send_json({"type": "turn", "id": "t2", "message": ""})
+            assert _until(ws, "error")[-1]["status"] == 422
+
+    assert server._sessions["ws-a"].memory.turn_count == 1
+
+
+def test_resume_replays_missed_frames(server) -> None:
+    with TestClient(server.app) as client:
+        with client.websocket_connect("/ws/session/ws-b") as ws:
+            token = ws.receive_json()["resume_token"]
+            ws.send_json({"type": "turn", "id": "t1", "message": "こんにちは"})
+            reply = _until(ws, "reply")[-1]
+
+        with client.websocket_connect(f"/ws/session/ws-b?resume={token}&last_seq=0") as ws:
+            ready = ws.receive_json()
+            assert ready["resumed"] is True and ready["turn_count"] == 1 and ready["resume_token"] == token
+            assert ws.receive_json() == reply
+
+        # An unknown token starts a fresh channel on the same session
+        with client.websocket_connect("/ws/session/ws-b?resume=stale") as ws:
+            ready = ws.receive_json()
+            assert ready["resumed"] is False and ready["resume_token"] != token
+
+
+def test_cancel_stops_a_running_turn(server, monkeypatch) -> None:
+    import clone_agentAI
+
+    async def slow_simulate(self, prompt, parts, on_token=None):
+        import asyncio
+        await asyncio.sleep(5)
+        return "遅い応答"
+
+    monkeypatch.setattr(clone_agentAI.OllamaClient, "_simulate_into", slow_simulate)
+    with TestClient(server.app) as client:
+        with client.websocket_connect("/ws/session/ws-c") as ws:
+            ws.receive_json()
+            ws.send_json({"type": "turn", "id": "slow", "message": "こんにちは"})
+            ws.send_json({"type": "cancel", "id": "slow"})
+            assert ws.receive_json() == {"type": "cancelled", "id": "slow", "seq": 1}
+
+    assert server._sessions["ws-c"].memory.turn_count == 0
+
+
+def test_silent_client_is_closed_after_missed_heartbeats(server, monkeypatch) -> None:
+    monkeypatch.setattr(server, "_WS_HEARTBEAT_S", 0.05)
+    with TestClient(server.app) as client:
+        with client.websocket_connect("/ws/session/ws-d") as ws:
+            assert ws.receive_json()["heartbeat_s"] == 0.05
+            started = time.monotonic()
+            with pytest.raises(WebSocketDisconnect) as exc:
+                while True:
+                    assert ws.receive_json()["type"] == "ping"
+            assert exc.value.code == server.WS_CLOSE_HEARTBEAT_TIMEOUT
+            assert time.monotonic() - started < 2.0
+
+
+def test_unknown_persona_is_rejected(server) -> None:
+    client = TestClient(server.app)
+    with pytest.raises(WebSocketDisconnect) as exc:
+        with client.websocket_connect("/ws/session/ws-e?persona_id=nobody") as ws:
+            ws.receive_json()
+    assert exc.value.code == server.WS_CLOSE_UNKNOWN_PERSONA
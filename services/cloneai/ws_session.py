@@ -0,0 +1,128 @@
+"""1つのセッションに結び付いた WebSocket チャネル（/ws/session/{session_id}）の状態
+
+長い実験セッションでは1ターンごとに HTTP リクエストを張り直すより、接続を1本張ったままにして
+ターン・トークン・サーバーからのイベントを流す方が安い。接続が切れても SessionChannel は
+猶予時間（CLONEAI_WS_RESUME_GRACE_S）だけ残り、その間は実行中のターンも続ける。
+再接続のときに resume_token と最後に受け取った seq を渡せば、その後に送ったフレームを送り直す。
+
+送り直すのは seq を付けたフレーム（reply / error / cancelled / facts のイベント）だけで、
+token・pong・metrics のイベントのような一時的なフレームは切断中なら捨てる
+（トークンを取りこぼしても最後の reply に全文が入っている）。
+
+イベントループのスレッドからだけ使う。
+
+    CLONEAI_WS_HEARTBEAT_S=20
+    CLONEAI_WS_RESUME_GRACE_S=30
+    CLONEAI_WS_EVENT_INTERVAL_S=10       # metrics のイベントの間隔（0 で送らない）
+"""
+
+from __future__ import annotations
+
+import asyncio
+import secrets
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from metrics import REGISTRY
+
+_connected = REGISTRY.gauge("cloneai_ws_sessions_connected", "WebSocket session channels with a client attached")
+_resumes = REGISTRY.counter("cloneai_ws_resumes_total", "WebSocket reconnects by whether the channel was resumed")
+
+# 送り直しのために覚えておく seq 付きフレームの数
+DEFAULT_REPLAY_SIZE = 256
+
+
+class SessionChannel:
+    """1つのセッションのチャネル。接続（送信キュー）は付け替えられる"""
+    def __init__(self, key: str, replay_size: int = DEFAULT_REPLAY_SIZE):
+        self.key = key
+        self.resume_token = secrets.token_urlsafe(16)
+        self.seq = 0
+        # 実行中（または順番待ち）のターン。id -> タスク
+        self.turns: Dict[str, asyncio.Task] = {}
+        # 同じセッションのターンは前のターンの上に積むので1つずつ実行する
+        self.turn_lock = asyncio.Lock()
+        self._replay: Deque[Dict[str, Any]] = deque(maxlen=replay_size)
+        self._outbox: Optional[asyncio.Queue] = None
+        self._expiry: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def attached(self) -> bool:
+        return self._outbox is not None
+
+    def push(self, frame: Dict[str, Any]) -> Dict[str, Any]:
+        """seq を付けて送る。接続が無ければ再接続のときに送る"""
+        self.seq += 1
+        frame = {**frame, "seq": self.seq}
+        self._replay.append(frame)
+        self.send(frame)
+        return frame
+
+    def send(self, frame: Dict[str, Any]) -> None:
+        """seq を付けずに送る（接続が無ければ捨てる）"""
+        if self._outbox is not None:
+            self._outbox.put_nowait(frame)
+
+    def attach(self, last_seq: int = 0) -> "asyncio.Queue":
+        """新しい接続の送信キューを返す。前の接続があれば None を入れて閉じさせる
+
+        last_seq より後の seq 付きフレームを先にキューに入れる。
+        """
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        if self._outbox is not None:
+            self._outbox.put_nowait(None)
+        else:
+            _connected.inc()
+        self._outbox = asyncio.Queue()
+        for frame in self._replay:
+            if frame["seq"] > last_seq:
+                self._outbox.put_nowait(frame)
+        return self._outbox
+
+    def detach(self, outbox: "asyncio.Queue", grace_s: float, on_expire: Any) -> None:
+        """接続が切れた。grace_s 秒以内に再接続が無ければ実行中のターンを止めて on_expire(self) を呼ぶ
+
+        別の接続に付け替え済みなら何もしない。
+        """
+        if outbox is not self._outbox:
+            return
+        self._outbox = None
+        _connected.dec()
+        self._expiry = asyncio.get_running_loop().call_later(max(0.0, grace_s), self._expire, on_expire)
+
+    def _expire(self, on_expire: Any) -> None:
+        self._expiry = None
+        self.close()
+        on_expire(self)
+
+    def close(self) -> None:
+        """実行中のターンをすべて止める"""
+        for task in list(self.turns.values()):
+            task.cancel()
+
+
+class ChannelRegistry:
+    """resume_token からチャネルを引く"""
+    def __init__(self, replay_size: int = DEFAULT_REPLAY_SIZE):
+        self.replay_size = replay_size
+        self._by_token: Dict[str, SessionChannel] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_token)
+
+    def open(self, key: str, resume_token: Optional[str] = None) -> SessionChannel:
+        """resume_token のチャネルが同じセッションのものならそれを、無ければ新しいチャネルを返す"""
+        channel = self._by_token.get(resume_token) if resume_token else None
+        if resume_token:
+            _resumes.inc(resumed="true" if channel is not None and channel.key == key else "false")
+        if channel is not None and channel.key == key:
+            return channel
+        channel = SessionChannel(key, replay_size=self.replay_size)
+        self._by_token[channel.resume_token] = channel
+        return channel
+
+    def drop(self, channel: SessionChannel) -> None:
+        if self._by_token.get(channel.resume_token) is channel:
+            del self._by_token[channel.resume_token]
@@ -0,0 +1,79 @@
+import { NextRequest, NextResponse } from 'next/server';
+import fs from 'node:fs';
+import path from 'node:path';
+
+type CloneAIChatItem = {
+    message: string;
+    session_id?: string;
+    reset?: boolean;
+    model_name?: string | null;
+    persona_id?: string | null;
+    deadline_ms?: number | null;
+    priority?: 'interactive' | 'background' | 'batch';
+};
+
+type CloneAIChatBatchRequest = {
+    items: CloneAIChatItem[];
+};
+
+function getCloneAIBaseUrl(): string {
+    if (process.env.CLONEAI_BASE_URL) return process.env.CLONEAI_BASE_URL;
+
+    try {
+        const portFilePath = path.join(process.cwd(), '.cloneai-port');
+        const portText = fs.readFileSync(portFilePath, 'utf8').trim();
+        const port = Number(portText);
+        if (Number.isFinite(port) && port > 0) {
+            return `http://127.0.0.1:${port}`;
+        }
+    } catch {
+        // ignore
+    }
+
+    return 'http://127.0.0.1:8001';
+}
+
+// 結果は1件終わるごとに NDJSON の1行 ({"index", "ok", "result" | "error"}) として届くので、そのまま流す
+export async function POST(request: NextRequest) {
+    try {
+        const body = (await request.json()) as CloneAIChatBatchRequest;
+
+        if (!Array.isArray(body?.items) || body.items.length === 0) {
+            return NextResponse.json({ error: 'items is required' }, { status: 400 });
+        }
+        if (body.items.some((item) => !item?.message || typeof item.message !== 'string' || !item.message.trim())) {
+            return NextResponse.json({ error: 'every item needs a message' }, { status: 400 });
+        }
+
+        const baseUrl = getCloneAIBaseUrl().replace(/\/$/, '');
+        const res = await fetch(`${baseUrl}/chat/batch`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ items: body.items }),
+            // ブラウザ側が切断したら CloneAI 側の未完了の項目もキャンセルさせる
+            signal: request.signal,
+            cache: 'no-store',
+        });
+
+        if (!res.ok || !res.body) {
+            const errorText = await res.text().catch(() => '');
+            return NextResponse.json(
+                { error: `CloneAI error: ${res.status} ${errorText}` },
+                { status: res.status === 200 ? 502 : res.status }
+            );
+        }
+
+        return new Response(res.body, {
+            status: 200,
+            headers: { 'Content-Type': 'application/x-ndjson', 'Cache-Control': 'no-store' },
+        });
+    } catch (error: any) {
+        console.error('CloneAI batch proxy error:', error);
+        const cause = error?.cause;
+        const code = cause?.code || error?.code;
+        if (code === 'ECONNREFUSED' || code === 'ENOTFOUND') {
+            return NextResponse.json({ error: 'CloneAIバックエンドへ接続できませんでした' }, { status: 502 });
+        }
+        return NextResponse.json({ error: error?.message || 'Unknown error' }, { status: 500 });
+    }
+}
@@ -7,12 +7,18 @@ type CloneAIChatRequest = {
     session_id?: string;
     reset?: boolean;
     model_name?: string | null;
+    persona_id?: string | null;
+    idempotency_key?: string | null;
 };
 
 type CloneAIChatResponse = {
     reply: string;
     session_id: string;
     model_name: string;
+    persona_id: string;
+    degraded?: boolean;
+    degraded_reason?: 'partial' | 'fallback' | null;
+    replayed?: boolean;
 };
 
 function getCloneAIBaseUrl(): string {
@@ -45,6 +51,9 @@ export async function POST(request: NextRequest) {
 
         const controller = new AbortController();
         const timeoutId = setTimeout(() => controller.abort(), 30000);
+        // ブラウザ側が切断したら CloneAI への接続も閉じ、生成を止めさせる
+        const abortUpstream = () => controller.abort();
+        request.signal.addEventListener('abort', abortUpstream);
 
         let res: Response;
         try {
@@ -56,6 +65,9 @@ export async function POST(request: NextRequest) {
                     session_id: body.session_id || 'default',
                     reset: Boolean(body.reset),
                     model_name: body.model_name ?? null,
+                    persona_id: body.persona_id ?? null,
+                    // 同じキーでやり直すと CloneAI は生成し直さず、最初のリクエストの応答を返す
+                    idempotency_key: body.idempotency_key ?? request.headers.get('idempotency-key'),
                 }),
                 signal: controller.signal,
                 cache: 'no-store',
@@ -78,6 +90,7 @@ export async function POST(request: NextRequest) {
             throw err;
         } finally {
             clearTimeout(timeoutId);
+            request.signal.removeEventListener('abort', abortUpstream);
         }
 
         if (!res.ok) {
@@ -30,7 +30,11 @@ export default function CloneAITestPage() {
             const res = await fetch('/api/cloneai/chat', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ message: content, session_id: 'default' }),
+                body: JSON.stringify({
+                    message: content,
+                    session_id: 'default',
+                    idempotency_key: crypto.randomUUID(),
+                }),
             });
 
             const data = await res.json().catch(() => ({}));